@@ -19,13 +19,53 @@ resource "aws_dynamodb_table" "intraday_job_status" {
     type = "S"
   }
 
+  attribute {
+    name = "IsActive"
+    type = "S"
+  }
+
   global_secondary_index {
     hash_key           = "Collection"
     range_key          = "TriggeredTime"
     name               = "byCollection"
     projection_type    = "INCLUDE"
-    non_key_attributes = ["JobStatus", "ProcessedDataStart", "ProcessedDataEnd"]
+    non_key_attributes = ["JobStatus", "ProcessedDataStart", "ProcessedDataEnd", "RecordCount", "InputBytes"]
+  }
+
+  # sparse index of items in an active JobStatus, used to check for running jobs
+  # and to find jobs abandoned by a lambda or cluster that died
+  global_secondary_index {
+    hash_key           = "IsActive"
+    name               = "byActiveJobs"
+    projection_type    = "INCLUDE"
+    non_key_attributes = ["JobStatus", "TriggeredTime"]
+  }
+
+  # completed and deferred items expire after JOB_STATUS_RETENTION_DAYS, the
+  # WATERMARK, LEASE and MIGRATION items never do
+  ttl {
+    attribute_name = "ExpiresAt"
+    enabled        = true
   }
 
   tags = { Name = "intraday-job-status" }
-}
\ No newline at end of file
+}
+
+resource "aws_dynamodb_table" "intraday_run_history" {
+  name         = "intraday-run-history"
+  hash_key     = "Collection"
+  range_key    = "TriggeredTime"
+  billing_mode = "PAY_PER_REQUEST"
+
+  attribute {
+    name = "Collection"
+    type = "S"
+  }
+
+  attribute {
+    name = "TriggeredTime"
+    type = "N"
+  }
+
+  tags = { Name = "intraday-run-history" }
+}
@@ -325,6 +325,19 @@ data "aws_iam_policy_document" "intraday_emr_main" {
     resources = [aws_acm_certificate.intraday-emr.arn]
   }
 
+  statement {
+    sid    = "AllowIntradayRunHistory"
+    effect = "Allow"
+
+    actions = [
+      "dynamodb:BatchWriteItem",
+      "dynamodb:PutItem",
+      "dynamodb:Query",
+    ]
+
+    resources = [aws_dynamodb_table.intraday_run_history.arn]
+  }
+
   statement {
     sid    = "GetPublicCerts"
     effect = "Allow"
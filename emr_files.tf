@@ -105,6 +105,7 @@ resource "aws_s3_object" "generate_dataset_from_hbase" {
       incremental_output_prefix = "intraday/"
       collections_secret_name   = local.collections_secret_name
       job_status_table_name     = aws_dynamodb_table.intraday_job_status.name
+      run_history_table_name    = aws_dynamodb_table.intraday_run_history.name
   })
 
   tags = { Name = "emr-step-generate-dataset-from-hbase" }
@@ -118,6 +119,14 @@ resource "aws_s3_object" "generate_dataset_from_adg" {
   tags = { Name = "emr-step-generate-dataset-from-adg" }
 }
 
+resource "aws_s3_object" "fairscheduler_xml" {
+  bucket  = data.terraform_remote_state.common.outputs.config_bucket["id"]
+  key     = "${local.ingest_emr_step_scripts_s3_prefix}/fairscheduler.xml"
+  content = file("files/emr-config/fairscheduler.xml")
+
+  tags = { Name = "emr-step-fairscheduler-xml" }
+}
+
 
 resource "aws_s3_object" "download_scripts" {
   bucket = data.terraform_remote_state.common.outputs.config_bucket["id"]
@@ -44,3 +44,9 @@ sudo -E $PIP install requests >> /var/log/emr-bootstrap/install-requests.log 2>&
   sudo -E $PIP install pycryptodome
   sudo yum remove -y python3-devel
 } >> /var/log/emr-bootstrap/install-pycrypto.log 2>&1
+# emr 5.x runs python 3.7, which current orjson releases no longer support
+#shellcheck disable=SC2024
+sudo -E $PIP install orjson==3.6.1 >> /var/log/emr-bootstrap/install-orjson.log 2>&1
+# Spark 2.4 (emr 5.x) pandas UDFs only read the Arrow IPC format of pyarrow < 0.15
+#shellcheck disable=SC2024
+sudo -E $PIP install pandas==0.25.3 pyarrow==0.14.1 >> /var/log/emr-bootstrap/install-pandas.log 2>&1
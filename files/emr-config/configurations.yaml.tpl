@@ -36,6 +36,12 @@ Configurations:
     "javax.jdo.option.ConnectionPassword": "${hive_metastore_pwd}"
     "hive.metastore.client.socket.timeout": "7200"
 
+- Classification: "spark-defaults"
+  Properties:
+    "spark.scheduler.mode": "FAIR"
+    "spark.scheduler.allocation.file": "/var/ci/fairscheduler.xml"
+    "spark.io.encryption.enabled": "true"
+
 - Classification: "spark-hive-site"
   Properties:
     "hive.txn.manager": "org.apache.hadoop.hive.ql.lockmgr.DbTxnManager"
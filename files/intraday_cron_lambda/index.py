@@ -5,8 +5,11 @@ import time
 from uuid import uuid4
 import base64
 import ast
+from concurrent.futures import ThreadPoolExecutor
 import boto3
-from boto3.dynamodb.conditions import Attr
+import botocore.exceptions
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeSerializer
 
 _logger = logging.getLogger()
 _logger.setLevel(logging.INFO)
@@ -18,23 +21,46 @@ LAUNCH_SNS_TOPIC_ARN = os.environ["launch_topic_arn"]
 EMR_CONFIG_BUCKET = os.environ["emr_config_bucket"]
 EMR_CONFIG_PREFIX = os.environ["emr_config_folder"]
 COLLECTIONS_SECRET_NAME = os.environ["collections_secret_name"]
+# long enough for the cluster to start, after which the step renews the leases
+LEASE_DURATION_MINUTES = int(os.environ.get("lease_duration_minutes", "60"))
 
 # Job Statuses & values stored in DynamoDB
 TRIGGERED = "LAMBDA_TRIGGERED"  # this lambda was triggered
-WAITING = "WAITING"  # this lambda is waiting up to 10 minutes for another cluster
-DEFERRED = "DEFERRED"  # this lambda timed out waiting, did not launch emr
+WAITING = "WAITING"  # no longer written, lambdas do not wait for other clusters
+DEFERRED = "DEFERRED"  # collection skipped, its lease is held or it has failed
 LAUNCHED = "EMR_LAUNCHED"  # this lambda posted to SNS topic to launch EMR cluster
 PROCESSING = "EMR_PROCESSING"  # emr cluster has started processing data
 COMPLETED = "EMR_COMPLETED"  # emr cluster processed the data successfully
 EMR_FAILED = "EMR_FAILED"  # emr cluster couldn't process data successfully
 LAMBDA_FAILED = "LAMBDA_FAILED"  # lambda encountered an error
 
-# this lambda will not launch emr if another job is in one of these states
-ACTIVE_STATES = [TRIGGERED, WAITING, LAUNCHED, PROCESSING, EMR_FAILED, LAMBDA_FAILED]
+THROTTLING_ERROR_CODES = {
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "ThrottlingException",
+}
 
-
-class PollingTimeoutError(TimeoutError):
-    pass
+# items in these states are flagged with IsActive, which keys the sparse
+# byActiveJobs index
+ACTIVE_STATES = [TRIGGERED, WAITING, LAUNCHED, PROCESSING, EMR_FAILED]
+ACTIVE_JOBS_INDEX = "byActiveJobs"
+# a collection is skipped while another job for it is in one of these states,
+# until the JobStatus is changed by hand (e.g. to _FAILED).  A lambda failure
+# does not block the collection, its lease decides whether it can be launched
+FAILED_STATES = [EMR_FAILED]
+# states of a job that is still being launched or processed.  An item left in
+# one of them by a lambda or cluster that died is retired once its job no
+# longer holds a live lease on the collection
+IN_FLIGHT_STATES = [TRIGGERED, WAITING, LAUNCHED, PROCESSING]
+# collections are processed by one cluster at a time, which holds the lease in
+# the collection's LEASE item until the step releases it or the lease expires
+LEASE_CORRELATION_ID = "LEASE"
+# items in these states expire through the table's ExpiresAt TTL attribute
+TERMINAL_STATES = [COMPLETED, DEFERRED, LAMBDA_FAILED]
+JOB_STATUS_RETENTION_DAYS = 90
+# key of the item recording that items written before the IsActive flag was
+# introduced have been flagged
+ACTIVE_FLAG_BACKFILL_KEY = {"CorrelationId": "MIGRATION", "Collection": "IsActive"}
 
 
 def get_collections_list_from_aws(secrets_client, collections_secret_name):
@@ -56,55 +82,309 @@ def retrieve_secrets(secrets_client, secret_name):
     return response_dict
 
 
-def update_db_items(table, collections, correlation_id: str, values: dict):
+def get_attribute_updates(values: dict):
+    """Return AttributeUpdates putting values.  When JobStatus is set, the
+    IsActive flag is put or removed to match it, and terminal statuses are
+    given an ExpiresAt time."""
+    serializer = TypeSerializer()
+    updates = {
+        key: {"Value": serializer.serialize(value), "Action": "PUT"}
+        for key, value in values.items()
+    }
+    if "JobStatus" in values:
+        if values["JobStatus"] in ACTIVE_STATES:
+            updates["IsActive"] = {"Value": {"S": "true"}, "Action": "PUT"}
+        else:
+            updates["IsActive"] = {"Action": "DELETE"}
+        if values["JobStatus"] in TERMINAL_STATES:
+            expires_at = round(time.time()) + JOB_STATUS_RETENTION_DAYS * 86400
+            updates["ExpiresAt"] = {"Value": {"N": str(expires_at)}, "Action": "PUT"}
+    return updates
+
+
+def update_db_items(
+    table,
+    collections,
+    correlation_id: str,
+    values: dict,
+    max_workers=20,
+    retries=5,
+):
+    """Update each collection's item with values, sending the updates
+    concurrently through the table's client.  Throttled updates are retried
+    with backoff, any other error is raised."""
     _logger.info(f"Updating db item: {values}")
-    updates = {key: {"Value": value} for key, value in values.items()}
-    for collection in collections:
-        table.update_item(
+    client = table.meta.client
+    updates = get_attribute_updates(values)
+
+    def update_item(collection):
+        return call_with_retries(
+            client.update_item,
+            retries,
+            TableName=table.name,
             Key={
-                "CorrelationId": correlation_id,
-                "Collection": collection,
+                "CorrelationId": {"S": correlation_id},
+                "Collection": {"S": collection},
             },
             AttributeUpdates=updates,
         )
 
+    map_concurrently(update_item, collections, max_workers)
 
-def check_for_running_jobs(table, collections, correlation_id):
-    _logger.debug("Checking for running jobs")
-    results = table.scan(
-        FilterExpression=Attr("JobStatus").is_in(ACTIVE_STATES)
-        & Attr("CorrelationId").ne(correlation_id)
-        & Attr("Collection").is_in(collections),
-    )
-    return results["Items"]
+
+def call_with_retries(call, retries=5, **kwargs):
+    """Call a DynamoDB client method, retrying throttled requests with backoff"""
+    for attempt in range(retries + 1):
+        try:
+            return call(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code not in THROTTLING_ERROR_CODES or attempt == retries:
+                raise
+            time.sleep(0.1 * 2**attempt)
+
+
+def map_concurrently(function, items, max_workers=20):
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(function, items))
+
+
+def acquire_leases(
+    table, collections, correlation_id: str, duration_minutes=LEASE_DURATION_MINUTES
+):
+    """Try to take the lease of each collection with a conditional write, which
+    succeeds if the lease is free or has expired.  Returns the collections
+    whose leases were acquired."""
+    client = table.meta.client
+    now = round(time.time() * 1000)
+    expires_at = now + duration_minutes * 60 * 1000
+
+    def acquire_lease(collection):
+        try:
+            call_with_retries(
+                client.update_item,
+                TableName=table.name,
+                Key={
+                    "CorrelationId": {"S": LEASE_CORRELATION_ID},
+                    "Collection": {"S": collection},
+                },
+                UpdateExpression="SET LeaseOwner = :owner,"
+                " LeaseAcquiredTime = :now, LeaseExpiresAt = :expires",
+                ConditionExpression="attribute_not_exists(LeaseOwner)"
+                " OR LeaseExpiresAt < :now",
+                ExpressionAttributeValues={
+                    ":owner": {"S": correlation_id},
+                    ":now": {"N": str(now)},
+                    ":expires": {"N": str(expires_at)},
+                },
+            )
+            return True
+        except botocore.exceptions.ClientError as e:
+            if (
+                e.response.get("Error", {}).get("Code")
+                == "ConditionalCheckFailedException"
+            ):
+                return False
+            raise
+
+    acquired = map_concurrently(acquire_lease, collections)
+    return [collection for collection, won in zip(collections, acquired) if won]
+
+
+def release_leases(table, collections, correlation_id: str):
+    """Release the collections' leases held by correlation_id"""
+    client = table.meta.client
+
+    def release_lease(collection):
+        try:
+            call_with_retries(
+                client.update_item,
+                TableName=table.name,
+                Key={
+                    "CorrelationId": {"S": LEASE_CORRELATION_ID},
+                    "Collection": {"S": collection},
+                },
+                UpdateExpression="REMOVE LeaseOwner, LeaseAcquiredTime, LeaseExpiresAt",
+                ConditionExpression="LeaseOwner = :owner",
+                ExpressionAttributeValues={":owner": {"S": correlation_id}},
+            )
+        except botocore.exceptions.ClientError as e:
+            if (
+                e.response.get("Error", {}).get("Code")
+                != "ConditionalCheckFailedException"
+            ):
+                raise
+
+    map_concurrently(release_lease, collections)
+
+
+def get_active_jobs(table):
+    """Return the items in the sparse active jobs index.  Its size depends on
+    the number of active jobs, not on the size of the table."""
+    query = {
+        "IndexName": ACTIVE_JOBS_INDEX,
+        "KeyConditionExpression": Key("IsActive").eq("true"),
+    }
+    items = []
+    while True:
+        results = table.query(**query)
+        items.extend(results["Items"])
+        if "LastEvaluatedKey" not in results:
+            return items
+        query["ExclusiveStartKey"] = results["LastEvaluatedKey"]
 
 
-def poll_previous_jobs(correlation_id, collections, table, timeout=300):
-    _logger.info("Polling for previous running jobs")
-    start_time = time.time()
+def clear_active_flag(table, item):
+    """Remove IsActive from an item and let it expire, unless its JobStatus
+    has since changed"""
+    expires_at = round(time.time()) + JOB_STATUS_RETENTION_DAYS * 86400
+    try:
+        table.update_item(
+            Key={
+                "CorrelationId": item["CorrelationId"],
+                "Collection": item["Collection"],
+            },
+            UpdateExpression="REMOVE IsActive SET ExpiresAt = :expires",
+            ConditionExpression=Attr("JobStatus").eq(item.get("JobStatus")),
+            ExpressionAttributeValues={":expires": expires_at},
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "ConditionalCheckFailedException":
+            raise
 
-    running_jobs = check_for_running_jobs(table, collections, correlation_id)
-    while running_jobs:
-        _logger.info(
-            f"Waited {round(time.time() - start_time)}/{timeout}"
-            f" seconds for previous collections to complete:"
+
+def backfill_active_flags(table):
+    """Flag the items left in an active state before IsActive was written, so
+    that the byActiveJobs index sees them.  This scans the table once, after
+    which a marker item records that it is done.  Returns the number of items
+    flagged."""
+    if "Item" in table.get_item(Key=ACTIVE_FLAG_BACKFILL_KEY):
+        return 0
+    _logger.info("Flagging active items written before the byActiveJobs index")
+    scan = {
+        "FilterExpression": Attr("JobStatus").is_in(ACTIVE_STATES)
+        & Attr("IsActive").not_exists()
+    }
+    flagged = 0
+    while True:
+        results = table.scan(**scan)
+        for item in results["Items"]:
+            try:
+                table.update_item(
+                    Key={
+                        "CorrelationId": item["CorrelationId"],
+                        "Collection": item["Collection"],
+                    },
+                    UpdateExpression="SET IsActive = :active",
+                    ConditionExpression=Attr("JobStatus").eq(item["JobStatus"]),
+                    ExpressionAttributeValues={":active": "true"},
+                )
+                flagged += 1
+            except botocore.exceptions.ClientError as e:
+                if (
+                    e.response.get("Error", {}).get("Code")
+                    != "ConditionalCheckFailedException"
+                ):
+                    raise
+        if "LastEvaluatedKey" not in results:
+            break
+        scan["ExclusiveStartKey"] = results["LastEvaluatedKey"]
+    table.put_item(
+        Item=dict(
+            ACTIVE_FLAG_BACKFILL_KEY,
+            CompletedTime=round(time.time() * 1000),
+            FlaggedItems=flagged,
         )
-        _logger.info(
-            "\n".join(
-                [
-                    str({"topic": row["Collection"], "JobStatus": row["JobStatus"]})
-                    for row in running_jobs
+    )
+    _logger.info({"active_flags_backfilled": flagged})
+    return flagged
+
+
+def get_leases(table, collections):
+    """Return {collection: LEASE item} for the collections that have one"""
+    collections = sorted(set(collections))
+
+    def get_lease(collection):
+        return table.get_item(
+            Key={"CorrelationId": LEASE_CORRELATION_ID, "Collection": collection}
+        ).get("Item")
+
+    leases = map_concurrently(get_lease, collections)
+    return {
+        collection: lease
+        for collection, lease in zip(collections, leases)
+        if lease is not None
+    }
+
+
+def get_abandoned_jobs(table, items, now=None):
+    """Return the items in IN_FLIGHT_STATES triggered more than
+    LEASE_DURATION_MINUTES ago whose job doesn't hold a live lease on the
+    collection.  A running job keeps its lease renewed, so these were left by
+    a lambda or cluster that died."""
+    now = now or round(time.time() * 1000)
+    cutoff = now - LEASE_DURATION_MINUTES * 60 * 1000
+    candidates = [
+        item
+        for item in items
+        if item.get("JobStatus") in IN_FLIGHT_STATES
+        and int(item.get("TriggeredTime", 0)) < cutoff
+    ]
+    if not candidates:
+        return []
+    leases = get_leases(table, [item["Collection"] for item in candidates])
+    abandoned = []
+    for item in candidates:
+        lease = leases.get(item["Collection"], {})
+        if (
+            lease.get("LeaseOwner") != item["CorrelationId"]
+            or int(lease.get("LeaseExpiresAt", 0)) < now
+        ):
+            abandoned.append(item)
+    return abandoned
+
+
+def check_for_running_jobs(table, collections, correlation_id):
+    _logger.debug("Checking for running jobs")
+    collections = set(collections)
+    running_jobs = []
+    active_jobs = get_active_jobs(table)
+    abandoned = get_abandoned_jobs(
+        table, [i for i in active_jobs if i["CorrelationId"] != correlation_id]
+    )
+    if abandoned:
+        _logger.warning(
+            {
+                "abandoned_jobs": [
+                    f"{i['Collection']}: {i['JobStatus']} in job {i['CorrelationId']}"
+                    for i in abandoned
                 ]
-            )
+            }
         )
-        if time.time() >= (start_time + timeout):
-            update_db_items(table, collections, correlation_id, {"JobStatus": DEFERRED})
-            raise PollingTimeoutError(
-                f"Polling timeout ({timeout}s), job(s) still in progress"
-            )
-        time.sleep(5)
-        running_jobs = check_for_running_jobs(table, collections, correlation_id)
-    return True
+    for item in active_jobs:
+        if item.get("JobStatus") not in ACTIVE_STATES or item in abandoned:
+            # JobStatus was changed without clearing the flag, e.g. a failed
+            # job marked _FAILED by hand, or the job died
+            clear_active_flag(table, item)
+        elif (
+            item["CorrelationId"] != correlation_id
+            and item["Collection"] in collections
+        ):
+            running_jobs.append(item)
+    return running_jobs
+
+
+def get_failed_collections(table, collections, correlation_id):
+    """Return {collection: CorrelationId} for collections with a job left in
+    one of the FAILED_STATES"""
+    return {
+        item["Collection"]: item["CorrelationId"]
+        for item in check_for_running_jobs(table, collections, correlation_id)
+        if item["JobStatus"] in FAILED_STATES
+    }
 
 
 def launch_cluster(
@@ -112,7 +392,6 @@ def launch_cluster(
     triggered_time: int,
     collections,
     sns_client,
-    job_table,
     topic_arn: str,
 ):
     # Cluster takes 10~15m to provision, this provides adequate time for the pipeline
@@ -134,6 +413,8 @@ def launch_cluster(
                     str(triggered_time),
                     "--end_time",
                     str(new_end_time),
+                    "--lease_duration_minutes",
+                    str(LEASE_DURATION_MINUTES),
                     "--collections",
                 ]
                 + collections
@@ -148,7 +429,6 @@ def launch_cluster(
         Message=cluster_overrides,
         Subject="Launch ingest-replica emr cluster",
     )
-    update_db_items(job_table, collections, correlation_id, {"JobStatus": LAUNCHED})
 
 
 def handler(event, context):
@@ -175,38 +455,60 @@ def handler(event, context):
         {"JobStatus": TRIGGERED, "TriggeredTime": triggered_time},
     )
 
+    acquired = []
+    launched = False
     try:
-        update_db_items(job_table, collections, correlation_id, {"JobStatus": WAITING})
-        poll_previous_jobs(
-            correlation_id=correlation_id, collections=collections, table=job_table
+        backfill_active_flags(job_table)
+        failed = get_failed_collections(job_table, collections, correlation_id)
+        acquired = acquire_leases(
+            job_table, [i for i in collections if i not in failed], correlation_id
         )
-        launch_cluster(
-            correlation_id=correlation_id,
-            triggered_time=triggered_time,
-            collections=collections,
-            sns_client=sns_client,
-            job_table=job_table,
-            topic_arn=LAUNCH_SNS_TOPIC_ARN,
-        )
-    except PollingTimeoutError:
-        # Dynamodb already updated with status
-        alert_message = json.dumps(
-            {
-                "severity": "High",
-                "notification_type": "Warning",
-                "title_text": "Intraday Cluster Launch Deferred - Previous cluster still running",
-            }
-        )
-        sns_client.publish(
-            TargetArn=SLACK_ALERT_ARN,
-            Message=alert_message,
-        )
-        raise
+        skipped = {
+            collection: (
+                f"{collection}: failed in job {failed[collection]}"
+                if collection in failed
+                else f"{collection}: lease held by another job"
+            )
+            for collection in collections
+            if collection not in acquired
+        }
+        if skipped:
+            update_db_items(
+                job_table, list(skipped), correlation_id, {"JobStatus": DEFERRED}
+            )
+            _logger.warning({"skipped_collections": list(skipped.values())})
+            alert_message = json.dumps(
+                {
+                    "severity": "High",
+                    "notification_type": "Warning",
+                    "title_text": f"Intraday Cluster Launch - {len(skipped)} of"
+                    f" {len(collections)} collections skipped",
+                }
+            )
+            sns_client.publish(
+                TargetArn=SLACK_ALERT_ARN,
+                Message=alert_message,
+            )
+        if acquired:
+            launch_cluster(
+                correlation_id=correlation_id,
+                triggered_time=triggered_time,
+                collections=acquired,
+                sns_client=sns_client,
+                topic_arn=LAUNCH_SNS_TOPIC_ARN,
+            )
+            launched = True
+            update_db_items(
+                job_table, acquired, correlation_id, {"JobStatus": LAUNCHED}
+            )
     except Exception:
-        # Update Dynamodb with failure status
-        update_db_items(
-            job_table, collections, correlation_id, {"JobStatus": LAMBDA_FAILED}
-        )
+        # once the launch message is out the cluster will run, and holds the
+        # leases and updates the items itself
+        if not launched:
+            update_db_items(
+                job_table, acquired, correlation_id, {"JobStatus": LAMBDA_FAILED}
+            )
+            release_leases(job_table, acquired, correlation_id)
 
         alert_message = json.dumps(
             {
@@ -0,0 +1,269 @@
+import json
+import os
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault("job_status_table_name", "intraday-job-status")
+os.environ.setdefault("alert_topic_arn", "arn:aws:sns:eu-west-2:000000000000:alert")
+os.environ.setdefault("launch_topic_arn", "arn:aws:sns:eu-west-2:000000000000:launch")
+os.environ.setdefault("emr_config_bucket", "config-bucket")
+os.environ.setdefault("emr_config_folder", "emr/intraday/")
+os.environ.setdefault("collections_secret_name", "collections")
+
+import botocore.exceptions  # noqa: E402
+
+from index import (  # noqa: E402
+    ACTIVE_FLAG_BACKFILL_KEY,
+    DEFERRED,
+    EMR_FAILED,
+    LAMBDA_FAILED,
+    LAUNCHED,
+    LEASE_CORRELATION_ID,
+    TRIGGERED,
+    PROCESSING,
+    backfill_active_flags,
+    check_for_running_jobs,
+    handler,
+)
+
+
+class TestActiveFlagBackfill(unittest.TestCase):
+    def test_backfill_flags_active_items_once(self):
+        table = mock.MagicMock()
+        table.get_item.return_value = {}
+        table.scan.side_effect = [
+            {
+                "Items": [
+                    {
+                        "CorrelationId": "a",
+                        "Collection": "db:one",
+                        "JobStatus": LAUNCHED,
+                    }
+                ],
+                "LastEvaluatedKey": {"CorrelationId": "a", "Collection": "db:one"},
+            },
+            {
+                "Items": [
+                    {
+                        "CorrelationId": "b",
+                        "Collection": "db:two",
+                        "JobStatus": TRIGGERED,
+                    }
+                ]
+            },
+        ]
+
+        self.assertEqual(backfill_active_flags(table), 2)
+
+        self.assertEqual(
+            table.scan.call_args_list[1][1]["ExclusiveStartKey"],
+            {"CorrelationId": "a", "Collection": "db:one"},
+        )
+        flagged = [i[1]["Key"] for i in table.update_item.call_args_list]
+        self.assertEqual(
+            flagged,
+            [
+                {"CorrelationId": "a", "Collection": "db:one"},
+                {"CorrelationId": "b", "Collection": "db:two"},
+            ],
+        )
+        marker = table.put_item.call_args[1]["Item"]
+        self.assertEqual(marker["FlaggedItems"], 2)
+        self.assertEqual(
+            {k: marker[k] for k in ACTIVE_FLAG_BACKFILL_KEY}, ACTIVE_FLAG_BACKFILL_KEY
+        )
+
+    def test_backfill_skipped_once_recorded(self):
+        table = mock.MagicMock()
+        table.get_item.return_value = {"Item": dict(ACTIVE_FLAG_BACKFILL_KEY)}
+
+        self.assertEqual(backfill_active_flags(table), 0)
+
+        table.scan.assert_not_called()
+        table.put_item.assert_not_called()
+
+
+class TestAbandonedJobs(unittest.TestCase):
+    def test_abandoned_jobs_are_retired(self):
+        now = round(time.time() * 1000)
+        hours_ago = now - 3 * 3600 * 1000
+        items = [
+            # cluster died and its lease expired
+            {
+                "CorrelationId": "dead",
+                "Collection": "db:one",
+                "JobStatus": PROCESSING,
+                "TriggeredTime": hours_ago,
+            },
+            # long running cluster renewing its lease
+            {
+                "CorrelationId": "alive",
+                "Collection": "db:two",
+                "JobStatus": PROCESSING,
+                "TriggeredTime": hours_ago,
+            },
+            # lambda running now, not yet holding a lease
+            {
+                "CorrelationId": "starting",
+                "Collection": "db:three",
+                "JobStatus": TRIGGERED,
+                "TriggeredTime": now,
+            },
+            # failed jobs block the collection until handled
+            {
+                "CorrelationId": "failed",
+                "Collection": "db:four",
+                "JobStatus": EMR_FAILED,
+                "TriggeredTime": hours_ago,
+            },
+        ]
+        leases = {
+            "db:one": {"LeaseOwner": "dead", "LeaseExpiresAt": now - 1000},
+            "db:two": {"LeaseOwner": "alive", "LeaseExpiresAt": now + 600000},
+        }
+        table = mock.MagicMock()
+        table.query.return_value = {"Items": items}
+        table.get_item.side_effect = lambda Key: (
+            {"Item": leases[Key["Collection"]]} if Key["Collection"] in leases else {}
+        )
+
+        running = check_for_running_jobs(
+            table, ["db:one", "db:two", "db:three", "db:four"], "current"
+        )
+
+        self.assertEqual(running, items[1:])
+        (retired,) = table.update_item.call_args_list
+        self.assertEqual(
+            retired[1]["Key"], {"CorrelationId": "dead", "Collection": "db:one"}
+        )
+        self.assertEqual(
+            retired[1]["UpdateExpression"], "REMOVE IsActive SET ExpiresAt = :expires"
+        )
+
+
+class TestHandler(unittest.TestCase):
+    collections = ["db:free", "db:leased", "db:failed"]
+
+    def setUp(self):
+        self.table = mock.MagicMock()
+        self.table.name = "intraday-job-status"
+        self.table.get_item.return_value = {"Item": dict(ACTIVE_FLAG_BACKFILL_KEY)}
+        self.table.query.return_value = {
+            "Items": [
+                {
+                    "CorrelationId": "previous",
+                    "Collection": "db:failed",
+                    "JobStatus": EMR_FAILED,
+                }
+            ]
+        }
+        self.leases = {"db:leased": "other"}
+        self.statuses = {}
+        self.lease_requests = []
+        self.table.meta.client.update_item.side_effect = self.update_item
+        self.boto3 = mock.patch("index.boto3").start()
+        self.boto3.resource.return_value.Table.return_value = self.table
+        self.sns_client = self.boto3.client.return_value
+        mock.patch(
+            "index.get_collections_list_from_aws", return_value=self.collections
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def update_item(self, **request):
+        collection = request["Key"]["Collection"]["S"]
+        if request["Key"]["CorrelationId"]["S"] != LEASE_CORRELATION_ID:
+            status = request["AttributeUpdates"]["JobStatus"]["Value"]["S"]
+            self.statuses[collection] = status
+            return
+        self.lease_requests.append(request)
+        owner = request["ExpressionAttributeValues"][":owner"]["S"]
+        if request["UpdateExpression"].startswith("REMOVE"):
+            if self.leases.get(collection) == owner:
+                del self.leases[collection]
+        elif collection in self.leases:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem"
+            )
+        else:
+            self.leases[collection] = owner
+
+    def published(self):
+        return [i[1] for i in self.sns_client.publish.call_args_list]
+
+    def test_launches_leased_collections_only(self):
+        handler({}, None)
+
+        self.assertEqual(
+            self.statuses,
+            {"db:free": LAUNCHED, "db:leased": DEFERRED, "db:failed": DEFERRED},
+        )
+        # failed collections are skipped without taking their lease
+        self.assertEqual(
+            sorted(i["Key"]["Collection"]["S"] for i in self.lease_requests),
+            ["db:free", "db:leased"],
+        )
+        self.assertEqual(self.leases["db:leased"], "other")
+        alert, launch = self.published()
+        self.assertIn("2 of 3 collections skipped", alert["Message"])
+        step_args = json.loads(launch["Message"])["additional_step_args"]
+        self.assertEqual(step_args["spark-submit"][-2:], ["--collections", "db:free"])
+        self.assertIn("--lease_duration_minutes", step_args["spark-submit"])
+
+    def test_nothing_launched_when_every_collection_skipped(self):
+        self.leases["db:free"] = "other"
+
+        handler({}, None)
+
+        self.assertEqual(set(self.statuses.values()), {DEFERRED})
+        self.assertEqual(len(self.published()), 1)
+
+    def test_releases_leases_when_launch_fails(self):
+        self.sns_client.publish.side_effect = [None, RuntimeError("sns"), None]
+
+        with self.assertRaises(RuntimeError):
+            handler({}, None)
+
+        # only the collection this invocation leased is marked failed
+        self.assertEqual(
+            self.statuses,
+            {"db:free": LAMBDA_FAILED, "db:leased": DEFERRED, "db:failed": DEFERRED},
+        )
+        self.assertNotIn("db:free", self.leases)
+        self.assertEqual(self.leases["db:leased"], "other")
+        self.assertIn("Lambda Failed", self.published()[-1]["Message"])
+
+    def test_keeps_leases_once_launch_published(self):
+        def update_item(**request):
+            if request["Key"]["CorrelationId"]["S"] != LEASE_CORRELATION_ID:
+                if request["AttributeUpdates"]["JobStatus"]["Value"]["S"] == LAUNCHED:
+                    raise RuntimeError("dynamodb")
+            return self.update_item(**request)
+
+        self.table.meta.client.update_item.side_effect = update_item
+
+        with self.assertRaises(RuntimeError):
+            handler({}, None)
+
+        self.assertNotIn(LAMBDA_FAILED, self.statuses.values())
+        self.assertEqual(self.statuses["db:free"], TRIGGERED)
+        self.assertIn("db:free", self.leases)
+
+    def test_lambda_failure_does_not_block_collection(self):
+        self.table.query.return_value = {
+            "Items": [
+                {
+                    "CorrelationId": "previous",
+                    "Collection": "db:failed",
+                    "JobStatus": LAMBDA_FAILED,
+                }
+            ]
+        }
+
+        handler({}, None)
+
+        self.assertEqual(self.statuses["db:failed"], LAUNCHED)
+
+
+if __name__ == "__main__":
+    unittest.main()
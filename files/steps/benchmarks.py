@@ -0,0 +1,178 @@
+"""Micro-benchmarks for the per-record functions of the pyspark steps.
+
+Run from this directory with `python3 benchmarks.py`.  Each benchmark compares
+the current implementation with the one it replaced on representative data."""
+
+import base64
+import datetime
+import json
+import os
+import re
+import timeit
+
+from generate_dataset_from_hbase import (
+    csv_partition,
+    get_json_loads,
+    parse_hbase_shell_line,
+    parse_message,
+)
+from generate_dataset_from_adg import process_timestamp
+from test_tools import filter_rows, list_to_csv_str
+
+RECORDS = 10000
+# timestamps are parsed for every record of the historic ADG snapshot
+TIMESTAMPS = 1000000
+
+
+def make_envelope(i):
+    db_object = base64.b64encode(os.urandom(1500)).decode("ascii")
+    return json.dumps(
+        {
+            "traceId": f"trace-{i}",
+            "unitOfWorkId": f"uow-{i}",
+            "@type": "V4",
+            "message": {
+                "@type": "MONGO_UPDATE",
+                "collection": "collection",
+                "db": "db",
+                "_id": {"declarationId": f"{i:08d}-0000-0000-0000-000000000000"},
+                "_lastModifiedDateTime": "2021-03-01T10:00:00.000Z",
+                "encryption": {
+                    "encryptionCipher": "AES",
+                    "keyEncryptionKeyId": "cloudhsm:1,2",
+                    "initialisationVector": "vtA/hDISUq2BacN2iklB8g==",
+                    "encryptedEncryptionKey": f"cek-{i % 50}",
+                },
+                "dbObject": db_object,
+                "timestamp_created_from": "_lastModifiedDateTime",
+            },
+            "version": "core-4.master.9790",
+            "timestamp": "2021-03-01T10:00:00.000+0000",
+        }
+    )
+
+
+def make_shell_lines(n):
+    return [
+        f" {i:08d}-abcdef    column=cf:record, timestamp={1614592800000 + i},"
+        f" value={make_envelope(i)}"
+        for i in range(n)
+    ] + ["ROW  COLUMN+CELL", f"{n} row(s)", "Took 1.2345 seconds"]
+
+
+def legacy_parse(lines):
+    """filter_rows + re.split + full json.loads, as process_record did"""
+    output = []
+    for x in filter(filter_rows, lines):
+        y = [str.strip(i) for i in re.split(r" *column=|, *timestamp=|, *value=", x)]
+        item = json.loads(y[3])
+        output.append(
+            (
+                item["message"]["_id"],
+                y[2],
+                item["message"]["encryption"]["initialisationVector"],
+                item["message"]["encryption"]["encryptedEncryptionKey"],
+                item["message"]["encryption"]["keyEncryptionKeyId"],
+                item["message"]["dbObject"],
+            )
+        )
+    return output
+
+
+def single_pass_parse(lines, json_backend="json"):
+    loads = get_json_loads(json_backend)
+    output = []
+    for x in lines:
+        cell = parse_hbase_shell_line(x)
+        if cell is None:
+            continue
+        record_id, iv, cek, kek, db_obj = parse_message(cell[2], loads)
+        output.append((record_id, cell[1], iv, cek, kek, db_obj))
+    return output
+
+
+def report(name, seconds, baseline, records=RECORDS):
+    print(
+        f"{name:<40} {seconds:8.3f}s  {records / seconds:>12,.0f} records/s"
+        f"  {baseline / seconds:5.2f}x"
+    )
+
+
+def benchmark_record_parsing(repeat=5):
+    lines = make_shell_lines(RECORDS)
+    assert legacy_parse(lines) == single_pass_parse(lines)
+    assert legacy_parse(lines) == single_pass_parse(lines, "orjson")
+
+    print(f"record parsing, {RECORDS} shell lines")
+    baseline = min(timeit.repeat(lambda: legacy_parse(lines), number=1, repeat=repeat))
+    report("filter_rows + re.split + json.loads", baseline, baseline)
+    for backend in ["json", "orjson"]:
+        seconds = min(
+            timeit.repeat(
+                lambda: single_pass_parse(lines, backend), number=1, repeat=repeat
+            )
+        )
+        report(f"single pass ({backend})", seconds, baseline)
+
+
+def benchmark_csv_serialization(repeat=5):
+    rows = [
+        [json.dumps({"declarationId": f"{i:08d}"}), 1614592800000 + i, make_envelope(i)]
+        for i in range(RECORDS)
+    ]
+    expected = "\n".join(map(list_to_csv_str, rows))
+    assert "\n".join(csv_partition(rows)) == expected
+
+    print(f"csv serialization, {RECORDS} records")
+    baseline = min(
+        timeit.repeat(lambda: list(map(list_to_csv_str, rows)), number=1, repeat=repeat)
+    )
+    report("list_to_csv_str per record", baseline, baseline)
+    seconds = min(
+        timeit.repeat(lambda: list(csv_partition(rows)), number=1, repeat=repeat)
+    )
+    report("csv_partition", seconds, baseline)
+
+
+def strptime_timestamp(timestamp):
+    if isinstance(timestamp, dict):
+        timestamp = timestamp["d_date"]
+    return round(
+        datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ").timestamp()
+        * 1000
+    )
+
+
+def benchmark_timestamp_parsing(repeat=3):
+    start = datetime.datetime(2018, 1, 1)
+    timestamps = [
+        (start + datetime.timedelta(seconds=i * 37.123)).strftime(
+            "%Y-%m-%dT%H:%M:%S.%f"
+        )[:-3]
+        + "Z"
+        for i in range(TIMESTAMPS)
+    ]
+    timestamps[::2] = [{"d_date": i} for i in timestamps[::2]]
+    assert list(map(strptime_timestamp, timestamps)) == list(
+        map(process_timestamp, timestamps)
+    )
+
+    print(f"timestamp parsing, {TIMESTAMPS} timestamps")
+    baseline = min(
+        timeit.repeat(
+            lambda: list(map(strptime_timestamp, timestamps)), number=1, repeat=repeat
+        )
+    )
+    report("datetime.strptime", baseline, baseline, TIMESTAMPS)
+    seconds = min(
+        timeit.repeat(
+            lambda: list(map(process_timestamp, timestamps)), number=1, repeat=repeat
+        )
+    )
+    report("process_timestamp", seconds, baseline, TIMESTAMPS)
+
+
+if __name__ == "__main__":
+    benchmark_record_parsing()
+    benchmark_csv_serialization()
+    benchmark_timestamp_parsing()
@@ -5,6 +5,7 @@ import io
 import itertools
 import json
 import os.path
+import re
 from concurrent.futures import ThreadPoolExecutor
 
 from pyspark.sql import SparkSession
@@ -54,21 +55,59 @@ def get_rdds(spark, collections):
         collection.update({"rdd": spark.sparkContext.textFile(collection["s3_path"])})
 
 
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+# the zero padded form with millisecond or microsecond precision, which
+# datetime.fromisoformat reads once the trailing Z is removed
+ISO_TIMESTAMP = re.compile(
+    r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.(?:\d{3}){1,2}Z", re.ASCII
+)
+
+
+def parse_timestamp(value):
+    """Return a TIMESTAMP_FORMAT timestamp as a datetime.  The usual form is
+    parsed with fromisoformat, anything else goes through strptime, which is
+    many times slower"""
+    if ISO_TIMESTAMP.fullmatch(value):
+        return datetime.datetime.fromisoformat(value[:-1])
+    return datetime.datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
 def process_timestamp(timestamp):
     if isinstance(timestamp, dict):
-        return round(
-            datetime.datetime.strptime(
-                timestamp["d_date"], "%Y-%m-%dT%H:%M:%S.%fZ"
-            ).timestamp()
-            * 1000
-        )
+        return round(parse_timestamp(timestamp["d_date"]).timestamp() * 1000)
     elif isinstance(timestamp, str):
-        return round(
-            datetime.datetime.strptime(
-                timestamp, "%Y-%m-%dT%H:%M:%S.%fZ"
-            ).timestamp()
-            * 1000
-        )
+        return round(parse_timestamp(timestamp).timestamp() * 1000)
+
+
+def csv_partition(rows, batch_size=1000):
+    """Format a partition of rows as csv text using one writer and buffer,
+    emitting batch_size lines per element.  saveAsTextFile writes a newline
+    after each element, so the output matches writing one line per element."""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    ends = []
+    for row in rows:
+        writer.writerow(row)
+        ends.append(output.tell())
+        if len(ends) >= batch_size:
+            yield join_csv_buffer(output, ends)
+            ends = []
+    if ends:
+        yield join_csv_buffer(output, ends)
+
+
+def join_csv_buffer(output, ends):
+    """Join the lines buffered in output without their terminators, then reset
+    the buffer"""
+    value = output.getvalue()
+    output.seek(0)
+    output.truncate()
+    lines = []
+    start = 0
+    for end in ends:
+        lines.append(value[start : end - 2])
+        start = end
+    return "\n".join(lines)
 
 
 def process_rdds(collections):
@@ -93,21 +132,18 @@ def process_rdds(collections):
             timestamp = 0
         return [str(x) for x in [record_id, timestamp, x]]
 
-    def output_csv_string(x):
-        output = io.StringIO("")
-        csv.writer(output).writerow(x)
-        return output.getvalue().strip()
-
     with ThreadPoolExecutor() as executor:
         _ = list(
             executor.map(
                 process_rdd,
                 list(collections),
                 itertools.repeat(process_record),
-                itertools.repeat(output_csv_string),
             )
         )
 
+    for collection in collections:
+        collection["rdd"] = collection["rdd"].mapPartitions(csv_partition)
+
 
 def output_rdds_from_collections(collections):
     def output_rdd(collection):
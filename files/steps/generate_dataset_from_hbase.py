@@ -1,8 +1,11 @@
 #!/usr/bin/python3
+import abc
 import argparse
 import base64
 import binascii
+import hashlib
 import concurrent.futures
+import contextlib
 import csv
 import datetime
 import io
@@ -10,23 +13,33 @@ import itertools
 import json
 import logging
 import os
-import re
+import subprocess
 import sys
+import threading
 import time
 from argparse import ArgumentError
+from collections import OrderedDict
 
 import boto3
 import botocore.config
+import botocore.exceptions
 import requests
 from Crypto import Random
 from Crypto.Cipher import AES
 from Crypto.Util import Counter
 from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeSerializer
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3 import Retry
 
-from pyspark import AccumulatorParam
-from pyspark.sql import SparkSession
+from pyspark import AccumulatorParam, StorageLevel
+from pyspark.sql import DataFrame, SparkSession, Window
+from pyspark.sql import functions as F
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 DKS_ENDPOINT = "${dks_decrypt_endpoint}"
 DKS_DECRYPT_ENDPOINT = DKS_ENDPOINT + "/datakey/actions/decrypt/"
@@ -35,12 +48,38 @@ INCREMENTAL_OUTPUT_BUCKET = "${incremental_output_bucket}"
 INCREMENTAL_OUTPUT_PREFIX = "${incremental_output_prefix}"
 
 JOB_STATUS_TABLE = "${job_status_table_name}"
+RUN_HISTORY_TABLE = "${run_history_table_name}"
 COLLECTIONS_SECRET_NAME = "${collections_secret_name}"
 DATABASE_NAME = "intraday"
 
 LOG_PATH = "${log_path}"
-dks_cache = {}
+METRICS_NAMESPACE = "IntradayReplica"
+_dks_client = None
+_dks_client_lock = threading.Lock()
+
+
+# output formats and the suffix of their collection output prefix.  Columnar
+# formats are kept apart from csv output, as a table can only read one format
+OUTPUT_FORMATS = {
+    "csv": "",
+    "parquet": "_parquet",
+    "orc": "_orc",
+}
 
+# run folders are named for the job's triggered time
+RUN_FOLDER_FORMAT = "%Y%m%d-%H%M"
+# length in days of the periods run folders are compacted into
+COMPACTION_PERIODS = {"daily": 1, "weekly": 7}
+# collection tables are partitioned by run folder
+PARTITION_COLUMN = "run"
+# tables and views are commented with a hash of the DDL that created them
+DDL_COMMENT_PREFIX = "ddl:"
+# table property of the latest snapshot holding the number of id buckets it
+# was built with
+SNAPSHOT_BUCKETS_PROPERTY = "id_buckets"
+# table property of the latest snapshot set while it misses records of runs
+# registered in the table, e.g. by runs that don't maintain the snapshot
+SNAPSHOT_STALE_PROPERTY = "stale"
 
 EMRStates = {
     "TRIGGERED": "LAMBDA_TRIGGERED",  # this lambda was triggered
@@ -53,24 +92,277 @@ EMRStates = {
     "LAMBDA_FAILED": "LAMBDA_FAILED",  # lambda encountered an error
 }
 
+# the lambda will not launch emr if another job is in one of these states.  Items
+# in them are flagged with IsActive, which keys the sparse byActiveJobs index
+ACTIVE_STATES = [
+    EMRStates[state]
+    for state in [
+        "TRIGGERED",
+        "WAITING",
+        "LAUNCHED",
+        "PROCESSING",
+        "EMR_FAILED",
+    ]
+]
+# items in these states expire through the table's ExpiresAt TTL attribute
+TERMINAL_STATES = [
+    EMRStates["COMPLETED"],
+    EMRStates["DEFERRED"],
+    EMRStates["LAMBDA_FAILED"],
+]
+JOB_STATUS_RETENTION_DAYS = 90
+# CorrelationId of the items holding each collection's lease, see the cron lambda
+LEASE_CORRELATION_ID = "LEASE"
+# leases are extended by this much every LEASE_RENEWAL_SECONDS while the step
+# runs, so a lease held by a cluster that has died expires soon after
+LEASE_DURATION_MINUTES = 60
+LEASE_RENEWAL_SECONDS = 600
+# CorrelationId of the items holding the ProcessedDataEnd each collection's
+# scheduled runs start from.  These are never expired, unlike completed items
+WATERMARK_CORRELATION_ID = "WATERMARK"
+
+# exit codes of the step for the run as a whole.  A partial success still fails
+# the EMR step, so it is alerted on, but the collections that succeeded are
+# recorded as completed and are not reprocessed
+RUN_EXIT_CODES = {
+    "SUCCEEDED": 0,
+    "PARTIALLY_SUCCEEDED": 2,
+}
+
 
 def ms_epoch_now():
     return round(time.time() * 1000) - (5 * 60 * 1000)
 
 
-class DictAccumulatorParam(AccumulatorParam):
+def merge_stats(s1, s2):
+    """Merge the stats dict s2 into s1.  min_timestamp and max_timestamp keep
+    the lowest and highest value that is not None, nested dicts are merged
+    and all other values are summed."""
+    for key, value in s2.items():
+        current = s1.get(key)
+        if current is None:
+            s1[key] = value.copy() if isinstance(value, dict) else value
+        elif value is None:
+            continue
+        elif key == "min_timestamp":
+            s1[key] = min(current, value)
+        elif key == "max_timestamp":
+            s1[key] = max(current, value)
+        elif isinstance(value, dict):
+            merge_stats(current, value)
+        else:
+            s1[key] = current + value
+    return s1
+
+
+class RunStatsAccumulatorParam(AccumulatorParam):
+    """Accumulates {collection: stats} dicts, merging stats with merge_stats.
+    Tasks aggregate their stats locally and add them once per partition."""
+
     def zero(self, v):
-        return v.copy()
+        return {}
 
     def addInPlace(self, d1, d2):
-        for key, value in d2.items():
-            if not d1.get(key):
-                d1.update({key: value})
-            elif value:
-                d1.update({key: max(value, d1.get(key, value))})
+        for collection, stats in d2.items():
+            merge_stats(d1.setdefault(collection, {}), stats)
         return d1
 
 
+class CollectionRunSummary:
+    """Summary of the records processed for one collection in a run"""
+
+    def __init__(self, collection, stats=None):
+        stats = stats or {}
+        self.collection = collection
+        self.record_count = stats.get("record_count", 0)
+        self.min_timestamp = stats.get("min_timestamp")
+        self.max_timestamp = stats.get("max_timestamp")
+        self.input_bytes = stats.get("input_bytes", 0)
+        self.output_bytes = stats.get("output_bytes", 0)
+        self.decrypt_seconds = stats.get("decrypt_seconds", 0.0)
+        self.dks_stats = {"hits": 0, "misses": 0, "evictions": 0}
+        merge_stats(self.dks_stats, stats.get("dks", {}))
+
+    def dynamodb_values(self):
+        """Return the job status attributes recording this summary"""
+        return {
+            "ProcessedDataEnd": self.max_timestamp,
+            "RecordCount": self.record_count,
+            "InputBytes": self.input_bytes,
+            "OutputBytes": self.output_bytes,
+        }
+
+    def __str__(self):
+        return (
+            f"{self.collection}: {self.record_count} records"
+            f" ({self.min_timestamp} to {self.max_timestamp}),"
+            f" {self.input_bytes} bytes in, {self.output_bytes} bytes out."
+            f"  {format_dks_stats(self.dks_stats)}"
+        )
+
+
+def get_run_summaries(run_stats):
+    """Return {collection: CollectionRunSummary} from a run_stats value"""
+    return {
+        collection: CollectionRunSummary(collection, stats)
+        for collection, stats in run_stats.items()
+    }
+
+
+def get_run_history_items(
+    collections, run_summaries, correlation_id, job_type, triggered_time
+):
+    """Return a run history item for each processed collection, recording its
+    volumes and how long each stage took in milliseconds"""
+    items = []
+    for collection in collections:
+        summary = run_summaries.get(
+            collection["hbase_table"],
+            CollectionRunSummary(collection["hbase_table"]),
+        )
+        durations = collection.get("durations", {})
+        item = {
+            "Collection": collection["hbase_table"],
+            "TriggeredTime": triggered_time,
+            "CorrelationId": correlation_id,
+            "JobType": job_type,
+            "ProcessedDataStart": collection["start_time"],
+            "ProcessedDataEnd": summary.max_timestamp,
+            "RecordCount": summary.record_count,
+            "InputBytes": summary.input_bytes,
+            "OutputBytes": summary.output_bytes,
+            "PartFiles": collection.get("part_files"),
+            "DksCalls": summary.dks_stats["misses"],
+            "DecryptMs": round(summary.decrypt_seconds * 1000),
+        }
+        for stage in ["extract", "write", "tag", "ddl"]:
+            if stage in durations:
+                item[f"{stage.capitalize()}Ms"] = round(durations[stage] * 1000)
+        items.append({key: value for key, value in item.items() if value is not None})
+    return items
+
+
+def put_run_history(history_table, items):
+    with history_table.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+
+
+def get_run_history(history_table, collection, since=None):
+    """Return the collection's run history items, oldest first, optionally
+    only those triggered at or after since (ms epoch)"""
+    condition = Key("Collection").eq(collection)
+    if since is not None:
+        condition = condition & Key("TriggeredTime").gte(since)
+    query = {"KeyConditionExpression": condition, "ScanIndexForward": True}
+    items = []
+    while True:
+        results = history_table.query(**query)
+        items.extend(results["Items"])
+        if "LastEvaluatedKey" not in results:
+            return items
+        query["ExclusiveStartKey"] = results["LastEvaluatedKey"]
+
+
+def get_volume_growth(items, attribute="InputBytes", window=5):
+    """Return the ratio of the mean attribute value over the latest window of
+    run history items to the mean over the window before it, or None if there
+    are too few runs"""
+    values = [int(item[attribute]) for item in items if attribute in item]
+    if len(values) < 2 * window:
+        return None
+    previous = sum(values[-2 * window : -window])
+    latest = sum(values[-window:])
+    return latest / previous if previous else None
+
+
+def get_run_stats_accumulator(spark):
+    return spark.sparkContext.accumulator({}, RunStatsAccumulatorParam())
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as json objects, including any extra attributes"""
+
+    standard_attributes = set(
+        logging.LogRecord("", 0, "", 0, "", None, None).__dict__
+    ) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "timestamp": self.formatTime(record),
+            "log_level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.standard_attributes:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class MetricsLogger:
+    """Writes metrics to log_path as CloudWatch Embedded Metric Format json
+    lines, with the given dimensions plus the collection where there is one.
+    Nothing is written when log_path is None."""
+
+    def __init__(self, log_path=None, namespace=METRICS_NAMESPACE, dimensions=None):
+        self.log_path = log_path
+        self.namespace = namespace
+        self.dimensions = dimensions or {}
+        self._lock = threading.Lock()
+
+    def put_metrics(self, metrics, collection=None):
+        """Emit metrics, a dict of name: (value, unit)"""
+        if self.log_path is None or not metrics:
+            return
+        dimensions = dict(self.dimensions)
+        if collection is not None:
+            dimensions["Collection"] = collection
+        entry = {
+            "_aws": {
+                "Timestamp": round(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [list(dimensions)],
+                        "Metrics": [
+                            {"Name": name, "Unit": unit}
+                            for name, (_, unit) in metrics.items()
+                        ],
+                    }
+                ],
+            },
+            **dimensions,
+            **{name: value for name, (value, _) in metrics.items()},
+        }
+        line = json.dumps(entry)
+        with self._lock, open(self.log_path, "a") as sink:
+            sink.write(line + "\n")
+
+    def put_metric(self, name, value, unit="Count", collection=None):
+        self.put_metrics({name: (value, unit)}, collection)
+
+    @contextlib.contextmanager
+    def timer(self, stage, collection_info=None):
+        """Time the enclosed stage, emitting <Stage>Time in milliseconds.  For
+        a collection's stage the duration is also kept in its "durations"."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            collection = None
+            if collection_info is not None:
+                collection_info.setdefault("durations", {})[stage] = seconds
+                collection = collection_info["hbase_table"]
+            name = "".join(i.capitalize() for i in stage.split("_")) + "Time"
+            self.put_metric(name, seconds * 1000, "Milliseconds", collection)
+
+
+_metrics = MetricsLogger()
+
+
 def setup_logging(log_level, log_path):
     logger = logging.getLogger()
     for old_handler in logger.handlers:
@@ -81,17 +373,57 @@ def setup_logging(log_level, log_path):
     else:
         handler = logging.FileHandler(log_path)
 
-    json_format = (
-        "{ 'timestamp': '%(asctime)s', 'log_level': '%(levelname)s', 'message': "
-        "'%(message)s' } "
-    )
-    handler.setFormatter(logging.Formatter(json_format))
+    handler.setFormatter(JsonFormatter())
     logger.addHandler(handler)
     new_level = logging.getLevelName(log_level.upper())
     logger.setLevel(new_level)
     return logger
 
 
+def add_processing_arguments(parser):
+    """Add args controlling how collections are extracted and processed"""
+    parser.add_argument(
+        "--hbase_reader",
+        type=str,
+        choices=list(HBASE_READERS),
+        default="shell",
+    )
+    parser.add_argument("--hbase_scan_ranges", type=int, default=1)
+    parser.add_argument(
+        "--hbase_scan_split", type=str, choices=["regions", "even"], default="regions"
+    )
+    parser.add_argument("--hbase_max_concurrent_scans", type=int, default=None)
+    parser.add_argument(
+        "--engine", type=str, choices=["rdd", "dataframe"], default="rdd"
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=list(OUTPUT_FORMATS),
+        default="csv",
+    )
+    parser.add_argument(
+        "--decrypt_mode", type=str, choices=["record", "partition"], default="partition"
+    )
+    parser.add_argument("--dks_max_workers", type=int, default=10)
+    parser.add_argument("--dks_cache_size", type=int, default=10000)
+    parser.add_argument("--dks_cache_ttl", type=int, default=None)
+    parser.add_argument("--prefetch_dks_keys", action="store_true")
+    parser.add_argument("--latest_snapshot_buckets", type=int, default=0)
+    parser.add_argument("--target_file_mb", type=int, default=128)
+    parser.add_argument("--min_output_files", type=int, default=1)
+    parser.add_argument("--max_output_files", type=int, default=1000)
+    parser.add_argument(
+        "--json_backend", type=str, choices=["json", "orjson"], default="json"
+    )
+    parser.add_argument(
+        "--s3_tagging", type=str, choices=["after_run", "on_write"], default="after_run"
+    )
+    parser.add_argument("--tagging_max_workers", type=int, default=20)
+    parser.add_argument("--max_concurrent_extractions", type=int, default=4)
+    parser.add_argument("--max_concurrent_collections", type=int, default=None)
+
+
 def get_parameters():
     """Define and parse command line args."""
     parser = argparse.ArgumentParser(
@@ -100,6 +432,9 @@ def get_parameters():
     sub_p = parser.add_subparsers(dest="job_type")
     p_scheduled = sub_p.add_parser("scheduled", description="Run scheduled execution")
     p_manual = sub_p.add_parser("manual", description="Run manual execution")
+    p_compact = sub_p.add_parser(
+        "compact", description="Compact run folders for ended periods"
+    )
 
     # Scheduled
     p_scheduled.add_argument("--correlation_id", type=str, required=True)
@@ -113,6 +448,9 @@ def get_parameters():
     p_scheduled.add_argument(
         "--output_s3_prefix", type=str, default=INCREMENTAL_OUTPUT_PREFIX
     )
+    p_scheduled.add_argument(
+        "--lease_duration_minutes", type=int, default=LEASE_DURATION_MINUTES
+    )
 
     # Manual
     p_manual.add_argument("--correlation_id", type=str, required=True)
@@ -125,6 +463,37 @@ def get_parameters():
         "--output_s3_bucket", type=str, default=INCREMENTAL_OUTPUT_BUCKET
     )
     p_manual.add_argument("--output_s3_prefix", type=str, required=True)
+    p_manual.add_argument("--window_ms", type=int, default=None)
+    p_manual.add_argument("--restart_backfill", action="store_true")
+
+    for sub_parser in [p_scheduled, p_manual]:
+        add_processing_arguments(sub_parser)
+
+    # Compaction
+    p_compact.add_argument("--correlation_id", type=str, required=True)
+    p_compact.add_argument("--collections", type=str, nargs="+", required=True)
+    p_compact.add_argument("--triggered_time", type=int)
+    p_compact.add_argument("--database_name", type=str, default=DATABASE_NAME)
+    p_compact.add_argument(
+        "--output_s3_bucket", type=str, default=INCREMENTAL_OUTPUT_BUCKET
+    )
+    p_compact.add_argument(
+        "--output_s3_prefix", type=str, default=INCREMENTAL_OUTPUT_PREFIX
+    )
+    p_compact.add_argument(
+        "--output_format", type=str, choices=list(OUTPUT_FORMATS), default="csv"
+    )
+    p_compact.add_argument(
+        "--compaction_period",
+        type=str,
+        choices=list(COMPACTION_PERIODS),
+        default="daily",
+    )
+    p_compact.add_argument("--target_file_mb", type=int, default=128)
+    p_compact.add_argument("--max_output_files", type=int, default=1000)
+    p_compact.add_argument(
+        "--lease_duration_minutes", type=int, default=LEASE_DURATION_MINUTES
+    )
 
     args, unrecognized_args = parser.parse_known_args()
     return args
@@ -133,18 +502,18 @@ def get_parameters():
 def get_s3_client():
     """Return S3 client"""
     client_config = botocore.config.Config(
-        max_pool_connections=100, retries={"max_attempts": 10, "mode": "standard"}
+        max_pool_connections=100, retries={"max_attempts": 10, "mode": "adaptive"}
     )
     client = boto3.client("s3", config=client_config)
     return client
 
 
-def update_db_with_success(table, correlation_id, max_timestamps, bulk_values=None):
-    """Updates each collection with its max_timestamp, updates all collections
+def update_db_with_success(table, correlation_id, run_summaries, bulk_values=None):
+    """Updates each collection with its run summary, updates all collections
     with any bulk_values provided"""
     collection_update_values = {
-        collection: {"ProcessedDataEnd": max_timestamp}
-        for collection, max_timestamp in max_timestamps.items()
+        collection: summary.dynamodb_values()
+        for collection, summary in run_summaries.items()
     }
 
     for values_dict in collection_update_values.values():
@@ -155,9 +524,9 @@ def update_db_with_success(table, correlation_id, max_timestamps, bulk_values=No
 
 def update_db_bulk_collections(table, correlation_id, collections, values: dict):
     """Update dynamo_db with supplied values for collections provided"""
-    collections_names = [i["hbase_table"] for i in collections]
-    for collection in collections_names:
-        _update_db_collection(table, correlation_id, collection, values)
+    values_per_collection = {i["hbase_table"]: values for i in collections}
+    with _metrics.timer("dynamodb_update"):
+        update_db_items_concurrently(table, correlation_id, values_per_collection)
 
 
 def update_db_per_collection(
@@ -170,19 +539,245 @@ def update_db_per_collection(
         for collection, values in values_per_collection.items():
             values.update(bulk_values)
 
-    for collection, values in values_per_collection.items():
-        _update_db_collection(table, correlation_id, collection, values)
+    with _metrics.timer("dynamodb_update"):
+        update_db_items_concurrently(table, correlation_id, values_per_collection)
 
 
-def _update_db_collection(table, correlation_id, collection, values: dict):
-    updates = {key: {"Value": value} for key, value in values.items()}
-    table.update_item(
-        Key={
-            "CorrelationId": correlation_id,
-            "Collection": collection,
-        },
-        AttributeUpdates=updates,
-    )
+THROTTLING_ERROR_CODES = {
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "ThrottlingException",
+}
+
+
+def get_attribute_updates(values):
+    """Return AttributeUpdates putting values.  When JobStatus is set, the
+    IsActive flag is put or removed to match it, and terminal statuses are
+    given an ExpiresAt time."""
+    serializer = TypeSerializer()
+    updates = {
+        key: {"Value": serializer.serialize(value), "Action": "PUT"}
+        for key, value in values.items()
+    }
+    if "JobStatus" in values:
+        if values["JobStatus"] in ACTIVE_STATES:
+            updates["IsActive"] = {"Value": {"S": "true"}, "Action": "PUT"}
+        else:
+            updates["IsActive"] = {"Action": "DELETE"}
+        if values["JobStatus"] in TERMINAL_STATES:
+            expires_at = round(time.time()) + JOB_STATUS_RETENTION_DAYS * 86400
+            updates["ExpiresAt"] = {"Value": {"N": str(expires_at)}, "Action": "PUT"}
+    return updates
+
+
+def update_db_items_concurrently(
+    table, correlation_id, values_per_collection, max_workers=20, retries=5
+):
+    """Update each collection's item with its values, sending the updates
+    concurrently through the table's client.  Throttled updates are retried
+    with backoff, any other error is raised."""
+    client = table.meta.client
+
+    def update_item(item):
+        collection, values = item
+        request = {
+            "TableName": table.name,
+            "Key": {
+                "CorrelationId": {"S": correlation_id},
+                "Collection": {"S": collection},
+            },
+            "AttributeUpdates": get_attribute_updates(values),
+        }
+        return call_with_retries(client.update_item, retries, **request)
+
+    map_concurrently(update_item, values_per_collection.items(), max_workers)
+
+
+def call_with_retries(call, retries=5, **kwargs):
+    """Call a DynamoDB client method, retrying throttled requests with backoff"""
+    for attempt in range(retries + 1):
+        try:
+            return call(**kwargs)
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code not in THROTTLING_ERROR_CODES or attempt == retries:
+                raise
+            time.sleep(0.1 * 2**attempt)
+
+
+def map_concurrently(function, items, max_workers=20):
+    items = list(items)
+    if not items:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_workers, len(items))
+    ) as executor:
+        return list(executor.map(function, items))
+
+
+def acquire_leases(
+    table, correlation_id, collections, duration_minutes=LEASE_DURATION_MINUTES
+):
+    """Try to take the lease of each collection with a conditional write, which
+    succeeds if the lease is free or has expired.  Returns the collections
+    whose leases were acquired."""
+    client = table.meta.client
+    now = round(time.time() * 1000)
+    expires_at = now + duration_minutes * 60 * 1000
+
+    def acquire_lease(collection):
+        try:
+            call_with_retries(
+                client.update_item,
+                TableName=table.name,
+                Key={
+                    "CorrelationId": {"S": LEASE_CORRELATION_ID},
+                    "Collection": {"S": collection["hbase_table"]},
+                },
+                UpdateExpression="SET LeaseOwner = :owner,"
+                " LeaseAcquiredTime = :now, LeaseExpiresAt = :expires",
+                ConditionExpression="attribute_not_exists(LeaseOwner)"
+                " OR LeaseExpiresAt < :now",
+                ExpressionAttributeValues={
+                    ":owner": {"S": correlation_id},
+                    ":now": {"N": str(now)},
+                    ":expires": {"N": str(expires_at)},
+                },
+            )
+            return True
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code != "ConditionalCheckFailedException":
+                raise
+            return False
+
+    acquired = map_concurrently(acquire_lease, collections)
+    return [collection for collection, won in zip(collections, acquired) if won]
+
+
+def release_leases(table, correlation_id, collections):
+    """Release the collections' leases taken for this job.
+    A lease that has expired and been taken by another job is left alone."""
+    client = table.meta.client
+
+    def release_lease(collection):
+        try:
+            call_with_retries(
+                client.update_item,
+                TableName=table.name,
+                Key={
+                    "CorrelationId": {"S": LEASE_CORRELATION_ID},
+                    "Collection": {"S": collection["hbase_table"]},
+                },
+                UpdateExpression="REMOVE LeaseOwner, LeaseAcquiredTime, LeaseExpiresAt",
+                ConditionExpression="LeaseOwner = :owner",
+                ExpressionAttributeValues={":owner": {"S": correlation_id}},
+            )
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code != "ConditionalCheckFailedException":
+                raise
+
+    map_concurrently(release_lease, collections)
+
+
+def renew_leases(
+    table, correlation_id, collections, duration_minutes=LEASE_DURATION_MINUTES
+):
+    """Extend the collections' leases held by this job.  Returns the
+    collections whose leases are no longer held, having expired and been
+    taken by another job."""
+    client = table.meta.client
+    expires_at = round(time.time() * 1000) + duration_minutes * 60 * 1000
+
+    def renew_lease(collection):
+        try:
+            call_with_retries(
+                client.update_item,
+                TableName=table.name,
+                Key={
+                    "CorrelationId": {"S": LEASE_CORRELATION_ID},
+                    "Collection": {"S": collection["hbase_table"]},
+                },
+                UpdateExpression="SET LeaseExpiresAt = :expires",
+                ConditionExpression="LeaseOwner = :owner",
+                ExpressionAttributeValues={
+                    ":owner": {"S": correlation_id},
+                    ":expires": {"N": str(expires_at)},
+                },
+            )
+            return True
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code != "ConditionalCheckFailedException":
+                raise
+            return False
+
+    renewed = map_concurrently(renew_lease, collections)
+    return [collection for collection, held in zip(collections, renewed) if not held]
+
+
+@contextlib.contextmanager
+def renewing_leases(
+    table,
+    correlation_id,
+    collections,
+    duration_minutes=LEASE_DURATION_MINUTES,
+    interval_seconds=LEASE_RENEWAL_SECONDS,
+):
+    """Renew the collections' leases from a background thread every
+    interval_seconds until the block exits, so they are held for as long as
+    the job runs rather than for a fixed time.  The leases must be held on
+    entry.  A collection whose lease is taken by another job, or may have
+    expired as renewals keep failing, is marked with lease_lost, which fails
+    it at its next stage."""
+    stopped = threading.Event()
+
+    def renew():
+        renewed_at = time.monotonic()
+        while not stopped.wait(interval_seconds):
+            held = [i for i in collections if not i.get("lease_lost")]
+            try:
+                lost = renew_leases(table, correlation_id, held, duration_minutes)
+                renewed_at = time.monotonic()
+            except Exception as e:
+                _logger.error(f"Failed to renew leases", extra={"Exception": e})
+                if time.monotonic() - renewed_at + interval_seconds < (
+                    duration_minutes * 60
+                ):
+                    continue
+                # the leases may expire before the next renewal
+                lost = held
+            for collection in lost:
+                _logger.warning(
+                    f"{collection['hbase_table']}: lease lost, stopping collection"
+                )
+                collection["lease_lost"] = True
+
+    thread = threading.Thread(target=renew, name="lease-renewal", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def defer_unleased_collections(table, correlation_id, collections, duration_minutes):
+    """Renew the collections' leases before processing starts, marking the
+    collections whose lease has expired and been taken by another job (e.g.
+    while the cluster started) as DEFERRED.  Returns the collections whose
+    leases are held."""
+    lost = renew_leases(table, correlation_id, collections, duration_minutes)
+    if lost:
+        _logger.warning(
+            f"Leases lost before processing, deferring: "
+            f"{' '.join(i['hbase_table'] for i in lost)}"
+        )
+        update_db_bulk_collections(
+            table, correlation_id, lost, {"JobStatus": EMRStates["DEFERRED"]}
+        )
+    return [i for i in collections if i not in lost]
 
 
 def get_start_timestamp(collection, args, job_table=None):
@@ -198,7 +793,46 @@ def get_start_timestamp(collection, args, job_table=None):
     return start_time
 
 
+def update_watermarks(table, collections, run_summaries):
+    """Advance the watermark item of each collection to the latest record
+    processed, or for a collection without records to the end of the range it
+    started from.  A watermark is never moved back."""
+    client = table.meta.client
+
+    def update_watermark(collection):
+        summary = run_summaries.get(collection["hbase_table"])
+        end = summary.max_timestamp if summary is not None else None
+        if end is None:
+            end = collection["start_time"] - 1
+        try:
+            call_with_retries(
+                client.update_item,
+                TableName=table.name,
+                Key={
+                    "CorrelationId": {"S": WATERMARK_CORRELATION_ID},
+                    "Collection": {"S": collection["hbase_table"]},
+                },
+                UpdateExpression="SET ProcessedDataEnd = :end",
+                ConditionExpression="attribute_not_exists(ProcessedDataEnd)"
+                " OR ProcessedDataEnd < :end",
+                ExpressionAttributeValues={":end": {"N": str(end)}},
+            )
+        except botocore.exceptions.ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code != "ConditionalCheckFailedException":
+                raise
+
+    map_concurrently(update_watermark, collections)
+
+
 def get_last_processed_dynamodb(collection, job_table):
+    """Return the collection's watermark, falling back to the latest completed
+    job for collections without a watermark item"""
+    watermark = job_table.get_item(
+        Key={"CorrelationId": WATERMARK_CORRELATION_ID, "Collection": collection}
+    ).get("Item")
+    if watermark is not None:
+        return int(watermark["ProcessedDataEnd"])
     results = job_table.query(
         IndexName="byCollection",
         ProjectionExpression="ProcessedDataEnd",
@@ -224,12 +858,43 @@ def get_last_processed_dynamodb(collection, job_table):
         raise
 
 
+def get_predicted_volume(collection, job_table, runs=5):
+    """Return the mean InputBytes of the collection's last completed runs, or
+    0 if none are recorded"""
+    results = job_table.query(
+        IndexName="byCollection",
+        ProjectionExpression="InputBytes",
+        KeyConditionExpression=Key("Collection").eq(collection),
+        FilterExpression=Attr("JobStatus").eq(str(EMRStates["COMPLETED"]))
+        & Attr("InputBytes").exists(),
+        ScanIndexForward=False,
+    )
+    volumes = [int(item["InputBytes"]) for item in results["Items"][:runs]]
+    return round(sum(volumes) / len(volumes)) if volumes else 0
+
+
+def schedule_collections(collections):
+    """Order collections largest predicted volume first, so the biggest
+    collections don't start last and become the run's long tail.  The jobs of
+    all collections run in the default pool, which fairscheduler.xml shares
+    fairly between them, so small collections don't queue behind big ones."""
+    return sorted(collections, key=lambda x: x.get("predicted_volume", 0), reverse=True)
+
+
+def format_schedule(collections):
+    return "; ".join(
+        f"{i}. {collection['hbase_table']} (predicted"
+        f" {collection.get('predicted_volume', 0)} bytes)"
+        for i, collection in enumerate(collections, 1)
+    )
+
+
 def get_collections(args, job_table=None):
     """Parse collections and add required information"""
     _logger.info("Parsing collections")
     timestamp_folder = datetime.datetime.fromtimestamp(
         args.triggered_time / 1000.0
-    ).strftime("%Y%m%d-%H%M")
+    ).strftime(RUN_FOLDER_FORMAT)
 
     # Assume PII, parse table/db names for tags
     collections = [
@@ -248,9 +913,18 @@ def get_collections(args, job_table=None):
     for collection in collections:
         if args.job_type == "scheduled":
             start_time = get_start_timestamp(collection["hbase_table"], args, job_table)
-        else:
+        elif args.job_type == "manual":
             start_time = args.start_time
-        coll_prefix = os.path.join(args.output_s3_prefix, collection["hive_table"])
+        else:
+            start_time = None
+        if job_table is not None:
+            collection["predicted_volume"] = get_predicted_volume(
+                collection["hbase_table"], job_table
+            )
+        coll_prefix = os.path.join(
+            args.output_s3_prefix,
+            collection["hive_table"] + OUTPUT_FORMATS[args.output_format],
+        )
         full_prefix = os.path.join(coll_prefix, timestamp_folder)
 
         collection.update(
@@ -260,15 +934,21 @@ def get_collections(args, job_table=None):
                 "output_root_prefix": args.output_s3_prefix,
                 "collection_output_prefix": coll_prefix,
                 "full_output_prefix": full_prefix,
+                "output_format": args.output_format,
             }
         )
+        if args.job_type == "manual" and args.window_ms:
+            collection["windows"] = get_time_windows(
+                start_time, args.end_time, args.window_ms
+            )
+            collection["restart_backfill"] = args.restart_backfill
 
     if len(collections) < 1:
         raise IndexError("No collections provided")
     return collections
 
 
-def retry_requests(retries=10, backoff=0.2, methods=None):
+def retry_requests(retries=10, backoff=0.2, methods=None, pool_size=10):
     if methods is None:
         methods = ["POST"]
     retry_strategy = Retry(
@@ -277,7 +957,9 @@ def retry_requests(retries=10, backoff=0.2, methods=None):
         status_forcelist=[429, 500, 502, 503, 504],
         allowed_methods=frozenset(methods),
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    adapter = HTTPAdapter(
+        max_retries=retry_strategy, pool_connections=pool_size, pool_maxsize=pool_size
+    )
     requests_session = requests.Session()
     requests_session.mount("https://", adapter)
     return requests_session
@@ -301,18 +983,131 @@ def encrypt_plaintext(data_key, plaintext_string, iv=None):
     return ciphertext.decode("ascii"), iv.decode("ascii")
 
 
-def get_plaintext_key(url, kek, cek, dks_count_acc):
-    plaintext_key = dks_cache.get(cek)
-    if not plaintext_key:
-        dks_count_acc.add(1)
-        plaintext_key = get_key_from_dks(url, kek, cek)
-        dks_cache[cek] = plaintext_key
-    return plaintext_key
+class DksClient:
+    """Long-lived DKS client.  Reuses one keep-alive connection pool and keeps
+    plaintext data keys in an LRU cache bounded by cache_size, with entries
+    optionally expiring after ttl_seconds.  Safe to share between threads."""
+
+    def __init__(
+        self, url=DKS_DECRYPT_ENDPOINT, cache_size=10000, ttl_seconds=None, pool_size=10
+    ):
+        self.url = url
+        self.cache_size = cache_size
+        self.ttl_seconds = ttl_seconds
+        self.session = retry_requests(methods=["POST"], pool_size=pool_size)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get_cached(self, cek):
+        with self._lock:
+            entry = self._cache.get(cek)
+            if entry is None:
+                self.misses += 1
+                return None
+            plaintext_key, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._cache[cek]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._cache.move_to_end(cek)
+            self.hits += 1
+            return plaintext_key
+
+    def _put(self, cek, plaintext_key):
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+        with self._lock:
+            self._cache[cek] = (plaintext_key, expires_at)
+            self._cache.move_to_end(cek)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+
+    def get_plaintext_key(self, kek, cek):
+        """Return plaintext data key from the cache, calling DKS on a miss"""
+        plaintext_key = self._get_cached(cek)
+        if plaintext_key is None:
+            plaintext_key = get_key_from_dks(self.url, kek, cek, session=self.session)
+            self._put(cek, plaintext_key)
+        return plaintext_key
+
+    def get_plaintext_keys(self, key_pairs, max_workers=10):
+        """Return dict of cek: plaintext key for distinct (kek, cek) pairs.  Keys
+        missing from the cache are resolved concurrently, with at most
+        max_workers requests to DKS in flight."""
+        plaintext_keys = {}
+        missing = []
+        for kek, cek in set(key_pairs):
+            plaintext_key = self._get_cached(cek)
+            if plaintext_key is None:
+                missing.append((kek, cek))
+            else:
+                plaintext_keys[cek] = plaintext_key
+        if missing:
+            with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+                resolved = executor.map(
+                    lambda pair: get_key_from_dks(
+                        self.url, pair[0], pair[1], session=self.session
+                    ),
+                    missing,
+                )
+                for (_, cek), plaintext_key in zip(missing, resolved):
+                    self._put(cek, plaintext_key)
+                    plaintext_keys[cek] = plaintext_key
+        return plaintext_keys
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
 
 
-def get_key_from_dks(url, kek, cek):
+def get_dks_client(**dks_config):
+    """Return this python worker's DksClient, creating it on first use"""
+    global _dks_client
+    if _dks_client is None:
+        with _dks_client_lock:
+            if _dks_client is None:
+                _dks_client = DksClient(**dks_config)
+    return _dks_client
+
+
+def stats_delta(before, after):
+    return {key: after[key] - before[key] for key in after}
+
+
+def format_dks_stats(dks_stats):
+    lookups = dks_stats["hits"] + dks_stats["misses"]
+    hit_ratio = dks_stats["hits"] / lookups if lookups else 0
+    message = (
+        f"{dks_stats['misses']} calls to DKS, {dks_stats['hits']} key cache hits"
+        f" ({hit_ratio:.1%} hit ratio), {dks_stats['evictions']} evictions"
+    )
+    if "broadcast_keys" in dks_stats:
+        message += (
+            f", {dks_stats['broadcast_keys']} keys broadcast,"
+            f" {dks_stats.get('late_lookups', 0)} records looked up late"
+        )
+    return message
+
+
+def get_plaintext_key(kek, cek, dks_client, preloaded_keys=None):
+    if preloaded_keys is not None:
+        plaintext_key = preloaded_keys.get(cek)
+        if plaintext_key is not None:
+            return plaintext_key
+    return dks_client.get_plaintext_key(kek, cek)
+
+
+def get_key_from_dks(url, kek, cek, session=None):
     """Call DKS to return decrypted datakey."""
-    request = retry_requests(methods=["POST"])
+    request = session if session is not None else retry_requests(methods=["POST"])
 
     response = request.post(
         url,
@@ -325,9 +1120,7 @@ def get_key_from_dks(url, kek, cek):
         verify="/etc/pki/ca-trust/source/anchors/analytical_ca.pem",
     )
     content = response.json()
-    plaintext_key = content["plaintextDataKey"]
-    dks_cache[kek] = plaintext_key
-    return plaintext_key
+    return content["plaintextDataKey"]
 
 
 def decrypt_ciphertext(ciphertext, key, iv):
@@ -338,52 +1131,703 @@ def decrypt_ciphertext(ciphertext, key, iv):
     return aes.decrypt(base64.b64decode(ciphertext)).decode("utf8")
 
 
-def decrypt_message(item, dks_count_acc):
+def get_json_loads(json_backend):
+    """Return loads function for the named json backend.  orjson is faster but
+    converts integers beyond 64 bits to floats, so it is opt-in."""
+    if json_backend == "orjson":
+        if orjson is None:
+            raise ImportError("json_backend 'orjson' requires orjson to be installed")
+        return orjson.loads
+    return json.loads
+
+
+def parse_message(item, loads=json.loads):
+    """Return record ID, encryption materials and encrypted dbObject from a
+    message: (record_id, iv, cek, kek, db_obj)"""
+    message = loads(item)["message"]
+    encryption = message["encryption"]
+    return (
+        message["_id"],
+        encryption["initialisationVector"],
+        encryption["encryptedEncryptionKey"],
+        encryption["keyEncryptionKeyId"],
+        message["dbObject"],
+    )
+
+
+def get_encryption_key_pair(item, loads=json.loads):
+    """Return (kek, cek) from a message without decrypting it"""
+    _, _, cek, kek, _ = parse_message(item, loads)
+    return kek, cek
+
+
+def decrypt_message(item, dks_client, preloaded_keys=None):
     """Find and decrypt dbObject, return tuple containing record ID and decrypted
     db_object."""
-    json_item = json.loads(item)
-    record_id = json_item["message"]["_id"]
-
-    # get encryption materials
-    iv = json_item["message"]["encryption"]["initialisationVector"]
-    cek = json_item["message"]["encryption"]["encryptedEncryptionKey"]
-    kek = json_item["message"]["encryption"]["keyEncryptionKeyId"]
-    # get encrypted db_object
-    db_obj = json_item["message"]["dbObject"]
+    record_id, iv, cek, kek, db_obj = parse_message(item)
 
     # decrypt data key using cache/dks
-    plaintext_key = get_plaintext_key(
-        DKS_DECRYPT_ENDPOINT,
-        kek,
-        cek,
-        dks_count_acc,
-    )
+    plaintext_key = get_plaintext_key(kek, cek, dks_client, preloaded_keys)
 
     # decrypt object using plaintext data key
     decrypted_obj = decrypt_ciphertext(db_obj, plaintext_key, iv)
     return record_id, decrypted_obj
 
 
-def filter_rows(x):
-    if x:
-        return str(x).find("column=") > -1
-    else:
-        return False
+def decrypt_partition(
+    cells,
+    table_name,
+    accumulators,
+    dks_client,
+    dks_max_workers=10,
+    chunk_size=10000,
+    preloaded_keys=None,
+    json_backend="json",
+):
+    """Decrypt an iterator of (row_key, timestamp, value) cells.  Distinct data
+    keys in each chunk of the partition are resolved concurrently before any
+    records in the chunk are decrypted.  Keys found in preloaded_keys are used
+    without a DKS lookup, and late_lookups counts the records whose key was
+    not, as process_cell does."""
+    cells = iter(cells)
+    loads = get_json_loads(json_backend)
+    dks_stats = dks_client.stats()
+    late_lookups = 0
+    record_count = input_bytes = output_bytes = 0
+    decrypt_seconds = 0.0
+    min_timestamp = max_timestamp = None
+    while True:
+        chunk = list(itertools.islice(cells, chunk_size))
+        if not chunk:
+            break
+        start = time.perf_counter()
+        messages = []
+        for _, timestamp, value in chunk:
+            messages.append((timestamp, parse_message(value, loads)))
+            input_bytes += len(value)
+        key_pairs = {(kek, cek) for _, (_, _, cek, kek, _) in messages}
+        plaintext_keys = {}
+        if preloaded_keys is not None:
+            for kek, cek in list(key_pairs):
+                if cek in preloaded_keys:
+                    plaintext_keys[cek] = preloaded_keys[cek]
+                    key_pairs.discard((kek, cek))
+            late_lookups += sum(
+                1 for _, (_, _, cek, _, _) in messages if cek not in plaintext_keys
+            )
+        plaintext_keys.update(dks_client.get_plaintext_keys(key_pairs, dks_max_workers))
+        records = []
+        for timestamp, (record_id, iv, cek, _, db_obj) in messages:
+            record = decrypt_ciphertext(db_obj, plaintext_keys[cek], iv)
+            ts = int(timestamp)
+            if max_timestamp is None or ts > max_timestamp:
+                max_timestamp = ts
+            if min_timestamp is None or ts < min_timestamp:
+                min_timestamp = ts
+            output_bytes += len(record)
+            records.append([record_id, timestamp, record])
+        decrypt_seconds += time.perf_counter() - start
+        record_count += len(records)
+        yield from records
+    dks_stats = stats_delta(dks_stats, dks_client.stats())
+    if preloaded_keys is not None:
+        dks_stats["late_lookups"] = late_lookups
+    accumulators["run_stats"].add(
+        {
+            table_name: {
+                "record_count": record_count,
+                "min_timestamp": min_timestamp,
+                "max_timestamp": max_timestamp,
+                "input_bytes": input_bytes,
+                "output_bytes": output_bytes,
+                "decrypt_seconds": decrypt_seconds,
+                "dks": dks_stats,
+            }
+        }
+    )
+
+
+def collect_key_pairs(cells, json_backend="json"):
+    """Return distinct (kek, cek) pairs from an RDD of cells"""
+    return (
+        cells.map(lambda x: get_encryption_key_pair(x[2], get_json_loads(json_backend)))
+        .distinct()
+        .collect()
+    )
+
+
+def collect_key_pairs_dataframe(cells_df, json_backend="json"):
+    """Return distinct (kek, cek) pairs from a DataFrame of cells"""
+    key_pair = F.pandas_udf(
+        lambda *columns: key_pair_batch(columns, json_backend),
+        "array<string>",
+        F.PandasUDFType.SCALAR,
+    )
+    rows = (
+        cells_df.select(key_pair(*cells_df.columns).alias("key_pair"))
+        .where(F.col("key_pair").isNotNull())
+        .distinct()
+        .collect()
+    )
+    return [tuple(row.key_pair) for row in rows]
+
+
+def check_io_encryption(spark):
+    """Raise ValueError unless spark encrypts the blocks it writes to local
+    disk, which is required before plaintext data keys are broadcast"""
+    conf = spark.sparkContext.getConf()
+    if conf.get("spark.io.encryption.enabled", "false").lower() != "true":
+        raise ValueError(
+            "--prefetch_dks_keys requires spark.io.encryption.enabled=true"
+        )
+
+
+def prefetch_plaintext_keys(
+    spark, key_pairs, table_name, accumulators, dks_client, dks_max_workers
+):
+    """Resolve each distinct data key once on the driver and broadcast the
+    plaintext keys to the executors.  Broadcast blocks can be spilled to local
+    disk, so the plaintext keys are only broadcast when spark.io.encryption is
+    enabled."""
+    check_io_encryption(spark)
+    dks_stats = dks_client.stats()
+    plaintext_keys = dks_client.get_plaintext_keys(key_pairs, dks_max_workers)
+    dks_stats = stats_delta(dks_stats, dks_client.stats())
+    dks_stats["broadcast_keys"] = len(plaintext_keys)
+    accumulators["run_stats"].add({table_name: {"dks": dks_stats}})
+    return spark.sparkContext.broadcast(plaintext_keys)
+
+
+def get_batch_cells(columns):
+    """Return the (row_key, timestamp, value) cell of each row of a batch,
+    given as pandas series of either raw `hbase shell` output lines or cell
+    columns.  Lines that are not cells are returned as None."""
+    if len(columns) == 1:
+        return [parse_hbase_shell_line(line) for line in columns[0]]
+    return list(zip(*columns))
+
+
+def key_pair_batch(columns, json_backend="json"):
+    """Scalar pandas UDF function returning the [kek, cek] pair of each cell
+    in a batch"""
+    import pandas as pd
+
+    loads = get_json_loads(json_backend)
+    return pd.Series(
+        [
+            None if cell is None else list(get_encryption_key_pair(cell[2], loads))
+            for cell in get_batch_cells(columns)
+        ],
+        dtype=object,
+    )
+
+
+def decrypt_batch(
+    columns,
+    table_name,
+    accumulators,
+    dks_client,
+    dks_max_workers=10,
+    preloaded_keys=None,
+    json_backend="json",
+):
+    """Scalar pandas UDF function decrypting an Arrow batch of cells into
+    [id, timestamp, record] arrays, None for lines that are not cells.
+    Records are decrypted by decrypt_partition, so the output matches the RDD
+    engine."""
+    import pandas as pd
+
+    cells = get_batch_cells(columns)
+    records = iter(
+        list(
+            decrypt_partition(
+                (cell for cell in cells if cell is not None),
+                table_name,
+                accumulators,
+                dks_client,
+                dks_max_workers,
+                chunk_size=max(len(cells), 1),
+                preloaded_keys=preloaded_keys,
+                json_backend=json_backend,
+            )
+        )
+    )
+    output = []
+    for cell in cells:
+        if cell is None:
+            output.append(None)
+        else:
+            record_id, timestamp, record = next(records)
+            output.append([csv_field(record_id), timestamp, record])
+    return pd.Series(output, dtype=object)
+
+
+def csv_batch(ids, timestamps, records):
+    """Scalar pandas UDF function formatting a batch of DECRYPTED_SCHEMA
+    columns as csv lines"""
+    import pandas as pd
+
+    rows = zip(ids, timestamps, records)
+    return pd.Series(
+        [
+            line
+            for line_batch in csv_line_batches(rows, max(len(ids), 1))
+            for line in line_batch
+        ],
+        dtype=object,
+    )
+
+
+def csv_field(x):
+    """Return value as csv.writer would write it"""
+    return "" if x is None else str(x)
+
+
+def parse_hbase_shell_line(x):
+    """Split a line of `hbase shell` scan output into (row_key, timestamp,
+    value) in a single scan.  Returns None for lines that are not cells."""
+    if not x:
+        return None
+    column = x.find("column=")
+    if column < 0:
+        return None
+    timestamp = x.find("timestamp=", column + 7)
+    value = x.find("value=", timestamp + 10)
+    if timestamp < 0 or value < 0:
+        return None
+    return (
+        x[:column].strip(),
+        x[timestamp + 10 : value].strip(", "),
+        x[value + 6 :].strip(),
+    )
+
+
+def parse_hbase_shell_partition(lines):
+    """Parse an iterator of `hbase shell` scan output lines, skipping lines
+    that are not cells"""
+    for line in lines:
+        cell = parse_hbase_shell_line(line)
+        if cell is not None:
+            yield cell
+
+
+CELL_SCHEMA = "row_key string, timestamp string, value string"
+DECRYPTED_SCHEMA = "id string, record_timestamp bigint, record string"
+
+
+class HBaseReader(abc.ABC):
+    """Extracts the cells of an hbase table written within a time range.
+
+    Implementations return an RDD (or RDD-like collection) of
+    (row_key, timestamp, value) tuples for every cell with a timestamp in
+    [start_time, end_time), matching the semantics of a TIMERANGE scan.
+    A lazy reader returns cells that are only read from hbase when a Spark
+    action runs over them, rather than extracting them in read."""
 
+    lazy = False
 
-def process_record(x, table_name, accumulators):
-    y = [str.strip(i) for i in re.split(r" *column=|, *timestamp=|, *value=", x)]
-    timestamp = y[2]
-    record_id, record = decrypt_message(y[3], accumulators["dks_count"])
-    accumulators["record_count"].add(1)
-    accumulators["max_timestamps"].add({table_name: int(timestamp)})
+    @abc.abstractmethod
+    def read(self, spark, collection_info, start_time, end_time):
+        pass
+
+    def read_dataframe(self, spark, collection_info, start_time, end_time):
+        """Return the cells as a DataFrame, either with CELL_SCHEMA columns or
+        a single `line` column of `hbase shell` output"""
+        return spark.createDataFrame(
+            self.read(spark, collection_info, start_time, end_time), CELL_SCHEMA
+        )
+
+    def cleanup(self, collection_info):
+        """Remove any intermediate data kept for the collection once its
+        records have been written"""
+
+
+def get_scan_command(hbase_table_name, start_time, end_time, start_row="", stop_row=""):
+    """Return the `hbase shell` scan of a table's cells in [start_time, end_time),
+    limited to row keys in [start_row, stop_row) where these are given.  Row
+    keys are in Bytes.toStringBinary form, which ruby reads as a double quoted
+    string"""
+    options = [f"TIMERANGE => [{start_time}, {end_time}]"]
+    for option, row in [("STARTROW", start_row), ("STOPROW", stop_row)]:
+        if row:
+            row = row.replace('"', '\\"').replace("#", "\\#")
+            options.append(f'{option} => "{row}"')
+    return f"scan '{hbase_table_name}', {{{', '.join(options)}}}"
+
+
+def get_hdfs_size(path):
+    """Return the total size in bytes of the files under an HDFS path, or None
+    if it could not be measured"""
+    result = subprocess.run(
+        ["hdfs", "dfs", "-du", "-s", path], capture_output=True, text=True
+    )
+    try:
+        return int(result.stdout.split()[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def parse_split_keys(output):
+    """Return the region split keys listed by `get_splits` in `hbase shell`
+    output"""
+    split_keys = []
+    lines = iter(output.splitlines())
+    for line in lines:
+        if line.startswith("Total number of splits"):
+            break
+    for line in lines:
+        if line.startswith("=>") or line.startswith("Took "):
+            break
+        if line:
+            split_keys.append(line)
+    return split_keys
+
+
+def get_even_split_keys(ranges):
+    """Return split keys dividing the row key space evenly on its first byte"""
+    return [f"\\x{256 * i // ranges:02X}" for i in range(1, ranges)]
+
+
+def get_scan_ranges(split_keys, ranges):
+    """Group the regions delimited by split_keys into at most `ranges`
+    contiguous (start_row, stop_row) ranges covering the whole table, with ""
+    for an open end"""
+    boundaries = [""] + list(split_keys) + [""]
+    regions = len(boundaries) - 1
+    ranges = max(1, min(ranges, regions))
+    cuts = [boundaries[i * regions // ranges] for i in range(ranges + 1)]
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+class HBaseShellReader(HBaseReader):
+    """Pipes `hbase shell` scan output through HDFS and parses it in Spark.
+
+    With scan_ranges > 1 the table is scanned as that many row key ranges in
+    parallel, split on region boundaries (split_source="regions") or evenly on
+    the first byte of the row key ("even").  Each range is written to its own
+    file, named in row key order, so the lines read back are those of a single
+    scan.
+
+    Every `hbase shell` the reader starts, across all the collections it
+    extracts concurrently, takes one of max_concurrent_scans slots (scan_ranges
+    by default), so extraction slots × ranges shells never run on the master
+    at once."""
+
+    def __init__(
+        self, scan_ranges=1, split_source="regions", max_concurrent_scans=None
+    ):
+        self.scan_ranges = scan_ranges
+        self.split_source = split_source
+        self.scan_slots = threading.BoundedSemaphore(
+            max_concurrent_scans or scan_ranges
+        )
+
+    def get_split_keys(self, hbase_table_name):
+        if self.split_source == "regions":
+            result = subprocess.run(
+                ["hbase", "shell"],
+                input=f"get_splits '{hbase_table_name}'\n",
+                capture_output=True,
+                text=True,
+            )
+            split_keys = parse_split_keys(result.stdout)
+            if split_keys:
+                return split_keys
+        return get_even_split_keys(self.scan_ranges)
+
+    @staticmethod
+    def get_extract_path(collection_info):
+        return collection_info.get(
+            "extract_path", f"hdfs:///{collection_info['hive_table']}"
+        )
+
+    def extract(self, collection_info, start_time, end_time):
+        """Scan the table into HDFS, return the HDFS path.  The size of the
+        extract is kept as collection_info["extracted_bytes"]."""
+        path = self.scan(collection_info, start_time, end_time)
+        collection_info["extracted_bytes"] = get_hdfs_size(path)
+        return path
+
+    def scan(self, collection_info, start_time, end_time):
+        if self.scan_ranges > 1:
+            return self.extract_ranges(collection_info, start_time, end_time)
+        hbase_table_name = collection_info["hbase_table"]
+        path = self.get_extract_path(collection_info)
+        scan_command = (
+            f"scan '{hbase_table_name}', {{TIMERANGE => [{start_time}, {end_time}]}}"
+        )
+        with self.scan_slots:
+            os.system(
+                f'echo -e "{scan_command}" '
+                f"| hbase shell  "
+                f"| hdfs dfs -put -f - {path}"
+            )
+        return path
+
+    def extract_ranges(self, collection_info, start_time, end_time):
+        """Scan the table into an HDFS directory holding a file per row key
+        range, return the HDFS path"""
+        hbase_table_name = collection_info["hbase_table"]
+        path = self.get_extract_path(collection_info)
+        scan_ranges = get_scan_ranges(
+            self.get_split_keys(hbase_table_name), self.scan_ranges
+        )
+        collection_info["scan_ranges"] = len(scan_ranges)
+        os.system(f"hdfs dfs -rm -r -f -skipTrash {path}")
+        os.system(f"hdfs dfs -mkdir -p {path}")
+
+        def extract_range(item):
+            i, (start_row, stop_row) = item
+            with self.scan_slots:
+                subprocess.run(
+                    f"hbase shell | hdfs dfs -put -f - {path}/range-{i:05d}",
+                    shell=True,
+                    input=get_scan_command(
+                        hbase_table_name, start_time, end_time, start_row, stop_row
+                    )
+                    + "\n",
+                    text=True,
+                    check=True,
+                )
+
+        map_concurrently(extract_range, enumerate(scan_ranges), len(scan_ranges))
+        return path
+
+    def cleanup(self, collection_info):
+        os.system(
+            f"hdfs dfs -rm -r -f -skipTrash {self.get_extract_path(collection_info)}"
+        )
+
+    def read(self, spark, collection_info, start_time, end_time):
+        path = self.extract(collection_info, start_time, end_time)
+        lines = spark.sparkContext.textFile(path)
+        return lines.mapPartitions(parse_hbase_shell_partition)
+
+    def read_dataframe(self, spark, collection_info, start_time, end_time):
+        path = self.extract(collection_info, start_time, end_time)
+        return spark.read.text(path).withColumnRenamed("value", "line")
+
+
+HBASE_READERS = {
+    "shell": HBaseShellReader,
+}
+
+
+def get_processing_options(args):
+    """Return keyword args for process_collection from the command line args"""
+    return {
+        "hbase_reader": get_hbase_reader(args),
+        "engine": args.engine,
+        "decrypt_mode": args.decrypt_mode,
+        "dks_max_workers": args.dks_max_workers,
+        "prefetch_dks_keys": args.prefetch_dks_keys,
+        "json_backend": args.json_backend,
+        "s3_tagging": args.s3_tagging,
+        "tagging_max_workers": args.tagging_max_workers,
+        "max_concurrent_extractions": args.max_concurrent_extractions,
+        "max_concurrent_collections": args.max_concurrent_collections,
+        "latest_snapshot_buckets": args.latest_snapshot_buckets,
+        "target_file_mb": args.target_file_mb,
+        "min_output_files": args.min_output_files,
+        "max_output_files": args.max_output_files,
+        "dks_config": {
+            "cache_size": args.dks_cache_size,
+            "ttl_seconds": args.dks_cache_ttl,
+            "pool_size": args.dks_max_workers,
+        },
+    }
+
+
+def get_hbase_reader(args):
+    """Return the HBaseReader selected by the command line args"""
+    if args.hbase_reader == "shell":
+        return HBaseShellReader(
+            scan_ranges=args.hbase_scan_ranges,
+            split_source=args.hbase_scan_split,
+            max_concurrent_scans=args.hbase_max_concurrent_scans,
+        )
+    return HBASE_READERS[args.hbase_reader]()
+
+
+def process_cell(cell, table_name, accumulators, dks_client, preloaded_keys=None):
+    """Decrypt a (row_key, timestamp, value) cell, return list containing
+    record ID, timestamp and decrypted record"""
+    _, timestamp, value = cell
+    dks_stats = dks_client.stats()
+    start = time.perf_counter()
+    record_id, record = decrypt_message(value, dks_client, preloaded_keys)
+    decrypt_seconds = time.perf_counter() - start
+    dks_stats = stats_delta(dks_stats, dks_client.stats())
+    if preloaded_keys is not None:
+        # a single key is looked up, unless the record's key was broadcast
+        dks_stats["late_lookups"] = dks_stats["hits"] + dks_stats["misses"]
+    accumulators["run_stats"].add(
+        {
+            table_name: {
+                "record_count": 1,
+                "min_timestamp": int(timestamp),
+                "max_timestamp": int(timestamp),
+                "input_bytes": len(value),
+                "output_bytes": len(record),
+                "decrypt_seconds": decrypt_seconds,
+                "dks": dks_stats,
+            }
+        }
+    )
     return [record_id, timestamp, record]
 
 
-def list_to_csv_str(x):
-    output = io.StringIO("")
-    csv.writer(output).writerow(x)
-    return output.getvalue().strip()
+def csv_line_batches(rows, batch_size=1000):
+    """Format rows as csv lines using one writer and buffer, yielding lists of
+    up to batch_size lines.  Only the line terminator is removed from each
+    line, so whitespace at either end of a row is preserved."""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    ends = []
+    for row in rows:
+        writer.writerow(row)
+        ends.append(output.tell())
+        if len(ends) >= batch_size:
+            yield split_csv_buffer(output, ends)
+            ends = []
+    if ends:
+        yield split_csv_buffer(output, ends)
+
+
+def split_csv_buffer(output, ends):
+    """Split the csv.writer output buffered in output at the given row end
+    offsets, then reset the buffer"""
+    value = output.getvalue()
+    output.seek(0)
+    output.truncate()
+    lines = []
+    start = 0
+    for end in ends:
+        lines.append(value[start : end - 2])
+        start = end
+    return lines
+
+
+def csv_partition(rows, batch_size=1000):
+    """Format a partition of rows as csv text, emitting batch_size lines per
+    element.  saveAsTextFile writes a newline after each element, so the
+    output is the same as writing one line per element."""
+    for lines in csv_line_batches(rows, batch_size):
+        yield "\n".join(lines)
+
+
+def decrypt_cells(
+    cells,
+    table_name,
+    accumulators,
+    decrypt_mode="partition",
+    dks_max_workers=10,
+    dks_config=None,
+    broadcast_keys=None,
+    json_backend="json",
+):
+    """Return RDD of [record_id, timestamp, record] from an RDD of cells"""
+    dks_config = dks_config or {}
+    if decrypt_mode == "partition":
+        return cells.mapPartitions(
+            lambda x: decrypt_partition(
+                x,
+                table_name,
+                accumulators,
+                get_dks_client(**dks_config),
+                dks_max_workers,
+                preloaded_keys=broadcast_keys.value if broadcast_keys else None,
+                json_backend=json_backend,
+            )
+        )
+    return cells.map(
+        lambda x: process_cell(
+            x,
+            table_name,
+            accumulators,
+            get_dks_client(**dks_config),
+            broadcast_keys.value if broadcast_keys else None,
+        )
+    )
+
+
+def decrypt_cells_dataframe(
+    cells_df,
+    table_name,
+    accumulators,
+    dks_max_workers=10,
+    dks_config=None,
+    broadcast_keys=None,
+    json_backend="json",
+):
+    """Return DECRYPTED_SCHEMA DataFrame from a DataFrame of cells, decrypting
+    Arrow batches with a scalar pandas UDF.  The UDF has side effects (DKS
+    calls and run stats), so it is marked nondeterministic to be evaluated
+    once per row."""
+    dks_config = dks_config or {}
+    decrypt = F.pandas_udf(
+        lambda *columns: decrypt_batch(
+            columns,
+            table_name,
+            accumulators,
+            get_dks_client(**dks_config),
+            dks_max_workers,
+            preloaded_keys=broadcast_keys.value if broadcast_keys else None,
+            json_backend=json_backend,
+        ),
+        "array<string>",
+        F.PandasUDFType.SCALAR,
+    ).asNondeterministic()
+    cells = cells_df.select(decrypt(*cells_df.columns).alias("cell"))
+    return cells.where(F.col("cell").isNotNull()).select(
+        F.col("cell")[0].alias("id"),
+        F.col("cell")[1].cast("bigint").alias("record_timestamp"),
+        F.col("cell")[2].alias("record"),
+    )
+
+
+def records_to_dataframe(spark, records):
+    """Return DECRYPTED_SCHEMA DataFrame from an RDD of
+    [record_id, timestamp, record]"""
+    return spark.createDataFrame(
+        records.map(lambda x: (csv_field(x[0]), int(x[1]), x[2])), DECRYPTED_SCHEMA
+    )
+
+
+def save_records(spark, records, output_path, output_format="csv"):
+    """Write decrypted records, either an RDD of [record_id, timestamp, record]
+    or a DECRYPTED_SCHEMA DataFrame, in the given output format"""
+    is_dataframe = isinstance(records, DataFrame)
+    if output_format == "csv":
+        if is_dataframe:
+            to_csv = F.pandas_udf(csv_batch, "string", F.PandasUDFType.SCALAR)
+            records.select(to_csv("id", "record_timestamp", "record")).write.text(
+                output_path, compression="com.hadoop.compression.lzo.LzopCodec"
+            )
+        else:
+            records.mapPartitions(csv_partition).saveAsTextFile(
+                output_path,
+                compressionCodecClass="com.hadoop.compression.lzo.LzopCodec",
+            )
+    else:
+        if not is_dataframe:
+            records = records_to_dataframe(spark, records)
+        records.write.format(output_format).save(output_path)
+
+
+def get_output_partitions(
+    input_bytes, target_file_mb=128, min_output_files=1, max_output_files=1000
+):
+    """Return the number of partitions, and so output files, to write for a
+    collection of input_bytes, aiming for files of target_file_mb"""
+    partitions = -(-input_bytes // (target_file_mb * 1024 * 1024))
+    return max(min_output_files, min(partitions, max_output_files))
+
+
+def get_num_partitions(data):
+    """Return the number of partitions of an RDD or DataFrame"""
+    rdd = data.rdd if isinstance(data, DataFrame) else data
+    return rdd.getNumPartitions()
 
 
 def process_collection(
@@ -391,59 +1835,306 @@ def process_collection(
     spark,
     end_time,
     accumulators,
+    hbase_reader=None,
+    engine="rdd",
+    decrypt_mode="partition",
+    dks_max_workers=10,
+    dks_config=None,
+    prefetch_dks_keys=False,
+    json_backend="json",
+    latest_snapshot_buckets=0,
+    s3_tagging="after_run",
+    tagging_max_workers=20,
+    s3_client=None,
+    extraction_slots=None,
+    target_file_mb=128,
+    min_output_files=1,
+    max_output_files=1000,
 ):
-    """Extract collection from hbase, decrypt, put in S3."""
+    """Extract collection from hbase, decrypt, put in S3.  When
+    latest_snapshot_buckets is set, the decrypted records are kept as
+    collection_info["latest_delta"] for update_latest_snapshot.  When
+    s3_tagging is on_write, the output is tagged as soon as it is saved rather
+    than in a stage after all collections are processed.  extraction_slots is
+    a semaphore limiting concurrent reads from hbase.  It is held until the
+    reader has extracted the cells, or for a lazy reader, which only reads
+    hbase as the records are written, until they have been written.
+
+    The output is written as files of roughly target_file_mb, sized from the
+    extracted input (or the collection's predicted volume where the reader
+    can't measure it), between min_output_files and max_output_files.  Cells
+    are spread over more partitions before they are decrypted, but records
+    are only brought down to fewer after decryption, so the decryption and its
+    DKS calls keep the parallelism of the input."""
     _logger.info(f"{collection_info['hbase_table']}: Processing collection")
     hbase_table_name = collection_info["hbase_table"]
-    hive_table_name = collection_info["hive_table"]
     start_time = collection_info["start_time"]
-
-    accumulators["max_timestamps"].add({hbase_table_name: None})
-    _logger.info(f"{hbase_table_name}: refreshing hfiles")
-    scan_command = (
-        f"scan '{hbase_table_name}', {{TIMERANGE => [{start_time}, {end_time}]}}"
-    )
-    _logger.info(f"{hbase_table_name}: extracting data")
-    os.system(
-        f'echo -e "{scan_command}" '
-        f"| hbase shell  "
-        f"| hdfs dfs -put -f - hdfs:///{hive_table_name}"
-    )
-    _logger.info(f"{hbase_table_name}: processing data")
-    rdd = (
-        spark.sparkContext.textFile(f"hdfs:///{hive_table_name}")
-        .filter(filter_rows)
-        .map(lambda x: process_record(x, hbase_table_name, accumulators))
-        .map(list_to_csv_str)
-    )
-    rdd.saveAsTextFile(
-        "s3://"
-        + os.path.join(
-            collection_info["output_bucket"],
-            collection_info["full_output_prefix"],
-        ),
-        compressionCodecClass="com.hadoop.compression.lzo.LzopCodec",
+    if hbase_reader is None:
+        hbase_reader = HBaseShellReader()
+    dks_config = dks_config or {}
+    output_path = "s3://" + os.path.join(
+        collection_info["output_bucket"],
+        collection_info["full_output_prefix"],
     )
+
+    accumulators["run_stats"].add({hbase_table_name: {"record_count": 0}})
+    with contextlib.ExitStack() as extraction:
+        extraction.enter_context(extraction_slots or contextlib.nullcontext())
+        with _metrics.timer("extract", collection_info):
+            _logger.info(f"{hbase_table_name}: extracting data")
+            if engine == "dataframe":
+                cells = hbase_reader.read_dataframe(
+                    spark, collection_info, start_time, end_time
+                )
+            else:
+                cells = hbase_reader.read(spark, collection_info, start_time, end_time)
+
+        if not hbase_reader.lazy:
+            # the cells have been extracted, free the slot for another collection
+            extraction.close()
+
+        input_bytes = collection_info.get(
+            "extracted_bytes", collection_info.get("predicted_volume")
+        )
+        partitions = None
+        if input_bytes is not None and target_file_mb:
+            partitions = get_output_partitions(
+                input_bytes, target_file_mb, min_output_files, max_output_files
+            )
+            _logger.info(
+                f"{hbase_table_name}: writing {partitions} files for {input_bytes} bytes"
+            )
+            if partitions > get_num_partitions(cells):
+                cells = cells.repartition(partitions)
+
+        broadcast_keys = None
+        if prefetch_dks_keys:
+            _logger.info(f"{hbase_table_name}: prefetching data keys")
+            cells = cells.persist(StorageLevel.MEMORY_AND_DISK)
+            if engine == "dataframe":
+                key_pairs = collect_key_pairs_dataframe(cells, json_backend)
+            else:
+                key_pairs = collect_key_pairs(cells, json_backend)
+            broadcast_keys = prefetch_plaintext_keys(
+                spark,
+                key_pairs,
+                hbase_table_name,
+                accumulators,
+                get_dks_client(**dks_config),
+                dks_max_workers,
+            )
+
+        _logger.info(f"{hbase_table_name}: processing data")
+        if engine == "dataframe":
+            records = decrypt_cells_dataframe(
+                cells,
+                hbase_table_name,
+                accumulators,
+                dks_max_workers,
+                dks_config,
+                broadcast_keys,
+                json_backend,
+            )
+        else:
+            records = decrypt_cells(
+                cells,
+                hbase_table_name,
+                accumulators,
+                decrypt_mode,
+                dks_max_workers,
+                dks_config,
+                broadcast_keys,
+                json_backend,
+            )
+        if partitions is not None and partitions < get_num_partitions(cells):
+            # shuffle rather than coalesce, which would merge the partitions
+            # before they are decrypted
+            records = records.repartition(partitions)
+        if latest_snapshot_buckets:
+            records = records.persist(StorageLevel.MEMORY_AND_DISK)
+        with _metrics.timer("write", collection_info):
+            save_records(
+                spark, records, output_path, collection_info.get("output_format", "csv")
+            )
     _logger.info(f"{hbase_table_name}: Saved to S3")
+    if s3_tagging == "on_write":
+        tag_s3_objects(s3_client, collection_info, tagging_max_workers)
+        collection_info["tagged"] = True
+    if latest_snapshot_buckets:
+        if not isinstance(records, DataFrame):
+            records = records_to_dataframe(spark, records)
+        collection_info.update(
+            {
+                "latest_delta": records,
+                "latest_snapshot_buckets": latest_snapshot_buckets,
+            }
+        )
+    if prefetch_dks_keys:
+        cells.unpersist()
+        broadcast_keys.unpersist()
     return collection_info
 
 
-def create_hive_table(spark, database_name, collection):
-    """Create hive table + 'latest' view over data in s3"""
-    hive_table = collection["hive_table"]
-    s3_path = "s3://" + os.path.join(
-        collection["output_bucket"],
-        collection["collection_output_prefix"],
+def get_time_windows(start_time, end_time, window_ms):
+    """Split [start_time, end_time) into consecutive windows of window_ms"""
+    return [
+        (window_start, min(window_start + window_ms, end_time))
+        for window_start in range(start_time, end_time, window_ms)
+    ]
+
+
+def get_remaining_windows(windows, completed):
+    """Return the parts of windows not covered by the completed windows.  A
+    rerun's windows need not match the checkpointed ones, e.g. its end_time
+    defaults to a later now, and only the time not yet processed is kept."""
+    remaining = []
+    for start_time, end_time in windows:
+        for done_start, done_end in sorted(completed):
+            if done_end <= start_time or done_start >= end_time:
+                continue
+            if done_start > start_time:
+                remaining.append((start_time, done_start))
+            start_time = max(start_time, done_end)
+            if start_time >= end_time:
+                break
+        if start_time < end_time:
+            remaining.append((start_time, end_time))
+    return remaining
+
+
+@contextlib.contextmanager
+def hold_all(*slots):
+    """Hold each of the given locks/semaphores, acquired in order"""
+    with contextlib.ExitStack() as stack:
+        for slot in slots:
+            if slot is not None:
+                stack.enter_context(slot)
+        yield
+
+
+def get_checkpoint_key(collection):
+    return os.path.join(
+        collection["collection_output_prefix"], "_backfill_checkpoint.json"
+    )
+
+
+def read_checkpoint(s3_client, collection):
+    """Return the set of windows recorded as complete for the collection"""
+    checkpoint = read_s3_json(
+        s3_client, collection["output_bucket"], get_checkpoint_key(collection)
     )
+    if checkpoint is None:
+        return set()
+    return {tuple(window) for window in checkpoint["completed_windows"]}
 
-    # sql to ensure db exists
-    create_db = f"create database if not exists {database_name}"
 
-    # sql for creating table over s3 data
-    drop_table = f"drop table if exists {database_name}.{hive_table}"
-    create_table = f"""
+def write_checkpoint(s3_client, collection, completed_windows):
+    s3_client.put_object(
+        Bucket=collection["output_bucket"],
+        Key=get_checkpoint_key(collection),
+        Body=json.dumps({"completed_windows": sorted(completed_windows)}),
+    )
+
+
+def delete_checkpoint(s3_client, collection):
+    delete_s3_keys(
+        s3_client, collection["output_bucket"], [get_checkpoint_key(collection)]
+    )
+
+
+def process_windows(collection_info, s3_client, extraction_slots=None, **kwargs):
+    """Process a collection as the time windows in collection_info["windows"],
+    each written to its own folder.  A window is extracted while the previous
+    one is decrypted and written.  Completed windows are recorded in a
+    checkpoint in S3 and the time they cover is skipped when the run is
+    repeated, so a failed backfill resumes from where it stopped without
+    processing any record twice.  The checkpoint is ignored and replaced when
+    collection_info["restart_backfill"] is set, and main deletes it once the
+    backfill's windows are registered.
+
+    Windows are tagged as they are written, as a checkpointed window must be
+    complete.  The latest snapshot is not maintained for windowed runs, and is
+    rebuilt by the next run that maintains it."""
+    hbase_table_name = collection_info["hbase_table"]
+    hbase_reader = kwargs.setdefault("hbase_reader", HBaseShellReader())
+    kwargs.update(s3_tagging="on_write", latest_snapshot_buckets=0)
+    kwargs.pop("end_time", None)
+    if collection_info.get("restart_backfill"):
+        delete_checkpoint(s3_client, collection_info)
+        completed = set()
+    else:
+        completed = read_checkpoint(s3_client, collection_info)
+    windows = get_remaining_windows(collection_info["windows"], completed)
+    _logger.info(
+        f"{hbase_table_name}: processing {len(windows)} windows, "
+        f"{len(completed)} already completed"
+    )
+    window_extraction = threading.Lock()
+    checkpoint_lock = threading.Lock()
+
+    def process_window(window):
+        check_lease(collection_info)
+        start_time, end_time = window
+        window_info = dict(
+            collection_info,
+            start_time=start_time,
+            full_output_prefix=os.path.join(
+                collection_info["collection_output_prefix"],
+                f"window-{start_time}-{end_time}",
+            ),
+            extract_path=f"hdfs:///{collection_info['hive_table']}-{start_time}",
+            durations={},
+        )
+        # clear output left by a failed attempt at this window
+        delete_s3_prefix(
+            s3_client,
+            window_info["output_bucket"],
+            window_info["full_output_prefix"] + "/",
+        )
+        process_collection(
+            window_info,
+            end_time=end_time,
+            s3_client=s3_client,
+            extraction_slots=hold_all(window_extraction, extraction_slots),
+            **kwargs,
+        )
+        hbase_reader.cleanup(window_info)
+        with checkpoint_lock:
+            completed.add(window)
+            write_checkpoint(s3_client, collection_info, completed)
+        _logger.info(f"{hbase_table_name}: completed window {start_time}-{end_time}")
+        return window_info
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        window_infos = list(executor.map(process_window, windows))
+
+    durations = collection_info.setdefault("durations", {})
+    for window_info in window_infos:
+        for stage, seconds in window_info["durations"].items():
+            durations[stage] = durations.get(stage, 0) + seconds
+    collection_info["part_files"] = sum(i.get("part_files", 0) for i in window_infos)
+    # register every checkpointed window, including those written by earlier
+    # attempts of a resumed backfill
+    collection_info["run_folders"] = [
+        f"window-{start_time}-{end_time}" for start_time, end_time in sorted(completed)
+    ]
+    collection_info["tagged"] = True
+    return collection_info
+
+
+def get_comment_clause(comment):
+    return f" comment '{comment}'" if comment else ""
+
+
+def get_create_table_sql(
+    database_name, hive_table, s3_path, output_format="csv", comment=None
+):
+    """Return external table DDL for data written in output_format"""
+    if output_format == "csv":
+        return f"""
     create external table if not exists {database_name}.{hive_table}
-        (id string, record_timestamp string, record string)
+        (id string, record_timestamp string, record string){get_comment_clause(comment)}
+        partitioned by ({PARTITION_COLUMN} string)
         ROW FORMAT SERDE 'org.apache.hadoop.hive.serde2.OpenCSVSerde'
            WITH SERDEPROPERTIES ( 
            "separatorChar" = ",",
@@ -451,10 +2142,33 @@ def create_hive_table(spark, database_name, collection):
                   )
         stored as textfile location "{s3_path}"
     """
+    return f"""
+    create external table if not exists {database_name}.{hive_table}
+        (id string, record_timestamp bigint, record string){get_comment_clause(comment)}
+        partitioned by ({PARTITION_COLUMN} string)
+        stored as {output_format} location "{s3_path}"
+    """
 
-    drop_view = f"drop view if exists {database_name}.v_{hive_table}_latest"
-    create_view = f"""
-        create view {database_name}.v_{hive_table}_latest as with ranked as (
+
+def get_create_latest_view_sql(
+    database_name, hive_table, snapshot=False, output_format="csv", comment=None
+):
+    """Return DDL for the view of the latest version of each record, read from
+    the latest snapshot table when one is maintained"""
+    view = f"{database_name}.v_{hive_table}_latest{get_comment_clause(comment)}"
+    if snapshot:
+        record_timestamp = (
+            "cast(record_timestamp as string) record_timestamp"
+            if output_format == "csv"
+            else "record_timestamp"
+        )
+        return f"""
+        create or replace view {view} as
+        select id, {record_timestamp}, record
+        from {database_name}.{hive_table}_latest
+        """
+    return f"""
+        create or replace view {view} as with ranked as (
         select  id,
                 record_timestamp,
                 record, 
@@ -466,33 +2180,540 @@ def create_hive_table(spark, database_name, collection):
         select id, record_timestamp, record from ranked where RANK = 1
         """
 
-    spark.sql(create_db)
+
+def get_latest_records(records):
+    """Return the latest version of each record in a DataFrame"""
+    ranked = records.withColumn(
+        "rank",
+        F.row_number().over(
+            Window.partitionBy("id").orderBy(F.col("record_timestamp").desc())
+        ),
+    )
+    return ranked.where(F.col("rank") == 1).drop("rank")
+
+
+def get_snapshot_partition_sql(snapshot_table, partition_locations, existing):
+    """Return statements pointing each id_bucket partition at its new location,
+    adding the partitions that don't exist yet in a single statement"""
+    new_partitions = [
+        f"partition (id_bucket={bucket}) location '{location}'"
+        for bucket, location in sorted(partition_locations.items())
+        if bucket not in existing
+    ]
+    statements = []
+    if new_partitions:
+        statements.append(
+            f"alter table {snapshot_table} add if not exists "
+            + " ".join(new_partitions)
+        )
+    statements.extend(
+        f"alter table {snapshot_table} partition (id_bucket={bucket})"
+        f" set location '{location}'"
+        for bucket, location in sorted(partition_locations.items())
+        if bucket in existing
+    )
+    return statements
+
+
+def get_table_properties(spark, table):
+    """Return the TBLPROPERTIES of an existing table"""
+    return {
+        row[0]: row[1] for row in spark.sql(f"show tblproperties {table}").collect()
+    }
+
+
+def get_set_stale_sql(snapshot_table, stale):
+    return (
+        f"alter table {snapshot_table} set tblproperties"
+        f" ('{SNAPSHOT_STALE_PROPERTY}'='{str(stale).lower()}')"
+    )
+
+
+def get_snapshot_buckets(spark, database_name, snapshot_table):
+    """Return the id_bucket partitions of an existing snapshot table"""
+    return {
+        int(row[0].split("=")[1])
+        for row in spark.sql(
+            f"show partitions {database_name}.{snapshot_table}"
+        ).collect()
+    }
+
+
+def get_superseded_snapshot_keys(objects, snapshot_prefix, run_folder, buckets=None):
+    """Return the keys of snapshot objects in the given buckets' folders (or
+    every bucket's) of runs other than run_folder, once those partitions point
+    at run_folder"""
+    keys = []
+    for obj in objects:
+        folders = os.path.relpath(obj["Key"], snapshot_prefix).split("/")
+        if (
+            len(folders) > 2
+            and folders[0] != run_folder
+            and folders[1].startswith("id_bucket=")
+            and (buckets is None or int(folders[1].split("=")[1]) in buckets)
+        ):
+            keys.append(obj["Key"])
+    return keys
+
+
+def update_latest_snapshot(spark, database_name, collection, s3_client, properties):
+    """Merge this run's records into {hive_table}_latest, a parquet table
+    holding the latest version of each record, partitioned by a hash bucket
+    of the id.  Only the buckets containing ids from this run are rewritten,
+    each to a new location under the run folder, and then switched to it,
+    after which the folders they were switched from are deleted.
+
+    properties are the snapshot's table properties from before this run's
+    partitions were registered, None if there is no snapshot table.  The
+    number of buckets is kept in them, as an id must always hash to the same
+    bucket, along with whether the snapshot is stale.  Until the table has
+    partitions, when it was built with a different number of buckets, or
+    when it is stale, it is rebuilt from the collection's full history, so a
+    first build or merge that fails is retried by the next run.  A rebuild
+    replaces the table once the records are written."""
+    hive_table = collection["hive_table"]
+    snapshot_table = f"{database_name}.{hive_table}_latest"
+    buckets = collection["latest_snapshot_buckets"]
+    output_bucket = collection["output_bucket"]
+    run_folder = os.path.basename(collection["full_output_prefix"])
+    snapshot_prefix = collection["collection_output_prefix"] + "_latest"
+    snapshot_path = "s3://" + os.path.join(output_bucket, snapshot_prefix)
+    run_path = os.path.join(snapshot_path, run_folder)
+
+    def with_bucket(df):
+        return df.select(
+            "id",
+            F.col("record_timestamp").cast("bigint").alias("record_timestamp"),
+            "record",
+            F.expr(f"pmod(hash(id), {buckets})").alias("id_bucket"),
+        )
+
+    delta = with_bucket(collection["latest_delta"])
+    existing = (
+        set()
+        if properties is None
+        else get_snapshot_buckets(spark, database_name, f"{hive_table}_latest")
+    )
+    rebuild = (
+        not existing
+        or properties.get(SNAPSHOT_BUCKETS_PROPERTY) != str(buckets)
+        or properties.get(SNAPSHOT_STALE_PROPERTY) == "true"
+    )
+    if not rebuild:
+        affected = [
+            row.id_bucket for row in delta.select("id_bucket").distinct().collect()
+        ]
+        if not affected:
+            _logger.info(f"{hive_table}: no new records for latest snapshot")
+            spark.sql(get_set_stale_sql(snapshot_table, False))
+            return
+        previous = spark.table(snapshot_table).where(F.col("id_bucket").isin(affected))
+        merged = get_latest_records(previous.unionByName(delta))
+    else:
+        _logger.info(
+            f"{hive_table}: building latest snapshot of {buckets} buckets"
+            f" from full history"
+        )
+        merged = get_latest_records(
+            with_bucket(spark.table(f"{database_name}.{hive_table}"))
+        )
+
+    merged.write.mode("overwrite").partitionBy("id_bucket").parquet(run_path)
+    if rebuild:
+        spark.sql(f"drop table if exists {snapshot_table}")
+        spark.sql(f"""
+            create external table {snapshot_table}
+                (id string, record_timestamp bigint, record string)
+                partitioned by (id_bucket int)
+                stored as parquet location "{snapshot_path}"
+                tblproperties (
+                    '{SNAPSHOT_BUCKETS_PROPERTY}'='{buckets}',
+                    '{SNAPSHOT_STALE_PROPERTY}'='false'
+                )
+            """)
+        existing = set()
+    written = {
+        int(folder.split("=")[1])
+        for folder in list_folders(
+            s3_client, output_bucket, os.path.join(snapshot_prefix, run_folder)
+        )
+        if folder.startswith("id_bucket=")
+    }
+    for statement in get_snapshot_partition_sql(
+        snapshot_table,
+        {bucket: f"{run_path}/id_bucket={bucket}" for bucket in written},
+        existing,
+    ):
+        spark.sql(statement)
+    if not rebuild:
+        spark.sql(get_set_stale_sql(snapshot_table, False))
+    superseded = get_superseded_snapshot_keys(
+        list_objects(s3_client, output_bucket, snapshot_prefix + "/"),
+        snapshot_prefix,
+        run_folder,
+        None if rebuild else written,
+    )
+    delete_s3_keys(s3_client, output_bucket, superseded)
+    _logger.info(
+        f"{hive_table}: rewrote {len(written)} latest snapshot partitions,"
+        f" deleted {len(superseded)} superseded objects"
+    )
+
+
+def get_add_partitions_sql(table, partition_locations, batch_size=500):
+    """Return statements registering each run partition at its location,
+    batch_size partitions to a statement"""
+    partitions = [
+        f"partition ({PARTITION_COLUMN}='{run}') location '{location}'"
+        for run, location in sorted(partition_locations.items())
+    ]
+    return [
+        f"alter table {table} add if not exists "
+        + " ".join(partitions[i : i + batch_size])
+        for i in range(0, len(partitions), batch_size)
+    ]
+
+
+def get_drop_partitions_sql(table, runs):
+    return f"alter table {table} drop if exists " + ", ".join(
+        f"partition ({PARTITION_COLUMN}='{run}')" for run in sorted(runs)
+    )
+
+
+def get_partitions(spark, table):
+    """Return the runs registered as partitions of table"""
+    return {
+        row[0].split("=", 1)[1]
+        for row in spark.sql(f"show partitions {table}").collect()
+    }
+
+
+def get_ddl_comment(statement):
+    """Return the comment marking a table or view with a hash of its DDL"""
+    normalised = " ".join(statement.split())
+    return DDL_COMMENT_PREFIX + hashlib.sha1(normalised.encode()).hexdigest()[:16]
+
+
+class MetastoreSync:
+    """Keeps the tables and views of a database in line with their DDL.  Each
+    is commented with a hash of the DDL that created it, so the current
+    definitions are read with one listing of the database and only DDL that
+    has changed is run."""
+
+    def __init__(self, spark, database_name):
+        self.spark = spark
+        self.database_name = database_name
+        self._comments = None
+        self._lock = threading.Lock()
+
+    def get_comment(self, name):
+        with self._lock:
+            if self._comments is None:
+                self.spark.sql(f"create database if not exists {self.database_name}")
+                self._comments = {
+                    table.name: table.description
+                    for table in self.spark.catalog.listTables(self.database_name)
+                }
+            return self._comments.get(name.lower())
+
+    def exists(self, name):
+        self.get_comment(name)
+        with self._lock:
+            return name.lower() in self._comments
+
+    def sync(self, name, get_sql, drop_sql=None):
+        """Run get_sql(comment) for the table or view `name` unless it was
+        created by the same DDL, first running drop_sql.  Returns whether the
+        DDL was run."""
+        comment = get_ddl_comment(get_sql(None))
+        if self.get_comment(name) == comment:
+            return False
+        if drop_sql:
+            self.spark.sql(drop_sql)
+        self.spark.sql(get_sql(comment))
+        with self._lock:
+            self._comments[name.lower()] = comment
+        return True
+
+
+def create_hive_table(spark, database_name, collection, s3_client=None, metastore=None):
+    """Create hive table + 'latest' view over data in s3.  The table is
+    partitioned by run folder, and each run registers only its own partition.
+    The table and view are only replaced when their DDL changes, and when the
+    table is (re)created every run folder under the collection prefix is
+    registered.  A latest snapshot is marked stale before the run's partitions
+    are registered, and only cleared once they are merged into it."""
+    hive_table = collection["hive_table"]
+    table = f"{database_name}.{hive_table}"
+    output_format = collection.get("output_format", "csv")
+    metastore = metastore or MetastoreSync(spark, database_name)
+    s3_path = "s3://" + os.path.join(
+        collection["output_bucket"],
+        collection["collection_output_prefix"],
+    )
+    run_folders = collection.get(
+        "run_folders", [os.path.basename(collection["full_output_prefix"])]
+    )
+    latest_delta = collection.get("latest_delta")
+
+    with _metrics.timer("ddl", collection):
+        created = metastore.sync(
+            hive_table,
+            lambda comment: get_create_table_sql(
+                database_name, hive_table, s3_path, output_format, comment
+            ),
+            drop_sql=f"drop table if exists {table}",
+        )
+        if created:
+            _logger.info(f"{hive_table}: created table, registering run folders")
+            run_folders = [
+                folder
+                for folder in list_folders(
+                    s3_client,
+                    collection["output_bucket"],
+                    collection["collection_output_prefix"],
+                )
+                if not folder.startswith("_")
+            ]
+        snapshot_properties = None
+        if metastore.exists(f"{hive_table}_latest"):
+            snapshot_properties = get_table_properties(spark, f"{table}_latest")
+            spark.sql(get_set_stale_sql(f"{table}_latest", True))
+        for statement in get_add_partitions_sql(
+            table, {run: f"{s3_path}/{run}" for run in run_folders}
+        ):
+            spark.sql(statement)
+        if latest_delta is not None:
+            update_latest_snapshot(
+                spark, database_name, collection, s3_client, snapshot_properties
+            )
+            latest_delta.unpersist()
+        metastore.sync(
+            f"v_{hive_table}_latest",
+            lambda comment: get_create_latest_view_sql(
+                database_name,
+                hive_table,
+                snapshot=latest_delta is not None,
+                output_format=output_format,
+                comment=comment,
+            ),
+        )
+
+
+def list_objects(s3_client, bucket, prefix):
+    """Yield every object under prefix, following list_objects_v2 pagination"""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        yield from page.get("Contents", [])
+
+
+def list_folders(s3_client, bucket, prefix):
+    """Yield the name of each folder directly under prefix"""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix + "/", Delimiter="/"):
+        for item in page.get("CommonPrefixes", []):
+            yield item["Prefix"][len(prefix) + 1 :].rstrip("/")
+
+
+def list_object_keys(s3_client, bucket, prefix):
+    """Yield every key under prefix"""
+    for item in list_objects(s3_client, bucket, prefix):
+        yield item["Key"]
+
+
+def read_s3_json(s3_client, bucket, key):
+    """Return the parsed JSON object at key, None if there is no such key"""
     try:
-        spark.sql(drop_view)
-        spark.sql(drop_table)
-    except Exception as e:
-        _logger.error(e)
-    spark.sql(create_table)
-    spark.sql(create_view)
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
 
+def delete_s3_prefix(s3_client, bucket, prefix):
+    """Delete every object under prefix"""
+    delete_s3_keys(s3_client, bucket, list(list_object_keys(s3_client, bucket, prefix)))
 
-def tag_s3_objects(s3_client, collection):
+
+def delete_s3_keys(s3_client, bucket, keys):
+    for i in range(0, len(keys), 1000):
+        s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]]},
+        )
+
+
+def tag_s3_objects(s3_client, collection, max_workers=20):
+    """Tag every object under the collection's output prefix with its tags,
+    using up to max_workers concurrent requests.  Throttled requests are
+    retried by the client's adaptive retry mode."""
     _logger.info(f"{collection['hive_table']}: tagging files")
-    i = 0
     aws_format_tags = [
         {"Key": key, "Value": value} for key, value in collection["tags"].items()
     ]
+    bucket = collection["output_bucket"]
 
-    for key in s3_client.list_objects(
-        Bucket=collection["output_bucket"], Prefix=collection["full_output_prefix"]
-    )["Contents"]:
+    def tag_object(key):
         s3_client.put_object_tagging(
-            Bucket=collection["output_bucket"],
-            Key=key["Key"],
-            Tagging={"TagSet": aws_format_tags},
+            Bucket=bucket, Key=key, Tagging={"TagSet": aws_format_tags}
+        )
+        return key
+
+    with _metrics.timer("tag", collection), concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers
+    ) as executor:
+        keys = list(
+            executor.map(
+                tag_object,
+                list_object_keys(s3_client, bucket, collection["full_output_prefix"]),
+            )
+        )
+    collection["part_files"] = sum(
+        1 for key in keys if os.path.basename(key).startswith("part-")
+    )
+    _metrics.put_metric(
+        "TaggedObjects", len(keys), collection=collection["hbase_table"]
+    )
+    _logger.info(f"{collection['hive_table']}: tagging complete, {len(keys)} objects")
+
+
+def get_compaction_period(folder, period="daily"):
+    """Return (compacted folder name, end of period) for a run folder or a
+    folder already compacted for the period, None for any other folder"""
+    for folder_format in [RUN_FOLDER_FORMAT, f"{period}-%Y%m%d"]:
+        try:
+            date = datetime.datetime.strptime(folder, folder_format)
+            break
+        except ValueError:
+            pass
+    else:
+        return None
+    start = date.replace(hour=0, minute=0)
+    if period == "weekly":
+        start -= datetime.timedelta(days=start.weekday())
+    end = start + datetime.timedelta(days=COMPACTION_PERIODS[period])
+    return f"{period}-{start:%Y%m%d}", end
+
+
+def plan_compaction(objects, collection_prefix, period, now):
+    """Group a collection's objects by run folder.  Returns {compacted folder:
+    {folder: [objects]}} for the run folders (and any compacted folder) of
+    periods ended by `now`.  Hidden objects, such as checkpoints, are left
+    out."""
+    compact = {}
+    for obj in objects:
+        folder = os.path.relpath(obj["Key"], collection_prefix).split("/")[0]
+        if folder.startswith("_"):
+            continue
+        compaction = get_compaction_period(folder, period)
+        if compaction is not None and compaction[1] <= now:
+            compact.setdefault(compaction[0], {}).setdefault(folder, []).append(obj)
+    return compact
+
+
+def rewrite_output(spark, paths, output_path, output_format, partitions):
+    """Rewrite the files under paths as `partitions` files at output_path.  Csv
+    output is copied line for line, coalescing whole files so that records
+    with quoted newlines stay intact."""
+    if output_format == "csv":
+        output = spark.read.option("lineSep", "\n").text(paths).coalesce(partitions)
+        output.write.option("lineSep", "\n").text(
+            output_path, compression="com.hadoop.compression.lzo.LzopCodec"
+        )
+    else:
+        output = spark.read.format(output_format).load(paths).coalesce(partitions)
+        output.write.format(output_format).save(output_path)
+
+
+def compact_collection(
+    spark,
+    s3_client,
+    database_name,
+    collection,
+    period="daily",
+    now=None,
+    target_file_mb=128,
+    max_output_files=1000,
+):
+    """Rewrite the collection's run partitions for ended periods into one
+    partition per period.  The switch is not atomic: tables are partitioned
+    by run folder, which Hive can't swap for a period partition in one
+    statement, so each compacted folder is added by one statement and the run
+    partitions it replaces are dropped by the next.  In between, queries see
+    the period's records twice (v_<table>_latest removes the duplicates), but
+    never miss them, and their objects are removed only after the drop.  A compaction interrupted
+    between the two leaves both registered, and the next attempt drops the
+    runs of any registered period before deleting their objects.  Only
+    registered partitions are read, so output left by an interrupted rewrite
+    is rewritten or removed."""
+    hive_table = collection["hive_table"]
+    table = f"{database_name}.{hive_table}"
+    bucket = collection["output_bucket"]
+    collection_prefix = collection["collection_output_prefix"]
+    output_format = collection.get("output_format", "csv")
+    now = now or datetime.datetime.now()
+
+    partitions = get_partitions(spark, table)
+    compact = plan_compaction(
+        list_objects(s3_client, bucket, collection_prefix + "/"),
+        collection_prefix,
+        period,
+        now,
+    )
+    for name, folders in sorted(compact.items()):
+        runs = {
+            i: objects
+            for i, objects in folders.items()
+            if i in partitions and i != name
+        }
+        if name in partitions:
+            # already compacted, finish the switch of an interrupted run and
+            # remove the originals it left
+            if runs:
+                _logger.info(f"{hive_table}: dropping {len(runs)} runs of {name}")
+                spark.sql(get_drop_partitions_sql(table, runs))
+            delete_s3_keys(
+                s3_client,
+                bucket,
+                [obj["Key"] for i in folders if i != name for obj in folders[i]],
+            )
+            continue
+        if not runs:
+            continue
+        _logger.info(f"{hive_table}: compacting {len(runs)} run folders into {name}")
+        output_prefix = os.path.join(collection_prefix, name)
+        delete_s3_prefix(s3_client, bucket, output_prefix + "/")
+        with _metrics.timer("compact", collection):
+            rewrite_output(
+                spark,
+                [f"s3://{bucket}/{collection_prefix}/{run}" for run in runs],
+                f"s3://{bucket}/{output_prefix}",
+                output_format,
+                get_output_partitions(
+                    sum(obj["Size"] for i in runs.values() for obj in i),
+                    target_file_mb,
+                    1,
+                    max_output_files,
+                ),
+            )
+        tag_s3_objects(
+            s3_client, dict(collection, full_output_prefix=output_prefix + "/")
         )
-        i += 1
-    _logger.info(f"{collection['hive_table']}: tagging complete, {i} objects")
+        for statement in get_add_partitions_sql(
+            table, {name: f"s3://{bucket}/{output_prefix}"}
+        ) + [get_drop_partitions_sql(table, runs)]:
+            spark.sql(statement)
+        delete_s3_keys(
+            s3_client, bucket, [obj["Key"] for i in runs.values() for obj in i]
+        )
+        _metrics.put_metric(
+            "CompactedObjects",
+            sum(len(i) for i in runs.values()),
+            collection=collection["hbase_table"],
+        )
+    return collection
 
 
 def main(
@@ -503,48 +2724,155 @@ def main(
     s3_client,
     accumulators,
     create_hive_tables_bool=True,
+    processing_options=None,
 ):
     _logger.info("Refreshing metadata")
-    try:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            processed_collections = list(
-                executor.map(
-                    process_collection,
-                    collections,
-                    itertools.repeat(spark),
-                    itertools.repeat(end_time),
-                    itertools.repeat(accumulators),
-                )
-            )
-    except Exception as e:
-        _logger.error(e)
-        raise e
-
-    # tag files
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        _ = list(
-            executor.map(
-                tag_s3_objects, itertools.repeat(s3_client), processed_collections
+    processing_options = dict(processing_options or {})
+    if processing_options.get("prefetch_dks_keys"):
+        check_io_encryption(spark)
+    max_workers = processing_options.pop("max_concurrent_collections", None)
+    extraction_slots = threading.BoundedSemaphore(
+        processing_options.pop("max_concurrent_extractions", 4)
+    )
+    collections = schedule_collections(collections)
+    _logger.info(f"Collection schedule: {format_schedule(collections)}")
+
+    def run_collection(collection_info):
+        if collection_info.get("windows"):
+            return process_windows(
+                collection_info,
+                spark=spark,
+                end_time=end_time,
+                accumulators=accumulators,
+                s3_client=s3_client,
+                extraction_slots=extraction_slots,
+                **processing_options,
             )
+        return process_collection(
+            collection_info,
+            spark=spark,
+            end_time=end_time,
+            accumulators=accumulators,
+            s3_client=s3_client,
+            extraction_slots=extraction_slots,
+            **processing_options,
         )
 
+    processed_collections = run_isolated(
+        run_collection, collections, "process", max_workers
+    )
+
+    # tag files not already tagged on write
+    tagging_max_workers = processing_options.get("tagging_max_workers", 20)
+    run_isolated(
+        lambda i: tag_s3_objects(s3_client, i, tagging_max_workers),
+        [i for i in processed_collections if not i.get("tagged")],
+        "tag",
+    )
+
     # create Hive tables
     if create_hive_tables_bool:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            _ = list(
-                executor.map(
-                    create_hive_table,
-                    itertools.repeat(spark),
-                    itertools.repeat(database_name),
-                    list(processed_collections),
-                )
+        metastore = MetastoreSync(spark, database_name)
+        run_isolated(
+            lambda i: create_hive_table(spark, database_name, i, s3_client, metastore),
+            [i for i in processed_collections if "error" not in i],
+            "create table",
+        )
+
+    # a completed backfill is not resumed, so its checkpoint is removed
+    run_isolated(
+        lambda i: delete_checkpoint(s3_client, i),
+        [i for i in processed_collections if i.get("windows") and "error" not in i],
+        "delete checkpoint",
+    )
+    return collections
+
+
+def run_isolated(function, collections, stage, max_workers=None):
+    """Apply function to each collection concurrently, returning those it
+    succeeded for.  A collection that raises, or whose lease has been lost, is
+    logged and marked with collection["error"], so later stages skip it
+    without failing the others."""
+
+    def run(collection):
+        try:
+            check_lease(collection)
+            function(collection)
+            return collection
+        except Exception as e:
+            _logger.error(
+                f"{collection['hbase_table']}: failed to {stage}",
+                extra={"Exception": e},
             )
+            collection["error"] = f"{stage}: {e}"
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        results = list(executor.map(run, collections))
+    return [i for i in results if i is not None]
+
+
+def check_lease(collection):
+    if collection.get("lease_lost"):
+        raise RuntimeError("lease lost to another job")
+
+
+def failed_collections(collections):
+    return [i for i in collections if "error" in i]
+
+
+def succeeded_collections(collections):
+    return [i for i in collections if "error" not in i]
+
+
+def log_run_summaries(run_summaries, total_time):
+    dks_stats = {"hits": 0, "misses": 0, "evictions": 0}
+    for summary in run_summaries.values():
+        _logger.info(str(summary))
+        _metrics.put_metrics(
+            {
+                "RecordCount": (summary.record_count, "Count"),
+                "InputBytes": (summary.input_bytes, "Bytes"),
+                "OutputBytes": (summary.output_bytes, "Bytes"),
+                "DksCalls": (summary.dks_stats["misses"], "Count"),
+                "DecryptTime": (summary.decrypt_seconds * 1000, "Milliseconds"),
+            },
+            summary.collection,
+        )
+        merge_stats(dks_stats, summary.dks_stats)
+    record_count = sum(summary.record_count for summary in run_summaries.values())
+    _metrics.put_metric("RunTime", total_time, "Seconds")
+    _logger.info(
+        f"time taken to process collections: {record_count} records"
+        + f" in {total_time}s.  {format_dks_stats(dks_stats)}"
+    )
 
 
 def get_job_status_table():
     return boto3.resource("dynamodb").Table(JOB_STATUS_TABLE)
 
 
+def get_run_history_table():
+    return boto3.resource("dynamodb").Table(RUN_HISTORY_TABLE)
+
+
+def save_run_history(args, collections, run_summaries):
+    """Record the run in the run history table.  Failures are logged rather
+    than raised, as the collections have already been processed."""
+    try:
+        put_run_history(
+            get_run_history_table(),
+            get_run_history_items(
+                collections,
+                run_summaries,
+                args.correlation_id,
+                args.job_type,
+                args.triggered_time,
+            ),
+        )
+    except Exception as e:
+        _logger.error(f"Failed to save run history", extra={"Exception": e})
+
+
 def scheduled_handler(args, cluster_id):
     _logger.info(f"Scheduled handler")
 
@@ -554,20 +2882,20 @@ def scheduled_handler(args, cluster_id):
 
     # spark
     spark = SparkSession.builder.enableHiveSupport().getOrCreate()
-    dks_count = spark.sparkContext.accumulator(0)
-    record_count = spark.sparkContext.accumulator(0)
-    max_timestamps = spark.sparkContext.accumulator(dict(), DictAccumulatorParam())
-    accumulators = {
-        "dks_count": dks_count,
-        "record_count": record_count,
-        "max_timestamps": max_timestamps,
-    }
+    run_stats = get_run_stats_accumulator(spark)
+    accumulators = {"run_stats": run_stats}
 
     # main
     collections = get_collections(args, job_table)
     _logger.info(
         f"Collections: {' '.join([collection['hbase_table'] for collection in collections])}"
     )
+    collections = defer_unleased_collections(
+        job_table, args.correlation_id, collections, args.lease_duration_minutes
+    )
+    if not collections:
+        _logger.warning("No collections left to process")
+        return "SUCCEEDED"
 
     start_times = {
         collection["hbase_table"]: {"ProcessedDataStart": collection["start_time"]}
@@ -588,22 +2916,52 @@ def scheduled_handler(args, cluster_id):
     perf_start = time.perf_counter()
     try:
         _logger.info("Executing main")
-        main(
-            spark=spark,
-            end_time=args.end_time,
-            database_name=args.database_name,
-            collections=collections,
-            s3_client=s3_client,
-            accumulators=accumulators,
+        with renewing_leases(
+            job_table,
+            args.correlation_id,
+            collections,
+            args.lease_duration_minutes,
+        ):
+            main(
+                spark=spark,
+                end_time=args.end_time,
+                database_name=args.database_name,
+                collections=collections,
+                s3_client=s3_client,
+                accumulators=accumulators,
+                processing_options=get_processing_options(args),
+            )
+        failed = failed_collections(collections)
+        _logger.info(
+            f"main executed, {len(collections) - len(failed)} of "
+            f"{len(collections)} collections succeeded"
         )
-        _logger.info("main executed successfully")
 
+        run_summaries = {
+            collection: summary
+            for collection, summary in get_run_summaries(run_stats.value).items()
+            if collection not in {i["hbase_table"] for i in failed}
+        }
+        update_watermarks(job_table, succeeded_collections(collections), run_summaries)
         update_db_with_success(
             table=job_table,
             correlation_id=args.correlation_id,
-            max_timestamps=max_timestamps.value,
+            run_summaries=run_summaries,
             bulk_values={"JobStatus": EMRStates["COMPLETED"]},
         )
+        update_db_bulk_collections(
+            table=job_table,
+            correlation_id=args.correlation_id,
+            collections=[i for i in failed if not i.get("lease_lost")],
+            values={"JobStatus": EMRStates["EMR_FAILED"]},
+        )
+        # another job holds these now, so they don't block later runs
+        update_db_bulk_collections(
+            table=job_table,
+            correlation_id=args.correlation_id,
+            collections=[i for i in failed if i.get("lease_lost")],
+            values={"JobStatus": EMRStates["DEFERRED"]},
+        )
         perf_end = time.perf_counter()
         total_time = round(perf_end - perf_start)
 
@@ -616,11 +2974,31 @@ def scheduled_handler(args, cluster_id):
             values={"JobStatus": EMRStates["EMR_FAILED"]},
         )
         raise
-
-    _logger.info(
-        f"time taken to process collections: {record_count.value} records"
-        + f" in {total_time}s.  {dks_count.value} calls to DKS"
+    finally:
+        try:
+            release_leases(job_table, args.correlation_id, collections)
+        except Exception as e:
+            _logger.error(f"Failed to release leases", extra={"Exception": e})
+
+    log_run_summaries(run_summaries, total_time)
+    save_run_history(args, succeeded_collections(collections), run_summaries)
+    return get_run_status(collections)
+
+
+def get_run_status(collections):
+    """Return the status of the run as a whole, raising if every collection
+    failed.  Failed collections are reported as a metric and in the log."""
+    failed = failed_collections(collections)
+    _metrics.put_metric("FailedCollections", len(failed))
+    if not failed:
+        return "SUCCEEDED"
+    errors = {i["hbase_table"]: i["error"] for i in failed}
+    if len(failed) == len(collections):
+        raise RuntimeError(f"All collections failed: {errors}")
+    _logger.error(
+        f"{len(failed)} of {len(collections)} collections failed", extra=errors
     )
+    return "PARTIALLY_SUCCEEDED"
 
 
 def manual_handler(args):
@@ -631,14 +3009,8 @@ def manual_handler(args):
 
     # spark
     spark = SparkSession.builder.enableHiveSupport().getOrCreate()
-    dks_count = spark.sparkContext.accumulator(0)
-    record_count = spark.sparkContext.accumulator(0)
-    max_timestamps = spark.sparkContext.accumulator(dict(), DictAccumulatorParam())
-    accumulators = {
-        "dks_count": dks_count,
-        "record_count": record_count,
-        "max_timestamps": max_timestamps,
-    }
+    run_stats = get_run_stats_accumulator(spark)
+    accumulators = {"run_stats": run_stats}
     args.end_time = ms_epoch_now() if args.end_time is None else args.end_time
 
     # main
@@ -657,6 +3029,7 @@ def manual_handler(args):
             collections=collections,
             s3_client=s3_client,
             accumulators=accumulators,
+            processing_options=get_processing_options(args),
         )
         perf_end = time.perf_counter()
         total_time = round(perf_end - perf_start)
@@ -665,10 +3038,49 @@ def manual_handler(args):
         _logger.error(f"Failed to process collections", extra={"Exception": e})
         raise
 
-    _logger.info(
-        f"time taken to process collections: {record_count.value} records"
-        + f" in {total_time}s.  {dks_count.value} calls to DKS"
+    run_summaries = get_run_summaries(run_stats.value)
+    log_run_summaries(run_summaries, total_time)
+    save_run_history(args, succeeded_collections(collections), run_summaries)
+    return get_run_status(collections)
+
+
+def compact_handler(args):
+    _logger.info(f"Compaction handler")
+
+    # boto3
+    job_table = get_job_status_table()
+    s3_client = get_s3_client()
+
+    # spark
+    spark = SparkSession.builder.enableHiveSupport().getOrCreate()
+
+    collections = get_collections(args)
+    leased = acquire_leases(
+        job_table, args.correlation_id, collections, args.lease_duration_minutes
     )
+    for collection in collections:
+        if collection not in leased:
+            _logger.warning(f"{collection['hbase_table']}: leased, not compacting")
+    try:
+        with renewing_leases(
+            job_table, args.correlation_id, leased, args.lease_duration_minutes
+        ):
+            run_isolated(
+                lambda i: compact_collection(
+                    spark,
+                    s3_client,
+                    args.database_name,
+                    i,
+                    period=args.compaction_period,
+                    target_file_mb=args.target_file_mb,
+                    max_output_files=args.max_output_files,
+                ),
+                leased,
+                "compact",
+            )
+    finally:
+        release_leases(job_table, args.correlation_id, leased)
+    return get_run_status(leased)
 
 
 if __name__ == "__main__":
@@ -679,14 +3091,21 @@ if __name__ == "__main__":
     cluster_id = os.environ.get("EMR_CLUSTER_ID")
     _logger.info(f"Job submitted on cluster {cluster_id}")
     args = get_parameters()
+    _metrics = MetricsLogger(
+        LOG_PATH, dimensions={"CorrelationId": args.correlation_id}
+    )
 
     args.triggered_time = (
         ms_epoch_now() if args.triggered_time is None else args.triggered_time
     )
 
     if args.job_type == "scheduled":
-        scheduled_handler(args, cluster_id)
+        run_status = scheduled_handler(args, cluster_id)
     elif args.job_type == "manual":
-        manual_handler(args)
+        run_status = manual_handler(args)
+    elif args.job_type == "compact":
+        run_status = compact_handler(args)
     else:
         raise ArgumentError(args.job_type, "Unrecognised job_type")
+    _logger.info(f"Run status: {run_status}")
+    sys.exit(RUN_EXIT_CODES[run_status])
@@ -1,7 +1,11 @@
+import csv
+import io
 import json
 from time import time
 from typing import Any
 
+from generate_dataset_from_hbase import parse_hbase_shell_line, process_cell
+
 dks_test_data = {
     "test_plaintext": "12b1a332-5b46-4ad7-bd98-6f8deea3ecb7",
     "test_ciphertext": "ZLDdPh9IXexOzCztXNtC/uFASJVFU+RhIzu7/x8DzUmenZlO",
@@ -33,9 +37,12 @@ class GetCollectionArgs:
     output_s3_bucket: str = "example-bucket"
     output_s3_prefix: str = "folder1/folder2"
     end_time: int = round(time() / 1000)
-    start_time: int = round(time() / 1000)-500
-    triggered_time: int = round(time() / 1000)-500
+    start_time: int = round(time() / 1000) - 500
+    triggered_time: int = round(time() / 1000) - 500
     job_type: str = "scheduled"
+    output_format: str = "csv"
+    window_ms: int = None
+    restart_backfill: bool = False
 
     def __init__(self, collections=None):
         self.collections = collections if collections else []
@@ -79,3 +86,175 @@ def mock_retrieve_secrets(*args, **kwargs):
 
 def mock_decrypt_message(item, *args, **kwargs):
     return "<id>", item
+
+
+def make_test_message(record_id, cek, db_object):
+    return json.dumps(
+        {
+            "message": {
+                "_id": record_id,
+                "encryption": {
+                    "initialisationVector": "<iv>",
+                    "encryptedEncryptionKey": cek,
+                    "keyEncryptionKeyId": "<kek>",
+                },
+                "dbObject": db_object,
+            }
+        }
+    )
+
+
+class LocalRDD:
+    """Minimal in-memory stand-in for the RDD operations used by the step"""
+
+    def __init__(self, items, saved=None):
+        self.items = list(items)
+        self.saved = {} if saved is None else saved
+
+    def map(self, f):
+        return LocalRDD((f(x) for x in self.items), self.saved)
+
+    def flatMap(self, f):
+        return LocalRDD((y for x in self.items for y in f(x)), self.saved)
+
+    def mapPartitions(self, f):
+        return LocalRDD(f(iter(self.items)), self.saved)
+
+    def filter(self, f):
+        return LocalRDD((x for x in self.items if f(x)), self.saved)
+
+    def distinct(self):
+        return LocalRDD(dict.fromkeys(self.items), self.saved)
+
+    def persist(self, *args):
+        return self
+
+    def unpersist(self):
+        return self
+
+    def collect(self):
+        return list(self.items)
+
+    def getNumPartitions(self):
+        return 1
+
+    def saveAsTextFile(self, path, **kwargs):
+        # Record the lines of the written text, as an element may hold several
+        self.saved[path] = "\n".join(self.items).split("\n") if self.items else []
+
+
+class LocalBroadcast:
+    def __init__(self, value):
+        self.value = value
+
+    def unpersist(self):
+        pass
+
+
+class LocalHBaseReader:
+    """HBaseReader fixture serving (row_key, timestamp, value) cells from
+    memory"""
+
+    lazy = False
+
+    def __init__(self, cells):
+        self.cells = cells
+        self.rdds = []
+
+    def read(self, spark, collection_info, start_time, end_time):
+        rdd = LocalRDD(
+            cell for cell in self.cells if start_time <= int(cell[1]) < end_time
+        )
+        self.rdds.append(rdd)
+        return rdd
+
+
+def make_shell_line(row_key, timestamp, value, column="cf:record"):
+    """Format a cell the way `hbase shell` scan output does"""
+    return f" {row_key}    column={column}, timestamp={timestamp}, value={value}"
+
+
+shell_output_lines = [
+    "HBase Shell",
+    'Use "help" to get list of supported commands.',
+    "ROW  COLUMN+CELL",
+    make_shell_line(
+        "\\x00\\x01abc",
+        1614556800000,
+        make_test_message({"declarationId": "1234"}, "<cek>", "<encrypted>"),
+    ),
+    make_shell_line("row2", 1614556800001, '{"a": "b , c"}'),
+    "2 row(s)",
+    "Took 0.1234 seconds",
+    "",
+]
+
+
+# reference implementations of the per-record functions the step used
+# before cells were parsed and written a partition at a time, kept to check
+# the current output against
+
+
+def filter_rows(x):
+    if x:
+        return str(x).find("column=") > -1
+    else:
+        return False
+
+
+def process_record(x, table_name, accumulators, dks_client):
+    return process_cell(parse_hbase_shell_line(x), table_name, accumulators, dks_client)
+
+
+def list_to_csv_str(x):
+    output = io.StringIO("")
+    csv.writer(output).writerow(x)
+    return output.getvalue().strip()
+
+
+def opencsv_parse_line(line, separator=",", quotechar='"', escape="\\"):
+    """Port of opencsv 2.3 CSVParser.parseLine as used by Hive's OpenCSVSerde
+    (non-strict quotes, leading whitespace ignored).  The serde swaps its
+    default escapeChar for opencsv's backslash default."""
+    tokens = []
+    sb = ""
+    in_quotes = False
+    in_field = False
+
+    def next_is(i, chars):
+        return (in_quotes or in_field) and len(line) > i + 1 and line[i + 1] in chars
+
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if c == escape:
+            if next_is(i, (quotechar, escape)):
+                sb += line[i + 1]
+                i += 1
+        elif c == quotechar:
+            if next_is(i, (quotechar,)):
+                sb += line[i + 1]
+                i += 1
+            else:
+                if (
+                    i > 2
+                    and line[i - 1] != separator
+                    and len(line) > i + 1
+                    and line[i + 1] != separator
+                ):
+                    if sb and sb.isspace():
+                        sb = ""
+                    else:
+                        sb += c
+                in_quotes = not in_quotes
+            in_field = not in_field
+        elif c == separator and not in_quotes:
+            tokens.append(sb)
+            sb = ""
+            in_field = False
+        else:
+            sb += c
+            in_field = True
+        i += 1
+    tokens.append(sb)
+    return tokens
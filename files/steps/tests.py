@@ -1,23 +1,102 @@
+import datetime
 import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
+
+import botocore.exceptions
 from test_tools import (
+    GetCollectionArgs,
     dks_test_data,
     mock_get_key_from_dks,
     mock_get_plaintext_key,
     mock_decrypt_ciphertext,
     mock_decrypt_message,
-)
-
-from generate_dataset_from_hbase import (
+    LocalHBaseReader,
+    LocalRDD,
+    LocalBroadcast,
+    make_test_message,
+    shell_output_lines,
+    make_shell_line,
+    opencsv_parse_line,
     filter_rows,
     list_to_csv_str,
     process_record,
+)
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+from generate_dataset_from_hbase import (
+    csv_partition,
+    csv_field,
     get_plaintext_key,
     decrypt_ciphertext,
     decrypt_message,
     encrypt_plaintext,
+    get_scan_command,
+    get_scan_ranges,
+    parse_split_keys,
+    HBaseShellReader,
+    process_collection,
+    process_cell,
+    decrypt_partition,
+    DksClient,
+    tag_s3_objects,
+    get_predicted_volume,
+    get_run_history_items,
+    get_run_history,
+    get_volume_growth,
+    MetricsLogger,
+    update_db_items_concurrently,
+    map_concurrently,
+    release_leases,
+    renewing_leases,
+    defer_unleased_collections,
+    run_isolated,
+    update_watermarks,
+    get_last_processed_dynamodb,
+    CollectionRunSummary,
+    setup_logging,
+    schedule_collections,
+    RunStatsAccumulatorParam,
+    get_run_summaries,
+    prefetch_plaintext_keys,
+    collect_key_pairs,
+    key_pair_batch,
+    decrypt_batch,
+    csv_batch,
+    get_collections,
+    get_remaining_windows,
+    get_time_windows,
+    get_output_partitions,
+    process_windows,
+    get_run_status,
+    get_compaction_period,
+    plan_compaction,
+    compact_collection,
+    main,
+    get_create_table_sql,
+    create_hive_table,
+    get_ddl_comment,
+    MetastoreSync,
+    get_create_latest_view_sql,
+    get_snapshot_partition_sql,
+    get_superseded_snapshot_keys,
+    update_latest_snapshot,
+    parse_hbase_shell_line,
+    parse_hbase_shell_partition,
+    parse_message,
+    get_json_loads,
 )
+import generate_dataset_from_adg
 
 
 class TestCrypto(unittest.TestCase):
@@ -79,13 +158,41 @@ class TestSparkFunctions(unittest.TestCase):
         for i in test_values:
             self.assertEqual(list_to_csv_str(i[0]), i[1])
 
+    def test_parse_hbase_shell_line(self):
+        for line in shell_output_lines:
+            expected = None
+            if filter_rows(line):
+                y = [
+                    str.strip(i)
+                    for i in re.split(r" *column=|, *timestamp=|, *value=", line)
+                ]
+                expected = (y[0], y[2], y[3])
+            self.assertEqual(parse_hbase_shell_line(line), expected)
+
+    def test_parse_hbase_shell_partition(self):
+        cells = list(parse_hbase_shell_partition(iter(shell_output_lines)))
+        self.assertEqual(len(cells), 2)
+        self.assertEqual(cells[1], ("row2", "1614556800001", '{"a": "b , c"}'))
+
+    def test_parse_message(self):
+        message = make_test_message({"declarationId": "1234"}, "<cek>", "<obj>")
+        self.assertEqual(
+            parse_message(message),
+            ({"declarationId": "1234"}, "<iv>", "<cek>", "<kek>", "<obj>"),
+        )
+
+    def test_json_backends_parse_message_equally(self):
+        message = make_test_message({"declarationId": "1234"}, "<cek>", "<obj>")
+        self.assertEqual(
+            parse_message(message, get_json_loads("orjson")),
+            parse_message(message, get_json_loads("json")),
+        )
+
     @mock.patch("generate_dataset_from_hbase.decrypt_message", mock_decrypt_message)
     def test_process_record(self):
         acc = mock.MagicMock()
-        input_record = (
-            "<id> column=<column>,  timestamp=12345, value=<recordvalue>"
-        )
-        output = process_record(input_record, "<table_name>", acc)
+        input_record = "<id> column=<column>,  timestamp=12345, value=<recordvalue>"
+        output = process_record(input_record, "<table_name>", acc, mock.MagicMock())
         self.assertIsInstance(output, list)
         self.assertEqual(len(output), 3)
         self.assertEqual(output[0], "<id>")
@@ -93,6 +200,1738 @@ class TestSparkFunctions(unittest.TestCase):
         self.assertEqual(output[2], "<recordvalue>")
 
 
+class TestCsvSerialization(unittest.TestCase):
+    rows = [
+        ["<id1>", 1614556800000, '{"a": "b , c", "d": "\'e\'"}'],
+        [123, "some text", '"', '"""'],
+        [None, "some-text", "text", None],
+        ["", "", ""],
+        ['{"declarationId": "1234"}', "1", '{"k": ["x", "y"]}'],
+    ]
+
+    def test_csv_partition_matches_list_to_csv_str(self):
+        expected = "\n".join(list_to_csv_str(row) for row in self.rows)
+        for batch_size in [1, 2, 1000]:
+            output = list(csv_partition(iter(self.rows), batch_size))
+            self.assertEqual(len(output), -(-len(self.rows) // batch_size))
+            self.assertEqual("\n".join(output), expected)
+        self.assertEqual(list(csv_partition(iter([]))), [])
+
+    def test_csv_partition_preserves_whitespace(self):
+        row = [" <id>", 100, '{"a": 1} ']
+        self.assertEqual(list(csv_partition([row])), [' <id>,100,"{""a"": 1} "'])
+        self.assertEqual(list_to_csv_str(row), '<id>,100,"{""a"": 1} "')
+
+    def test_csv_partition_opencsv_serde_parse(self):
+        rows = self.rows + [[" <id>", 100, '{"a": 1} ']]
+        lines = "\n".join(csv_partition(rows, 2)).split("\n")
+        for row, line in zip(rows, lines):
+            self.assertEqual(opencsv_parse_line(line), [csv_field(x) for x in row])
+
+    def test_adg_csv_partition(self):
+        for batch_size in [1, 3]:
+            self.assertEqual(
+                list(generate_dataset_from_adg.csv_partition(self.rows, batch_size)),
+                list(csv_partition(self.rows, batch_size)),
+            )
+
+
+class TestAdgTimestamps(unittest.TestCase):
+    @staticmethod
+    def strptime_timestamp(value):
+        return round(
+            datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ").timestamp()
+            * 1000
+        )
+
+    def test_matches_strptime(self):
+        start = datetime.datetime(2019, 3, 30)
+        values = [
+            (start + datetime.timedelta(minutes=i * 7, microseconds=i)).strftime(
+                "%Y-%m-%dT%H:%M:%S.%f"
+            )
+            for i in range(2000)
+        ]
+        values = [i[:-3] + "Z" for i in values] + [i + "Z" for i in values]
+        # forms only strptime reads
+        values += ["2020-3-4T5:06:07.1Z", "2020-03-04T05:06:07.12345Z"]
+        for value in values:
+            expected = self.strptime_timestamp(value)
+            self.assertEqual(
+                generate_dataset_from_adg.process_timestamp(value), expected
+            )
+            self.assertEqual(
+                generate_dataset_from_adg.process_timestamp({"d_date": value}),
+                expected,
+            )
+
+    def test_invalid_timestamps(self):
+        for value in [
+            "2020-13-04T05:06:07.123Z",
+            "2020-03-04T24:06:07.123Z",
+            "2020-03-04T05:06:07Z",
+            "2020-03-04 05:06:07.123",
+        ]:
+            with self.assertRaises(ValueError):
+                self.strptime_timestamp(value)
+            with self.assertRaises(ValueError):
+                generate_dataset_from_adg.process_timestamp(value)
+        self.assertIsNone(generate_dataset_from_adg.process_timestamp(None))
+
+
+class TestHBaseReaders(unittest.TestCase):
+    def test_parse_split_keys(self):
+        output = "\n".join(
+            [
+                "HBase Shell",
+                "get_splits 'db:collection'",
+                "Total number of splits = 3",
+                "\\x10abc",
+                "\\x80def",
+                "Took 0.0213 seconds",
+                '=> ["\\x10abc", "\\x80def"]',
+            ]
+        )
+        self.assertEqual(parse_split_keys(output), ["\\x10abc", "\\x80def"])
+        self.assertEqual(parse_split_keys("ERROR: Unknown table"), [])
+
+    def test_scan_ranges_cover_table(self):
+        split_keys = ["b", "c", "d", "e", "f"]
+        self.assertEqual(get_scan_ranges(split_keys, 1), [("", "")])
+        for ranges in [2, 3, 6, 10]:
+            scan_ranges = get_scan_ranges(split_keys, ranges)
+            self.assertEqual(len(scan_ranges), min(ranges, 6))
+            self.assertEqual(scan_ranges[0][0], "")
+            self.assertEqual(scan_ranges[-1][1], "")
+            for (_, stop_row), (start_row, _) in zip(scan_ranges, scan_ranges[1:]):
+                self.assertEqual(stop_row, start_row)
+
+    def test_scan_command(self):
+        self.assertEqual(
+            get_scan_command("db:coll", 100, 200),
+            "scan 'db:coll', {TIMERANGE => [100, 200]}",
+        )
+        self.assertEqual(
+            get_scan_command("db:coll", 100, 200, "\\x10", 'a"#'),
+            "scan 'db:coll', {TIMERANGE => [100, 200], "
+            'STARTROW => "\\x10", STOPROW => "a\\"\\#"}',
+        )
+
+    @mock.patch("generate_dataset_from_hbase.os.system")
+    @mock.patch("generate_dataset_from_hbase.subprocess.run")
+    def test_range_scans_match_single_scan(self, run, _):
+        rows = [chr(c) * 3 for c in range(ord("a"), ord("z") + 1)]
+        files = {}
+
+        def hbase_shell(command, input=None, **kwargs):
+            if input is None:
+                return mock.Mock(stdout="1024  3072  hdfs:///db_coll\n")
+            if input.startswith("get_splits"):
+                return mock.Mock(stdout="Total number of splits = 4\nh\np\nw\n")
+            start = re.search(r'STARTROW => "([^"]*)"', input)
+            stop = re.search(r'STOPROW => "([^"]*)"', input)
+            files[command.split()[-1]] = [
+                row
+                for row in rows
+                if (not start or row >= start.group(1))
+                and (not stop or row < stop.group(1))
+            ]
+
+        run.side_effect = hbase_shell
+        reader = HBaseShellReader(scan_ranges=8)
+        collection = {"hbase_table": "db:coll", "hive_table": "db_coll"}
+        path = reader.extract(collection, 100, 200)
+        self.assertEqual(path, "hdfs:///db_coll")
+        self.assertEqual(collection["scan_ranges"], 4)
+        self.assertEqual(collection["extracted_bytes"], 1024)
+        self.assertEqual(
+            sorted(files), [f"hdfs:///db_coll/range-{i:05d}" for i in range(4)]
+        )
+        self.assertEqual(sum((files[f] for f in sorted(files)), []), rows)
+
+    @mock.patch("generate_dataset_from_hbase.os.system")
+    @mock.patch("generate_dataset_from_hbase.subprocess.run")
+    def test_range_scans_share_reader_budget(self, run, _):
+        lock = threading.Lock()
+        running = [0]
+        peaks = []
+
+        def hbase_shell(command, input=None, **kwargs):
+            if input.startswith("get_splits"):
+                return mock.Mock(stdout="Total number of splits = 4\nh\np\nw\n")
+            with lock:
+                running[0] += 1
+                peaks.append(running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        run.side_effect = hbase_shell
+        reader = HBaseShellReader(scan_ranges=4, max_concurrent_scans=3)
+        collections = [
+            {"hbase_table": f"db:coll{i}", "hive_table": f"db_coll{i}"}
+            for i in range(3)
+        ]
+        map_concurrently(lambda c: reader.scan(c, 100, 200), collections)
+        self.assertEqual(len(peaks), 12)
+        self.assertLessEqual(max(peaks), 3)
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    @mock.patch("generate_dataset_from_hbase.decrypt_message", mock_decrypt_message)
+    def test_process_collection_with_local_reader(self, _):
+        reader = LocalHBaseReader(
+            [
+                ("<id1>", "100", "<record1>"),
+                ("<id2>", "150", "<record2>"),
+                ("<id3>", "200", "<record3>"),
+            ]
+        )
+        collection = {
+            "hbase_table": "db:collection",
+            "hive_table": "db_collection",
+            "start_time": 100,
+            "output_bucket": "bucket",
+            "full_output_prefix": "prefix/db_collection/run",
+        }
+        process_collection(
+            collection, None, 200, mock.MagicMock(), reader, decrypt_mode="record"
+        )
+        self.assertEqual(
+            reader.rdds[0].saved["s3://bucket/prefix/db_collection/run"],
+            ["<id>,100,<record1>", "<id>,150,<record2>"],
+        )
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    @mock.patch("generate_dataset_from_hbase.decrypt_message", mock_decrypt_message)
+    def test_extraction_slot_held_while_reading(self, _):
+        collection = {
+            "hbase_table": "db:collection",
+            "hive_table": "db_collection",
+            "start_time": 100,
+            "output_bucket": "bucket",
+            "full_output_prefix": "prefix/db_collection/run",
+        }
+        for lazy, held_on_write in [(False, False), (True, True)]:
+            slot = threading.Lock()
+            held = []
+            reader = LocalHBaseReader([("<id1>", "100", "<record1>")])
+            reader.lazy = lazy
+            with mock.patch.object(
+                LocalRDD,
+                "saveAsTextFile",
+                lambda *args, **kwargs: held.append(slot.locked()),
+            ):
+                process_collection(
+                    collection,
+                    None,
+                    200,
+                    mock.MagicMock(),
+                    reader,
+                    decrypt_mode="record",
+                    extraction_slots=slot,
+                )
+            self.assertEqual(held, [held_on_write])
+            self.assertFalse(slot.locked())
+
+
+@mock.patch("generate_dataset_from_hbase.decrypt_ciphertext", mock_decrypt_ciphertext)
+@mock.patch(
+    "generate_dataset_from_hbase.get_key_from_dks", side_effect=mock_get_key_from_dks
+)
+class TestDecryptPartition(unittest.TestCase):
+    def setUp(self):
+        self.dks_client = DksClient(url=None)
+        self.cells = [
+            (
+                f"row{i}",
+                str(1000 + i),
+                make_test_message(
+                    f"id{i}", f"key{i % 3}_ciphertext", f"obj{i}_encrypted"
+                ),
+            )
+            for i in range(20)
+        ]
+
+    def test_one_dks_call_per_distinct_key(self, post_mock):
+        acc = {"run_stats": mock.MagicMock()}
+        output = list(
+            decrypt_partition(
+                iter(self.cells), "db:coll", acc, self.dks_client, chunk_size=7
+            )
+        )
+        self.assertEqual(len(output), 20)
+        self.assertEqual(post_mock.call_count, 3)
+        acc["run_stats"].add.assert_called_once_with(
+            {
+                "db:coll": {
+                    "record_count": 20,
+                    "min_timestamp": 1000,
+                    "max_timestamp": 1019,
+                    "input_bytes": sum(len(cell[2]) for cell in self.cells),
+                    "output_bytes": sum(len(f"obj{i}_decrypted") for i in range(20)),
+                    "decrypt_seconds": mock.ANY,
+                    "dks": {"hits": 6, "misses": 3, "evictions": 0},
+                }
+            }
+        )
+
+    def test_matches_record_path(self, _):
+        acc = mock.MagicMock()
+        partition_output = list(
+            decrypt_partition(self.cells, "db:coll", acc, self.dks_client)
+        )
+        record_output = [
+            process_cell(cell, "db:coll", acc, self.dks_client) for cell in self.cells
+        ]
+        self.assertEqual(partition_output, record_output)
+        self.assertEqual(partition_output[4], ["id4", "1004", "obj4_decrypted"])
+
+    def test_preloaded_keys_with_late_lookup(self, post_mock):
+        acc = {"run_stats": mock.MagicMock()}
+        preloaded_keys = {
+            "key0_ciphertext": "key0_plaintext",
+            "key1_ciphertext": "key1_plaintext",
+        }
+        output = list(
+            decrypt_partition(
+                self.cells,
+                "db:coll",
+                acc,
+                self.dks_client,
+                preloaded_keys=preloaded_keys,
+            )
+        )
+        self.assertEqual(len(output), 20)
+        post_mock.assert_called_once_with(
+            None, "<kek>", "key2_ciphertext", session=mock.ANY
+        )
+        stats = acc["run_stats"].add.call_args.args[0]["db:coll"]
+        # late lookups are counted per record, as in the record path
+        self.assertEqual(
+            stats["dks"], {"hits": 0, "misses": 1, "evictions": 0, "late_lookups": 6}
+        )
+        record_acc = {"run_stats": mock.MagicMock()}
+        for cell in self.cells:
+            process_cell(cell, "db:coll", record_acc, self.dks_client, preloaded_keys)
+        late_lookups = sum(
+            i.args[0]["db:coll"]["dks"]["late_lookups"]
+            for i in record_acc["run_stats"].add.call_args_list
+        )
+        self.assertEqual(late_lookups, 6)
+
+    def test_prefetch_plaintext_keys(self, post_mock):
+        acc = {"run_stats": mock.MagicMock()}
+        spark = mock.MagicMock()
+        spark.sparkContext.getConf.return_value = {
+            "spark.io.encryption.enabled": "true"
+        }
+        spark.sparkContext.broadcast.side_effect = LocalBroadcast
+        key_pairs = collect_key_pairs(LocalRDD(self.cells))
+        broadcast = prefetch_plaintext_keys(
+            spark, key_pairs, "db:coll", acc, self.dks_client, 10
+        )
+        self.assertEqual(
+            broadcast.value,
+            {f"key{i}_ciphertext": f"key{i}_plaintext" for i in range(3)},
+        )
+        self.assertEqual(post_mock.call_count, 3)
+        acc["run_stats"].add.assert_called_once_with(
+            {
+                "db:coll": {
+                    "dks": {"hits": 0, "misses": 3, "evictions": 0, "broadcast_keys": 3}
+                }
+            }
+        )
+
+    def test_prefetch_requires_io_encryption(self, post_mock):
+        spark = mock.MagicMock()
+        for conf in [{}, {"spark.io.encryption.enabled": "false"}]:
+            spark.sparkContext.getConf.return_value = conf
+            with self.assertRaises(ValueError):
+                prefetch_plaintext_keys(
+                    spark, [("<kek>", "key0_ciphertext")], "db:coll", {}, None, 10
+                )
+        spark.sparkContext.broadcast.assert_not_called()
+        post_mock.assert_not_called()
+
+
+@mock.patch("generate_dataset_from_hbase.decrypt_ciphertext", mock_decrypt_ciphertext)
+@mock.patch(
+    "generate_dataset_from_hbase.get_key_from_dks", side_effect=mock_get_key_from_dks
+)
+class TestRunStats(unittest.TestCase):
+    def accumulator(self):
+        param = RunStatsAccumulatorParam()
+        acc = mock.MagicMock()
+        acc.value = param.zero({})
+        acc.add.side_effect = lambda x: param.addInPlace(acc.value, x)
+        return acc
+
+    def test_partition_stats_match_record_stats(self, _):
+        cells = [
+            (f"row{i}", str(1000 + (i * 7) % 20), make_test_message(f"id{i}", "k", "o"))
+            for i in range(20)
+        ]
+        partition_acc, record_acc = self.accumulator(), self.accumulator()
+        for partition in [cells[:8], cells[8:]]:
+            list(
+                decrypt_partition(
+                    partition,
+                    "db:coll",
+                    {"run_stats": partition_acc},
+                    DksClient(url=None),
+                )
+            )
+        dks_client = DksClient(url=None)
+        for cell in cells:
+            process_cell(cell, "db:coll", {"run_stats": record_acc}, dks_client)
+
+        self.assertEqual(partition_acc.add.call_count, 2)
+        self.assertEqual(record_acc.add.call_count, 20)
+        partition_stats = partition_acc.value["db:coll"]
+        record_stats = record_acc.value["db:coll"]
+        self.assertGreater(partition_stats.pop("decrypt_seconds"), 0)
+        self.assertGreater(record_stats.pop("decrypt_seconds"), 0)
+        self.assertEqual(
+            partition_stats.pop("dks"), {"hits": 0, "misses": 2, "evictions": 0}
+        )
+        self.assertEqual(
+            record_stats.pop("dks"), {"hits": 19, "misses": 1, "evictions": 0}
+        )
+        self.assertEqual(partition_stats, record_stats)
+        self.assertEqual(partition_stats["record_count"], 20)
+        self.assertEqual(partition_stats["min_timestamp"], 1000)
+        self.assertEqual(partition_stats["max_timestamp"], 1019)
+
+    def test_run_summaries(self, _):
+        acc = self.accumulator()
+        acc.add({"db:empty": {"record_count": 0}, "db:coll": {"record_count": 0}})
+        acc.add({"db:coll": {"dks": {"hits": 0, "misses": 2, "evictions": 0}}})
+        acc.add(
+            {
+                "db:coll": {
+                    "record_count": 3,
+                    "min_timestamp": 5,
+                    "max_timestamp": 9,
+                    "input_bytes": 30,
+                    "output_bytes": 20,
+                    "dks": {"hits": 3, "misses": 0, "evictions": 1},
+                }
+            }
+        )
+        acc.add({"db:coll": {"record_count": 0, "min_timestamp": None}})
+        summaries = get_run_summaries(acc.value)
+        self.assertEqual(
+            summaries["db:coll"].dynamodb_values(),
+            {
+                "ProcessedDataEnd": 9,
+                "RecordCount": 3,
+                "InputBytes": 30,
+                "OutputBytes": 20,
+            },
+        )
+        self.assertEqual(summaries["db:coll"].min_timestamp, 5)
+        self.assertEqual(
+            summaries["db:coll"].dks_stats, {"hits": 3, "misses": 2, "evictions": 1}
+        )
+        self.assertEqual(
+            summaries["db:empty"].dynamodb_values(),
+            {
+                "ProcessedDataEnd": None,
+                "RecordCount": 0,
+                "InputBytes": 0,
+                "OutputBytes": 0,
+            },
+        )
+
+
+@unittest.skipUnless(pd, "pandas is required for the dataframe engine")
+@mock.patch("generate_dataset_from_hbase.decrypt_ciphertext", mock_decrypt_ciphertext)
+@mock.patch(
+    "generate_dataset_from_hbase.get_key_from_dks", side_effect=mock_get_key_from_dks
+)
+class TestDataFrameEngine(unittest.TestCase):
+    def setUp(self):
+        self.cells = [
+            (
+                f"row{i}",
+                str(1000 + i),
+                make_test_message(
+                    {"declarationId": f"id{i}"} if i % 2 else None,
+                    f"key{i % 3}_ciphertext",
+                    f'{{"a": "obj{i}, \\"quoted\\"\\n"}}_encrypted',
+                ),
+            )
+            for i in range(20)
+        ]
+
+    def get_batches(self):
+        columns = [pd.Series(column) for column in zip(*self.cells)]
+        return [[column[:8] for column in columns], [column[8:] for column in columns]]
+
+    def test_decrypt_batch_arrays(self, _):
+        batches = [
+            decrypt_batch(batch, "db:coll", mock.MagicMock(), DksClient(url=None))
+            for batch in self.get_batches()
+        ]
+        self.assertEqual([len(batch) for batch in batches], [8, 12])
+        self.assertEqual(batches[0][0][:2], ["", "1000"])
+        self.assertEqual(batches[0][1][0], "{'declarationId': 'id1'}")
+
+    def test_engines_produce_identical_output(self, _):
+        acc = mock.MagicMock()
+        rdd_lines = [
+            list_to_csv_str(row)
+            for row in decrypt_partition(
+                self.cells, "db:coll", acc, DksClient(url=None)
+            )
+        ]
+        dataframe_lines = []
+        for batch in self.get_batches():
+            records = pd.DataFrame(
+                list(decrypt_batch(batch, "db:coll", acc, DksClient(url=None))),
+                columns=["id", "record_timestamp", "record"],
+            ).astype({"record_timestamp": "int64"})
+            dataframe_lines.extend(
+                csv_batch(records["id"], records["record_timestamp"], records["record"])
+            )
+        self.assertEqual(dataframe_lines, rdd_lines)
+
+    def test_shell_line_batch(self, _):
+        lines = pd.Series(
+            ["ROW  COLUMN+CELL"] + [make_shell_line(*c) for c in self.cells]
+        )
+        cells = decrypt_batch([lines], "db:coll", mock.MagicMock(), DksClient(url=None))
+        self.assertEqual(len(cells), 21)
+        self.assertIsNone(cells[0])
+        self.assertEqual(cells[20][1], "1019")
+
+    def test_key_pair_batch(self, _):
+        pairs = {
+            tuple(pair)
+            for batch in self.get_batches()
+            for pair in key_pair_batch(batch)
+        }
+        self.assertEqual(pairs, {("<kek>", f"key{i}_ciphertext") for i in range(3)})
+
+
+class TestOutputFormats(unittest.TestCase):
+    def test_csv_table_sql(self):
+        sql = get_create_table_sql("db", "db_coll", "s3://bucket/prefix/db_coll")
+        self.assertIn("(id string, record_timestamp string, record string)", sql)
+        self.assertIn("OpenCSVSerde", sql)
+        self.assertIn("partitioned by (run string)", sql)
+        self.assertIn('stored as textfile location "s3://bucket/prefix/db_coll"', sql)
+
+    def test_columnar_table_sql(self):
+        for output_format in ["parquet", "orc"]:
+            sql = get_create_table_sql("db", "db_coll", "s3://b/p", output_format)
+            self.assertIn("(id string, record_timestamp bigint, record string)", sql)
+            self.assertIn(f'stored as {output_format} location "s3://b/p"', sql)
+            self.assertNotIn("SERDE", sql)
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_collection_prefix_per_format(self, _):
+        args = GetCollectionArgs(["db:coll"])
+        csv_collection = get_collections(args)[0]
+        args.output_format = "parquet"
+        parquet_collection = get_collections(args)[0]
+        self.assertEqual(
+            csv_collection["collection_output_prefix"], "folder1/folder2/db_coll"
+        )
+        self.assertEqual(
+            parquet_collection["collection_output_prefix"],
+            "folder1/folder2/db_coll_parquet",
+        )
+        self.assertEqual(parquet_collection["output_format"], "parquet")
+
+
+class TestOutputSizing(unittest.TestCase):
+    def test_output_partitions(self):
+        mb = 1024 * 1024
+        self.assertEqual(get_output_partitions(0), 1)
+        self.assertEqual(get_output_partitions(10 * mb), 1)
+        self.assertEqual(get_output_partitions(129 * mb), 2)
+        self.assertEqual(get_output_partitions(1280 * mb, target_file_mb=64), 20)
+        self.assertEqual(get_output_partitions(10 * mb, min_output_files=4), 4)
+        self.assertEqual(get_output_partitions(10**12, max_output_files=50), 50)
+
+    def process_collection(self, predicted_mb, input_partitions):
+        """Process a collection, returning the items of each repartitioned
+        RDD with the number of partitions it was given"""
+        reader = LocalHBaseReader([("<id1>", "100", "<record1>")])
+        collection = {
+            "hbase_table": "db:collection",
+            "hive_table": "db_collection",
+            "start_time": 100,
+            "output_bucket": "bucket",
+            "full_output_prefix": "prefix/db_collection/run",
+            "predicted_volume": predicted_mb * 1024 * 1024,
+        }
+        repartitioned = []
+
+        def repartition(rdd, partitions):
+            repartitioned.append((rdd.collect(), partitions))
+            return rdd
+
+        with mock.patch.object(
+            LocalRDD, "repartition", repartition, create=True
+        ), mock.patch.object(
+            LocalRDD, "getNumPartitions", lambda rdd: input_partitions
+        ):
+            process_collection(
+                collection, None, 200, mock.MagicMock(), reader, decrypt_mode="record"
+            )
+        return repartitioned
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    @mock.patch("generate_dataset_from_hbase.decrypt_message", mock_decrypt_message)
+    def test_process_collection_grows_partitions_before_decrypting(self, _):
+        self.assertEqual(
+            self.process_collection(300, 1), [([("<id1>", "100", "<record1>")], 3)]
+        )
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    @mock.patch("generate_dataset_from_hbase.decrypt_message", mock_decrypt_message)
+    def test_process_collection_shrinks_partitions_after_decrypting(self, _):
+        ((items, partitions),) = self.process_collection(10, 8)
+        self.assertEqual(partitions, 1)
+        self.assertNotEqual(items, [("<id1>", "100", "<record1>")])
+
+
+class TestCompaction(unittest.TestCase):
+    now = datetime.datetime(2024, 1, 3, 9, 0)
+
+    def setUp(self):
+        keys = [
+            "prefix/db_coll/20240101-0900/part-00000.lzo",
+            "prefix/db_coll/20240101-0900/_SUCCESS",
+            "prefix/db_coll/20240101-1500/part-00000.lzo",
+            "prefix/db_coll/20240102-0900/part-00000.lzo",
+            "prefix/db_coll/20240103-0900/part-00000.lzo",
+            "prefix/db_coll/daily-20231231/part-00000.lzo",
+            "prefix/db_coll/window-0-100/part-00000.lzo",
+            "prefix/db_coll/_backfill_checkpoint.json",
+        ]
+        self.objects = [{"Key": key, "Size": 100} for key in keys]
+
+    def test_compaction_period(self):
+        self.assertEqual(
+            get_compaction_period("20240103-1500"),
+            ("daily-20240103", datetime.datetime(2024, 1, 4)),
+        )
+        self.assertEqual(
+            get_compaction_period("20240103-1500", "weekly"),
+            ("weekly-20240101", datetime.datetime(2024, 1, 8)),
+        )
+        self.assertEqual(get_compaction_period("daily-20240103")[0], "daily-20240103")
+        self.assertIsNone(get_compaction_period("weekly-20240101"))
+        self.assertIsNone(get_compaction_period("window-0-100"))
+
+    def test_plan_compaction(self):
+        compact = plan_compaction(self.objects, "prefix/db_coll", "daily", self.now)
+        self.assertEqual(
+            {name: sorted(folders) for name, folders in compact.items()},
+            {
+                "daily-20231231": ["daily-20231231"],
+                "daily-20240101": ["20240101-0900", "20240101-1500"],
+                "daily-20240102": ["20240102-0900"],
+            },
+        )
+
+    @mock.patch("generate_dataset_from_hbase.rewrite_output")
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_compact_collection(self, _, rewrite_output):
+        s3_client = mock.MagicMock()
+        s3_client.get_paginator.return_value.paginate.side_effect = (
+            lambda Bucket, Prefix: [
+                {"Contents": [i for i in self.objects if i["Key"].startswith(Prefix)]}
+            ]
+        )
+        spark = mock.MagicMock()
+        # 20240102-0900 was written but never registered
+        spark.sql.return_value.collect.return_value = [
+            ["run=20240101-0900"],
+            ["run=20240101-1500"],
+            ["run=20240103-0900"],
+            ["run=daily-20231231"],
+        ]
+        collection = {
+            "hbase_table": "db:coll",
+            "hive_table": "db_coll",
+            "output_bucket": "bucket",
+            "collection_output_prefix": "prefix/db_coll",
+            "tags": {"pii": "true"},
+        }
+        compact_collection(spark, s3_client, "intraday", collection, now=self.now)
+
+        rewrite_output.assert_called_once_with(
+            spark,
+            [
+                "s3://bucket/prefix/db_coll/20240101-0900",
+                "s3://bucket/prefix/db_coll/20240101-1500",
+            ],
+            "s3://bucket/prefix/db_coll/daily-20240101",
+            "csv",
+            1,
+        )
+        self.assertEqual(
+            [call[0][0] for call in spark.sql.call_args_list[1:]],
+            [
+                "alter table intraday.db_coll add if not exists partition "
+                "(run='daily-20240101') location "
+                "'s3://bucket/prefix/db_coll/daily-20240101'",
+                "alter table intraday.db_coll drop if exists "
+                "partition (run='20240101-0900'), partition (run='20240101-1500')",
+            ],
+        )
+        deleted = [
+            i["Key"]
+            for call in s3_client.delete_objects.call_args_list
+            for i in call[1]["Delete"]["Objects"]
+        ]
+        self.assertEqual(
+            sorted(deleted),
+            [
+                "prefix/db_coll/20240101-0900/_SUCCESS",
+                "prefix/db_coll/20240101-0900/part-00000.lzo",
+                "prefix/db_coll/20240101-1500/part-00000.lzo",
+            ],
+        )
+
+    @mock.patch("generate_dataset_from_hbase.rewrite_output")
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_compact_collection_completes_interrupted_switch(self, _, rewrite_output):
+        self.objects.append(
+            {"Key": "prefix/db_coll/daily-20240101/part-00000.lzo", "Size": 100}
+        )
+        s3_client = mock.MagicMock()
+        s3_client.get_paginator.return_value.paginate.side_effect = (
+            lambda Bucket, Prefix: [
+                {"Contents": [i for i in self.objects if i["Key"].startswith(Prefix)]}
+            ]
+        )
+        spark = mock.MagicMock()
+        # daily-20240101 was added, but its runs were not dropped
+        spark.sql.return_value.collect.return_value = [
+            ["run=20240101-0900"],
+            ["run=20240101-1500"],
+            ["run=daily-20240101"],
+            ["run=daily-20231231"],
+        ]
+        collection = {
+            "hbase_table": "db:coll",
+            "hive_table": "db_coll",
+            "output_bucket": "bucket",
+            "collection_output_prefix": "prefix/db_coll",
+        }
+        compact_collection(spark, s3_client, "intraday", collection, now=self.now)
+
+        rewrite_output.assert_not_called()
+        self.assertEqual(
+            [call[0][0] for call in spark.sql.call_args_list[1:]],
+            [
+                "alter table intraday.db_coll drop if exists "
+                "partition (run='20240101-0900'), partition (run='20240101-1500')",
+            ],
+        )
+        deleted = [
+            i["Key"]
+            for call in s3_client.delete_objects.call_args_list
+            for i in call[1]["Delete"]["Objects"]
+        ]
+        self.assertEqual(
+            sorted(deleted),
+            [
+                "prefix/db_coll/20240101-0900/_SUCCESS",
+                "prefix/db_coll/20240101-0900/part-00000.lzo",
+                "prefix/db_coll/20240101-1500/part-00000.lzo",
+            ],
+        )
+
+
+class TestHiveTables(unittest.TestCase):
+    def setUp(self):
+        self.collection = {
+            "hbase_table": "db:coll",
+            "hive_table": "db_coll",
+            "output_bucket": "bucket",
+            "collection_output_prefix": "prefix/db_coll",
+            "full_output_prefix": "prefix/db_coll/20240103-0900",
+        }
+        self.s3_client = mock.MagicMock()
+        self.s3_client.get_paginator.return_value.paginate.return_value = [
+            {
+                "CommonPrefixes": [
+                    {"Prefix": "prefix/db_coll/20240101-0900/"},
+                    {"Prefix": "prefix/db_coll/20240103-0900/"},
+                    {"Prefix": "prefix/db_coll/_tmp/"},
+                ]
+            }
+        ]
+        self.spark = mock.MagicMock()
+
+    def get_statements(self):
+        return [" ".join(call[0][0].split()) for call in self.spark.sql.call_args_list]
+
+    def list_tables(self, **comments):
+        tables = []
+        for name, comment in comments.items():
+            # name is a Mock constructor argument, so is set afterwards
+            table = mock.Mock(description=comment)
+            table.name = name
+            tables.append(table)
+        self.spark.catalog.listTables.return_value = tables
+
+    def get_comments(self, snapshot=False):
+        return {
+            "db_coll": get_ddl_comment(
+                get_create_table_sql("db", "db_coll", "s3://bucket/prefix/db_coll")
+            ),
+            "v_db_coll_latest": get_ddl_comment(
+                get_create_latest_view_sql("db", "db_coll", snapshot)
+            ),
+        }
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_unchanged_ddl_only_registers_run(self, _):
+        self.list_tables(**self.get_comments())
+        create_hive_table(self.spark, "db", self.collection, self.s3_client)
+        self.assertEqual(
+            self.get_statements(),
+            [
+                "create database if not exists db",
+                "alter table db.db_coll add if not exists partition "
+                "(run='20240103-0900') location "
+                "'s3://bucket/prefix/db_coll/20240103-0900'",
+            ],
+        )
+        self.s3_client.get_paginator.assert_not_called()
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_snapshot_marked_stale_by_runs_not_merging(self, _):
+        comments = self.get_comments(snapshot=True)
+        self.list_tables(db_coll_latest=None, **comments)
+        self.spark.sql.return_value.collect.return_value = [("id_buckets", "4")]
+        create_hive_table(self.spark, "db", self.collection, self.s3_client)
+        statements = self.get_statements()
+        self.assertEqual(
+            statements[1:4],
+            [
+                "show tblproperties db.db_coll_latest",
+                "alter table db.db_coll_latest set tblproperties ('stale'='true')",
+                "alter table db.db_coll add if not exists partition "
+                "(run='20240103-0900') location "
+                "'s3://bucket/prefix/db_coll/20240103-0900'",
+            ],
+        )
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_changed_view_is_replaced(self, _):
+        self.list_tables(**self.get_comments(snapshot=True))
+        create_hive_table(self.spark, "db", self.collection, self.s3_client)
+        statements = self.get_statements()
+        self.assertEqual(len(statements), 3)
+        self.assertTrue(
+            statements[-1].startswith(
+                "create or replace view db.v_db_coll_latest comment 'ddl:"
+            )
+        )
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_recreates_table_from_other_ddl(self, _):
+        self.list_tables(db_coll=None, v_db_coll_latest=None)
+        create_hive_table(self.spark, "db", self.collection, self.s3_client)
+        statements = self.get_statements()
+        self.assertEqual(statements[1], "drop table if exists db.db_coll")
+        self.assertIn("comment 'ddl:", statements[2])
+        self.assertEqual(
+            statements[3],
+            "alter table db.db_coll add if not exists "
+            "partition (run='20240101-0900') "
+            "location 's3://bucket/prefix/db_coll/20240101-0900' "
+            "partition (run='20240103-0900') "
+            "location 's3://bucket/prefix/db_coll/20240103-0900'",
+        )
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_metastore_read_once(self, _):
+        self.list_tables()
+        metastore = MetastoreSync(self.spark, "db")
+        for _ in range(3):
+            create_hive_table(
+                self.spark, "db", self.collection, self.s3_client, metastore
+            )
+        self.spark.catalog.listTables.assert_called_once_with("db")
+        self.assertEqual(
+            sum(i.startswith("create external table") for i in self.get_statements()),
+            1,
+        )
+
+
+class TestBackfillWindows(unittest.TestCase):
+    def setUp(self):
+        self.collection = {
+            "hbase_table": "db:coll",
+            "hive_table": "db_coll",
+            "output_bucket": "bucket",
+            "collection_output_prefix": "prefix/db_coll",
+            "windows": [(0, 100), (100, 200), (200, 250)],
+        }
+        self.s3_client = mock.MagicMock()
+        self.s3_client.get_paginator.return_value.paginate.return_value = []
+        self.processed = []
+
+    def process_collection(self, collection_info, end_time, **kwargs):
+        self.processed.append((collection_info["start_time"], end_time))
+        self.assertEqual(kwargs["s3_tagging"], "on_write")
+        collection_info["durations"]["write"] = 1.5
+        collection_info["part_files"] = 2
+        return collection_info
+
+    def test_time_windows(self):
+        self.assertEqual(
+            get_time_windows(0, 250, 100), [(0, 100), (100, 200), (200, 250)]
+        )
+        self.assertEqual(get_time_windows(0, 100, 100), [(0, 100)])
+
+    def test_remaining_windows(self):
+        windows = [(0, 100), (100, 200), (200, 300)]
+        self.assertEqual(get_remaining_windows(windows, set()), windows)
+        self.assertEqual(
+            get_remaining_windows(windows, {(0, 100), (200, 250)}),
+            [(100, 200), (250, 300)],
+        )
+        self.assertEqual(
+            get_remaining_windows(windows, {(50, 150), (260, 270)}),
+            [(0, 50), (150, 200), (200, 260), (270, 300)],
+        )
+        self.assertEqual(get_remaining_windows(windows, {(0, 300)}), [])
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_manual_collections_windowed(self, _):
+        args = GetCollectionArgs(["db:coll"])
+        args.job_type = "manual"
+        args.start_time, args.end_time, args.window_ms = 0, 250, 100
+        collection = get_collections(args)[0]
+        self.assertEqual(collection["windows"], [(0, 100), (100, 200), (200, 250)])
+        self.assertFalse(collection["restart_backfill"])
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_resume_from_checkpoint(self, _):
+        self.s3_client.get_object.return_value = {
+            "Body": mock.Mock(read=lambda: '{"completed_windows": [[0, 100]]}')
+        }
+        reader = mock.MagicMock()
+        with mock.patch(
+            "generate_dataset_from_hbase.process_collection", self.process_collection
+        ):
+            process_windows(
+                self.collection, self.s3_client, hbase_reader=reader, end_time=250
+            )
+        self.assertEqual(sorted(self.processed), [(100, 200), (200, 250)])
+        self.assertEqual(reader.cleanup.call_count, 2)
+        checkpoint = self.s3_client.put_object.call_args_list[-1][1]
+        self.assertEqual(checkpoint["Key"], "prefix/db_coll/_backfill_checkpoint.json")
+        self.assertEqual(
+            json.loads(checkpoint["Body"]),
+            {"completed_windows": [[0, 100], [100, 200], [200, 250]]},
+        )
+        self.assertEqual(self.collection["durations"], {"write": 3.0})
+        self.assertEqual(self.collection["part_files"], 4)
+        self.assertEqual(
+            self.collection["run_folders"],
+            ["window-0-100", "window-100-200", "window-200-250"],
+        )
+        self.assertTrue(self.collection["tagged"])
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_rerun_with_later_end_time(self, _):
+        self.s3_client.get_object.return_value = {
+            "Body": mock.Mock(
+                read=lambda: '{"completed_windows": [[0, 100], [100, 200], [200, 250]]}'
+            )
+        }
+        self.collection["windows"] = get_time_windows(0, 320, 100)
+        with mock.patch(
+            "generate_dataset_from_hbase.process_collection", self.process_collection
+        ):
+            process_windows(self.collection, self.s3_client, hbase_reader=mock.Mock())
+        self.assertEqual(sorted(self.processed), [(250, 300), (300, 320)])
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_restart_ignores_checkpoint(self, _):
+        self.collection["restart_backfill"] = True
+        with mock.patch(
+            "generate_dataset_from_hbase.process_collection", self.process_collection
+        ):
+            process_windows(self.collection, self.s3_client, hbase_reader=mock.Mock())
+        self.assertEqual(sorted(self.processed), self.collection["windows"])
+        self.s3_client.get_object.assert_not_called()
+        self.s3_client.delete_objects.assert_any_call(
+            Bucket="bucket",
+            Delete={"Objects": [{"Key": "prefix/db_coll/_backfill_checkpoint.json"}]},
+        )
+
+    @mock.patch("generate_dataset_from_hbase.create_hive_table")
+    @mock.patch("generate_dataset_from_hbase.process_windows")
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_checkpoint_deleted_once_registered(self, _, process, ddl):
+        collections = [
+            dict(self.collection, hbase_table=f"db:coll{i}", hive_table=f"db_coll{i}")
+            for i in range(2)
+        ]
+        process.side_effect = lambda collection_info, **kwargs: collection_info
+        for collection in collections:
+            collection["tagged"] = True
+
+        def create_hive_table(spark, database_name, collection, *args):
+            if collection["hbase_table"] == "db:coll1":
+                raise ValueError("metastore unavailable")
+
+        ddl.side_effect = create_hive_table
+        main(mock.MagicMock(), 250, "db", collections, self.s3_client, {})
+        # the failed collection keeps its checkpoint to resume from
+        self.s3_client.delete_objects.assert_called_once_with(
+            Bucket="bucket",
+            Delete={"Objects": [{"Key": "prefix/db_coll/_backfill_checkpoint.json"}]},
+        )
+
+    @mock.patch("generate_dataset_from_hbase.os.system")
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_first_run_clears_partial_windows(self, _, system):
+        self.s3_client.get_object.side_effect = botocore.exceptions.ClientError(
+            {"Error": {"Code": "NoSuchKey"}}, "GetObject"
+        )
+        self.s3_client.get_paginator.return_value.paginate.side_effect = (
+            lambda Bucket, Prefix: [{"Contents": [{"Key": Prefix + "part-00000"}]}]
+        )
+        with mock.patch(
+            "generate_dataset_from_hbase.process_collection", self.process_collection
+        ):
+            process_windows(self.collection, self.s3_client)
+        self.assertEqual(len(self.processed), 3)
+        deleted = sorted(
+            call[1]["Delete"]["Objects"][0]["Key"]
+            for call in self.s3_client.delete_objects.call_args_list
+        )
+        self.assertEqual(
+            deleted,
+            [
+                "prefix/db_coll/window-0-100/part-00000",
+                "prefix/db_coll/window-100-200/part-00000",
+                "prefix/db_coll/window-200-250/part-00000",
+            ],
+        )
+        system.assert_any_call("hdfs dfs -rm -r -f -skipTrash hdfs:///db_coll-100")
+
+
+@mock.patch("generate_dataset_from_hbase._logger", create=True)
+class TestFailureIsolation(unittest.TestCase):
+    def setUp(self):
+        self.collections = [
+            {"hbase_table": f"db:coll{i}", "hive_table": f"db_coll{i}"}
+            for i in range(3)
+        ]
+
+    @mock.patch("generate_dataset_from_hbase.create_hive_table")
+    @mock.patch("generate_dataset_from_hbase.tag_s3_objects")
+    @mock.patch("generate_dataset_from_hbase.process_collection")
+    def test_failed_collection_does_not_fail_others(self, process, tag, ddl, _):
+        def process_collection(collection_info, **kwargs):
+            if collection_info["hbase_table"] == "db:coll1":
+                raise ValueError("decrypt failed")
+            return collection_info
+
+        def tag_s3_objects(s3_client, collection, max_workers):
+            if collection["hbase_table"] == "db:coll2":
+                raise ValueError("access denied")
+
+        process.side_effect = process_collection
+        tag.side_effect = tag_s3_objects
+        collections = main(mock.MagicMock(), 200, "db", self.collections, None, {})
+        self.assertNotIn("error", collections[0])
+        self.assertEqual(collections[1]["error"], "process: decrypt failed")
+        self.assertEqual(collections[2]["error"], "tag: access denied")
+        self.assertEqual(tag.call_count, 2)
+        ddl.assert_called_once_with(mock.ANY, "db", collections[0], None, mock.ANY)
+
+    def test_run_status(self, _):
+        self.assertEqual(get_run_status(self.collections), "SUCCEEDED")
+        self.collections[1]["error"] = "process: decrypt failed"
+        self.assertEqual(get_run_status(self.collections), "PARTIALLY_SUCCEEDED")
+        for collection in self.collections:
+            collection["error"] = "process: decrypt failed"
+        with self.assertRaises(RuntimeError):
+            get_run_status(self.collections)
+
+
+class TestScheduler(unittest.TestCase):
+    def test_predicted_volume(self):
+        job_table = mock.MagicMock()
+        job_table.query.return_value = {
+            "Items": [{"InputBytes": 100}, {"InputBytes": 300}, {"InputBytes": 999}],
+            "Count": 3,
+        }
+        self.assertEqual(get_predicted_volume("db:coll", job_table, runs=2), 200)
+        job_table.query.return_value = {"Items": [], "Count": 0}
+        self.assertEqual(get_predicted_volume("db:coll", job_table), 0)
+
+    def test_largest_collections_first(self):
+        collections = [
+            {"hive_table": "db_small", "predicted_volume": 10},
+            {"hive_table": "db_new"},
+            {"hive_table": "db_large", "predicted_volume": 1000},
+            {"hive_table": "db_medium", "predicted_volume": 100},
+        ]
+        schedule = schedule_collections(collections)
+        self.assertEqual(
+            [i["hive_table"] for i in schedule],
+            ["db_large", "db_medium", "db_small", "db_new"],
+        )
+
+
+class TestRunHistory(unittest.TestCase):
+    def test_run_history_items(self):
+        collections = [
+            {
+                "hbase_table": "db:coll",
+                "start_time": 100,
+                "part_files": 3,
+                "durations": {"extract": 1.5, "write": 10.25, "tag": 0.5, "ddl": 2},
+            },
+            {"hbase_table": "db:empty", "start_time": 100},
+        ]
+        summaries = get_run_summaries(
+            {
+                "db:coll": {
+                    "record_count": 3,
+                    "max_timestamp": 200,
+                    "input_bytes": 30,
+                    "output_bytes": 20,
+                    "decrypt_seconds": 0.0125,
+                    "dks": {"hits": 1, "misses": 2, "evictions": 0},
+                },
+                "db:empty": {"record_count": 0},
+            }
+        )
+        items = get_run_history_items(
+            collections, summaries, "corr-1", "scheduled", 1000
+        )
+        self.assertEqual(
+            items[0],
+            {
+                "Collection": "db:coll",
+                "TriggeredTime": 1000,
+                "CorrelationId": "corr-1",
+                "JobType": "scheduled",
+                "ProcessedDataStart": 100,
+                "ProcessedDataEnd": 200,
+                "RecordCount": 3,
+                "InputBytes": 30,
+                "OutputBytes": 20,
+                "PartFiles": 3,
+                "DksCalls": 2,
+                "DecryptMs": 12,
+                "ExtractMs": 1500,
+                "WriteMs": 10250,
+                "TagMs": 500,
+                "DdlMs": 2000,
+            },
+        )
+        self.assertNotIn("ProcessedDataEnd", items[1])
+        self.assertEqual(items[1]["RecordCount"], 0)
+
+    def test_run_history_query(self):
+        history_table = mock.MagicMock()
+        history_table.query.side_effect = [
+            {
+                "Items": [{"InputBytes": 100 + i} for i in range(5)],
+                "LastEvaluatedKey": {"k": 1},
+            },
+            {"Items": [{"InputBytes": 200 + i} for i in range(5)]},
+        ]
+        items = get_run_history(history_table, "db:coll", since=1000)
+        self.assertEqual(len(items), 10)
+        self.assertEqual(
+            history_table.query.call_args.kwargs["ExclusiveStartKey"], {"k": 1}
+        )
+        self.assertAlmostEqual(get_volume_growth(items), 1010 / 510)
+        self.assertIsNone(get_volume_growth(items[:9]))
+
+
+class TestJobStatusWrites(unittest.TestCase):
+    def setUp(self):
+        self.table = mock.MagicMock()
+        self.table.name = "intraday-job-status"
+        # mock call counts are not thread safe, so record calls in lists
+        self.requests = []
+        self.attempts = []
+        self.errors = {}
+
+        def update_item(**request):
+            collection = request["Key"]["Collection"]["S"]
+            self.attempts.append(collection)
+            error = self.errors.get(collection, [])
+            if error:
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": error.pop(0)}}, "UpdateItem"
+                )
+            self.requests.append(request)
+
+        self.table.meta.client.update_item.side_effect = update_item
+
+    @mock.patch("generate_dataset_from_hbase.time.sleep")
+    def test_updates_each_collection(self, _):
+        update_db_items_concurrently(
+            self.table,
+            "corr-1",
+            {
+                f"db:coll{i}": {"JobStatus": "EMR_COMPLETED", "ProcessedDataEnd": i}
+                for i in range(50)
+            },
+        )
+        self.assertEqual(len(self.requests), 50)
+        request = next(
+            i for i in self.requests if i["Key"]["Collection"] == {"S": "db:coll7"}
+        )
+        self.assertEqual(
+            request,
+            {
+                "TableName": "intraday-job-status",
+                "Key": {
+                    "CorrelationId": {"S": "corr-1"},
+                    "Collection": {"S": "db:coll7"},
+                },
+                "AttributeUpdates": {
+                    "JobStatus": {"Value": {"S": "EMR_COMPLETED"}, "Action": "PUT"},
+                    "ProcessedDataEnd": {"Value": {"N": "7"}, "Action": "PUT"},
+                    "IsActive": {"Action": "DELETE"},
+                    "ExpiresAt": {"Value": {"N": mock.ANY}, "Action": "PUT"},
+                },
+            },
+        )
+        expires_at = int(request["AttributeUpdates"]["ExpiresAt"]["Value"]["N"])
+        self.assertAlmostEqual(expires_at, time.time() + 90 * 86400, delta=60)
+
+    def test_active_flag_follows_job_status(self):
+        update_db_items_concurrently(
+            self.table,
+            "corr-1",
+            {
+                "db:processing": {"JobStatus": "EMR_PROCESSING"},
+                "db:failed": {"JobStatus": "EMR_FAILED"},
+                "db:start": {"ProcessedDataStart": 1},
+            },
+        )
+        updates = {
+            i["Key"]["Collection"]["S"]: i["AttributeUpdates"] for i in self.requests
+        }
+        for collection in ["db:processing", "db:failed"]:
+            self.assertEqual(
+                updates[collection]["IsActive"],
+                {"Value": {"S": "true"}, "Action": "PUT"},
+            )
+            self.assertNotIn("ExpiresAt", updates[collection])
+        self.assertNotIn("IsActive", updates["db:start"])
+
+    @mock.patch("generate_dataset_from_hbase.time.sleep")
+    def test_retries_throttled_items_only(self, sleep_mock):
+        self.errors = {
+            "db:throttled": [
+                "ProvisionedThroughputExceededException",
+                "ThrottlingException",
+            ]
+        }
+        update_db_items_concurrently(
+            self.table,
+            "corr-1",
+            {"db:throttled": {"ProcessedDataEnd": None}, "db:ok": {"RecordCount": 1}},
+        )
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(len(self.attempts), 4)
+        self.assertEqual(sleep_mock.call_count, 2)
+        self.assertIn(
+            {"Value": {"NULL": True}, "Action": "PUT"},
+            [i["AttributeUpdates"].get("ProcessedDataEnd") for i in self.requests],
+        )
+
+        self.errors = {"db:invalid": ["ValidationException"]}
+        with self.assertRaises(botocore.exceptions.ClientError):
+            update_db_items_concurrently(
+                self.table, "corr-1", {"db:invalid": {"RecordCount": 1}}
+            )
+
+    def test_release_leases(self):
+        def update_item(**request):
+            self.requests.append(request)
+            if request["Key"]["Collection"]["S"] == "db:taken":
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "ConditionalCheckFailedException"}},
+                    "UpdateItem",
+                )
+
+        self.table.meta.client.update_item.side_effect = update_item
+        release_leases(
+            self.table,
+            "corr-1",
+            [{"hbase_table": "db:held"}, {"hbase_table": "db:taken"}],
+        )
+        self.assertEqual(len(self.requests), 2)
+        for request in self.requests:
+            self.assertEqual(request["Key"]["CorrelationId"], {"S": "LEASE"})
+            self.assertEqual(request["ConditionExpression"], "LeaseOwner = :owner")
+            self.assertEqual(
+                request["ExpressionAttributeValues"], {":owner": {"S": "corr-1"}}
+            )
+
+    def fail_leases(self, *collections):
+        def update_item(**request):
+            self.requests.append(request)
+            key = request["Key"]
+            if key["CorrelationId"]["S"] == "LEASE" and key["Collection"]["S"] in (
+                collections
+            ):
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "ConditionalCheckFailedException"}},
+                    "UpdateItem",
+                )
+
+        self.table.meta.client.update_item.side_effect = update_item
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_defer_unleased_collections(self, _):
+        self.fail_leases("db:taken")
+        collections = [{"hbase_table": "db:held"}, {"hbase_table": "db:taken"}]
+        self.assertEqual(
+            defer_unleased_collections(self.table, "corr-1", collections, 60),
+            [{"hbase_table": "db:held"}],
+        )
+        leases = [i for i in self.requests if i["Key"]["CorrelationId"]["S"] == "LEASE"]
+        self.assertEqual(len(leases), 2)
+        for request in leases:
+            self.assertEqual(request["ConditionExpression"], "LeaseOwner = :owner")
+            self.assertEqual(
+                request["ExpressionAttributeValues"][":owner"], {"S": "corr-1"}
+            )
+        (deferred,) = [i for i in self.requests if "AttributeUpdates" in i]
+        self.assertEqual(deferred["Key"]["Collection"], {"S": "db:taken"})
+        self.assertEqual(
+            deferred["AttributeUpdates"]["JobStatus"]["Value"], {"S": "DEFERRED"}
+        )
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_renewing_leases_stops_lost_collections(self, _):
+        self.fail_leases("db:taken")
+        collections = [{"hbase_table": "db:held"}, {"hbase_table": "db:taken"}]
+        with renewing_leases(self.table, "corr-1", collections, interval_seconds=0.01):
+            while not collections[1].get("lease_lost"):
+                time.sleep(0.01)
+        self.assertNotIn("lease_lost", collections[0])
+        processed = run_isolated(lambda i: None, collections, "process")
+        self.assertEqual(processed, [collections[0]])
+        self.assertIn("lease lost", collections[1]["error"])
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_renewing_leases_stops_collections_when_renewals_fail(self, _):
+        self.errors = {"db:coll": ["InternalServerError"] * 100}
+        collections = [{"hbase_table": "db:coll"}]
+        with renewing_leases(
+            self.table, "corr-1", collections, duration_minutes=0, interval_seconds=0.01
+        ):
+            while not collections[0].get("lease_lost"):
+                time.sleep(0.01)
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_renewing_leases_not_renewed_on_entry(self, _):
+        with renewing_leases(
+            self.table, "corr-1", [{"hbase_table": "db:coll"}], interval_seconds=3600
+        ):
+            pass
+        self.assertEqual(self.attempts, [])
+
+    def test_update_watermarks(self):
+        self.errors = {"db:behind": ["ConditionalCheckFailedException"]}
+        update_watermarks(
+            self.table,
+            [
+                {"hbase_table": "db:records", "start_time": 101},
+                {"hbase_table": "db:empty", "start_time": 101},
+                {"hbase_table": "db:behind", "start_time": 101},
+            ],
+            {
+                "db:records": CollectionRunSummary(
+                    "db:records", {"max_timestamp": 150}
+                ),
+                "db:empty": CollectionRunSummary("db:empty"),
+            },
+        )
+        ends = {
+            i["Key"]["Collection"]["S"]: i["ExpressionAttributeValues"][":end"]
+            for i in self.requests
+        }
+        self.assertEqual(ends, {"db:records": {"N": "150"}, "db:empty": {"N": "100"}})
+        for request in self.requests:
+            self.assertEqual(request["Key"]["CorrelationId"], {"S": "WATERMARK"})
+            self.assertNotIn("ExpiresAt", request["UpdateExpression"])
+            self.assertIn("ProcessedDataEnd < :end", request["ConditionExpression"])
+
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_last_processed_from_watermark(self, _):
+        job_table = mock.MagicMock()
+        job_table.get_item.return_value = {
+            "Item": {"CorrelationId": "WATERMARK", "ProcessedDataEnd": 150}
+        }
+        self.assertEqual(get_last_processed_dynamodb("db:coll", job_table), 150)
+        job_table.get_item.assert_called_once_with(
+            Key={"CorrelationId": "WATERMARK", "Collection": "db:coll"}
+        )
+        job_table.query.assert_not_called()
+
+        # collections completed before watermarks were kept use their last job
+        job_table.get_item.return_value = {}
+        job_table.query.return_value = {
+            "Items": [{"ProcessedDataEnd": 120}],
+            "Count": 1,
+        }
+        self.assertEqual(get_last_processed_dynamodb("db:coll", job_table), 120)
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.tmp_dir.name, "step.log")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def read_lines(self):
+        with open(self.log_path) as log_file:
+            return [json.loads(line) for line in log_file]
+
+    def test_timer_emits_embedded_metric_format(self):
+        metrics = MetricsLogger(self.log_path, dimensions={"CorrelationId": "c-1"})
+        collection = {"hbase_table": "db:coll"}
+        with metrics.timer("extract", collection):
+            pass
+        with metrics.timer("dynamodb_update"):
+            pass
+        metrics.put_metrics(
+            {"RecordCount": (3, "Count"), "InputBytes": (30, "Bytes")}, "db:coll"
+        )
+
+        extract, update, counters = self.read_lines()
+        self.assertEqual(
+            extract["_aws"]["CloudWatchMetrics"],
+            [
+                {
+                    "Namespace": "IntradayReplica",
+                    "Dimensions": [["CorrelationId", "Collection"]],
+                    "Metrics": [{"Name": "ExtractTime", "Unit": "Milliseconds"}],
+                }
+            ],
+        )
+        self.assertEqual(extract["Collection"], "db:coll")
+        self.assertEqual(extract["CorrelationId"], "c-1")
+        self.assertAlmostEqual(
+            extract["ExtractTime"], collection["durations"]["extract"] * 1000
+        )
+        self.assertEqual(
+            update["_aws"]["CloudWatchMetrics"][0]["Dimensions"], [["CorrelationId"]]
+        )
+        self.assertIn("DynamodbUpdateTime", update)
+        self.assertEqual((counters["RecordCount"], counters["InputBytes"]), (3, 30))
+
+    def test_null_sink(self):
+        with MetricsLogger().timer("extract"):
+            pass
+        self.assertFalse(os.path.exists(self.log_path))
+
+    def test_log_lines_are_json(self):
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        try:
+            logger = setup_logging("INFO", self.log_path)
+            logger.info("it's a 'quoted' \"message\"")
+            logger.error("failed", extra={"Exception": ValueError("bad")})
+            for handler in logger.handlers:
+                handler.flush()
+        finally:
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+                handler.close()
+            for handler in handlers:
+                root.addHandler(handler)
+            root.setLevel(level)
+
+        info, error = self.read_lines()
+        self.assertEqual(info["message"], "it's a 'quoted' \"message\"")
+        self.assertEqual(info["log_level"], "INFO")
+        self.assertEqual(error["Exception"], "bad")
+
+
+class TestLatestSnapshot(unittest.TestCase):
+    def test_row_number_view(self):
+        sql = get_create_latest_view_sql("db", "db_coll")
+        self.assertIn("create or replace view db.v_db_coll_latest as", sql)
+        self.assertIn("row_number()", sql)
+        self.assertIn("from db.db_coll)", sql)
+
+    def test_snapshot_view(self):
+        sql = " ".join(get_create_latest_view_sql("db", "db_coll", True).split())
+        self.assertEqual(
+            sql,
+            "create or replace view db.v_db_coll_latest as select id,"
+            " cast(record_timestamp as string) record_timestamp, record"
+            " from db.db_coll_latest",
+        )
+        sql = " ".join(
+            get_create_latest_view_sql("db", "db_coll", True, "parquet").split()
+        )
+        self.assertIn("select id, record_timestamp, record", sql)
+
+    def test_snapshot_partition_sql(self):
+        statements = get_snapshot_partition_sql(
+            "db.db_coll_latest",
+            {
+                3: "s3://b/run/id_bucket=3",
+                1: "s3://b/run/id_bucket=1",
+                2: "s3://b/run/id_bucket=2",
+            },
+            existing={1, 5},
+        )
+        self.assertEqual(
+            statements,
+            [
+                "alter table db.db_coll_latest add if not exists"
+                " partition (id_bucket=2) location 's3://b/run/id_bucket=2'"
+                " partition (id_bucket=3) location 's3://b/run/id_bucket=3'",
+                "alter table db.db_coll_latest partition (id_bucket=1)"
+                " set location 's3://b/run/id_bucket=1'",
+            ],
+        )
+
+    def test_superseded_snapshot_keys(self):
+        keys = [
+            "p/db_coll_latest/run1/_SUCCESS",
+            "p/db_coll_latest/run1/id_bucket=1/part-00000.parquet",
+            "p/db_coll_latest/run1/id_bucket=2/part-00000.parquet",
+            "p/db_coll_latest/run2/id_bucket=1/part-00000.parquet",
+            "p/db_coll_latest/run3/id_bucket=1/part-00000.parquet",
+        ]
+        self.assertEqual(
+            get_superseded_snapshot_keys(
+                [{"Key": key} for key in keys], "p/db_coll_latest", "run3", {1}
+            ),
+            [
+                "p/db_coll_latest/run1/id_bucket=1/part-00000.parquet",
+                "p/db_coll_latest/run2/id_bucket=1/part-00000.parquet",
+            ],
+        )
+
+    def update_snapshot(self, properties, partitions, buckets=4):
+        """Run update_latest_snapshot against a snapshot table with the given
+        properties and id_bucket partitions, returning the statements run,
+        the spark session and the S3 client"""
+        spark = mock.MagicMock()
+        statements = []
+        results = {"show partitions": [[f"id_bucket={i}"] for i in partitions]}
+
+        def sql(statement):
+            statements.append(" ".join(statement.split()))
+            result = mock.MagicMock()
+            result.collect.return_value = next(
+                (v for k, v in results.items() if statement.startswith(k)), []
+            )
+            return result
+
+        spark.sql.side_effect = sql
+        spark.table.return_value.where.return_value.unionByName.return_value = (
+            mock.MagicMock()
+        )
+        self.keys = [
+            "p/db_coll_latest/run1/id_bucket=1/part-00000.parquet",
+            "p/db_coll_latest/run1/id_bucket=3/part-00000.parquet",
+            "p/db_coll_latest/run2/id_bucket=1/part-00000.parquet",
+            "p/db_coll_latest/run2/id_bucket=2/part-00000.parquet",
+        ]
+        s3_client = mock.MagicMock()
+        s3_client.get_paginator.return_value.paginate.side_effect = (
+            lambda Bucket, Prefix, Delimiter=None: [
+                (
+                    {
+                        "CommonPrefixes": [
+                            {"Prefix": f"{Prefix}id_bucket={i}/"} for i in [1, 2]
+                        ]
+                    }
+                    if Delimiter
+                    else {"Contents": [{"Key": key} for key in self.keys]}
+                )
+            ]
+        )
+        collection = {
+            "hive_table": "db_coll",
+            "output_bucket": "b",
+            "collection_output_prefix": "p/db_coll",
+            "full_output_prefix": "p/db_coll/run2",
+            "latest_snapshot_buckets": buckets,
+            "latest_delta": mock.MagicMock(),
+        }
+        delta = collection["latest_delta"].select.return_value
+        delta.select.return_value.distinct.return_value.collect.return_value = [
+            mock.Mock(id_bucket=1),
+            mock.Mock(id_bucket=2),
+        ]
+        update_latest_snapshot(spark, "db", collection, s3_client, properties)
+        return statements, spark, s3_client
+
+    def get_deleted(self, s3_client):
+        return [
+            i["Key"]
+            for call in s3_client.delete_objects.call_args_list
+            for i in call[1]["Delete"]["Objects"]
+        ]
+
+    @mock.patch("generate_dataset_from_hbase.get_latest_records")
+    @mock.patch("generate_dataset_from_hbase.F")
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_snapshot_without_partitions_is_rebuilt(self, _, functions, latest):
+        # a first build created the table, then failed before any partitions
+        statements, spark, s3_client = self.update_snapshot({"id_buckets": "4"}, [])
+
+        spark.table.assert_called_once_with("db.db_coll")
+        latest.return_value.write.mode.assert_called_once_with("overwrite")
+        self.assertEqual(statements[1], "drop table if exists db.db_coll_latest")
+        self.assertTrue(statements[2].startswith("create external table"))
+        self.assertIn(
+            "tblproperties ( 'id_buckets'='4', 'stale'='false' )", statements[2]
+        )
+        self.assertEqual(
+            statements[3:],
+            [
+                "alter table db.db_coll_latest add if not exists"
+                " partition (id_bucket=1) location 's3://b/p/db_coll_latest/run2/id_bucket=1'"
+                " partition (id_bucket=2) location 's3://b/p/db_coll_latest/run2/id_bucket=2'"
+            ],
+        )
+        self.assertEqual(self.get_deleted(s3_client), self.keys[:2])
+
+    @mock.patch("generate_dataset_from_hbase.get_latest_records")
+    @mock.patch("generate_dataset_from_hbase.F")
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_snapshot_rebuilt_when_buckets_change(self, _, functions, latest):
+        statements, spark, s3_client = self.update_snapshot(
+            {"id_buckets": "8"}, range(8)
+        )
+
+        spark.table.assert_called_once_with("db.db_coll")
+        self.assertIn("drop table if exists db.db_coll_latest", statements)
+        # every bucket of earlier runs is replaced, not only those rewritten
+        self.assertEqual(self.get_deleted(s3_client), self.keys[:2])
+
+    @mock.patch("generate_dataset_from_hbase.get_latest_records")
+    @mock.patch("generate_dataset_from_hbase.F")
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_snapshot_merges_delta(self, _, functions, latest):
+        statements, spark, s3_client = self.update_snapshot(
+            {"id_buckets": "4"}, range(4)
+        )
+
+        spark.table.assert_called_once_with("db.db_coll_latest")
+        self.assertNotIn("drop table if exists db.db_coll_latest", statements)
+        self.assertEqual(
+            statements[1:],
+            [
+                "alter table db.db_coll_latest partition (id_bucket=1)"
+                " set location 's3://b/p/db_coll_latest/run2/id_bucket=1'",
+                "alter table db.db_coll_latest partition (id_bucket=2)"
+                " set location 's3://b/p/db_coll_latest/run2/id_bucket=2'",
+                "alter table db.db_coll_latest set tblproperties ('stale'='false')",
+            ],
+        )
+        self.assertEqual(self.get_deleted(s3_client), self.keys[:1])
+
+    @mock.patch("generate_dataset_from_hbase.get_latest_records")
+    @mock.patch("generate_dataset_from_hbase.F")
+    @mock.patch("generate_dataset_from_hbase._logger", create=True)
+    def test_stale_snapshot_is_rebuilt(self, _, functions, latest):
+        # a run that didn't maintain the snapshot registered its partition
+        statements, spark, s3_client = self.update_snapshot(
+            {"id_buckets": "4", "stale": "true"}, range(4)
+        )
+
+        spark.table.assert_called_once_with("db.db_coll")
+        self.assertIn("drop table if exists db.db_coll_latest", statements)
+        self.assertEqual(self.get_deleted(s3_client), self.keys[:2])
+
+
+@mock.patch("generate_dataset_from_hbase._logger", create=True)
+class TestS3Tagging(unittest.TestCase):
+    def setUp(self):
+        self.s3_client = mock.MagicMock()
+        # mock call counts are not thread safe, so record calls in a list
+        self.tagged = []
+        self.s3_client.put_object_tagging.side_effect = (
+            lambda **kwargs: self.tagged.append(kwargs)
+        )
+        self.s3_client.get_paginator.return_value.paginate.return_value = [
+            {"Contents": [{"Key": f"prefix/run/part-{i:05d}"} for i in range(1000)]},
+            {
+                "Contents": [
+                    {"Key": f"prefix/run/part-{i:05d}"} for i in range(1000, 1500)
+                ]
+            },
+            {},
+        ]
+        self.collection = {
+            "hbase_table": "db:collection",
+            "hive_table": "db_collection",
+            "start_time": 100,
+            "output_bucket": "bucket",
+            "full_output_prefix": "prefix/run",
+            "tags": {"pii": "true", "db": "db", "table": "collection"},
+        }
+
+    def test_tags_every_page(self, _):
+        tag_s3_objects(self.s3_client, self.collection, max_workers=4)
+        self.s3_client.get_paginator.assert_called_once_with("list_objects_v2")
+        self.s3_client.get_paginator.return_value.paginate.assert_called_once_with(
+            Bucket="bucket", Prefix="prefix/run"
+        )
+        self.assertEqual(len(self.tagged), 1500)
+        self.assertIn(
+            dict(
+                Bucket="bucket",
+                Key="prefix/run/part-01499",
+                Tagging={
+                    "TagSet": [
+                        {"Key": "pii", "Value": "true"},
+                        {"Key": "db", "Value": "db"},
+                        {"Key": "table", "Value": "collection"},
+                    ]
+                },
+            ),
+            self.tagged,
+        )
+
+    @mock.patch("generate_dataset_from_hbase.decrypt_message", mock_decrypt_message)
+    def test_tag_on_write(self, _):
+        reader = LocalHBaseReader([("<id1>", "100", "<record1>")])
+        collection = process_collection(
+            self.collection,
+            None,
+            200,
+            mock.MagicMock(),
+            reader,
+            decrypt_mode="record",
+            s3_tagging="on_write",
+            s3_client=self.s3_client,
+        )
+        self.assertTrue(collection["tagged"])
+        self.assertEqual(len(self.tagged), 1500)
+        self.assertEqual(collection["part_files"], 1500)
+
+
 class TestDksCache(unittest.TestCase):
     @mock.patch(
         "generate_dataset_from_hbase.get_key_from_dks",
@@ -100,14 +1939,48 @@ class TestDksCache(unittest.TestCase):
     )
     def test_dks_cache(self, post_mock):
         ceks = ["key1_ciphertext", "key2_ciphertext", "key3_ciphertext"]
+        dks_client = DksClient(url=None)
         for _ in range(5):
             for cek in ceks:
-                cek_plaintext = get_plaintext_key(url=None, kek=None, cek=cek, dks_count_acc=mock.MagicMock())
+                cek_plaintext = get_plaintext_key(
+                    kek=None, cek=cek, dks_client=dks_client
+                )
                 self.assertNotEqual(cek_plaintext, cek)
 
         # assert one call to 'dks' per key
         self.assertEqual(post_mock.call_count, len(ceks))
+        self.assertEqual(dks_client.stats(), {"hits": 12, "misses": 3, "evictions": 0})
+
+    @mock.patch(
+        "generate_dataset_from_hbase.get_key_from_dks",
+        side_effect=mock_get_key_from_dks,
+    )
+    def test_dks_cache_lru_eviction(self, post_mock):
+        dks_client = DksClient(url=None, cache_size=2)
+        for cek in ["key1_ciphertext", "key2_ciphertext", "key1_ciphertext"]:
+            dks_client.get_plaintext_key(None, cek)
+        dks_client.get_plaintext_key(None, "key3_ciphertext")  # evicts key2
+        dks_client.get_plaintext_key(None, "key1_ciphertext")
+        dks_client.get_plaintext_key(None, "key2_ciphertext")
+        self.assertEqual(post_mock.call_count, 4)
+        self.assertEqual(dks_client.stats()["evictions"], 2)
 
+    @mock.patch(
+        "generate_dataset_from_hbase.get_key_from_dks",
+        side_effect=mock_get_key_from_dks,
+    )
+    @mock.patch("generate_dataset_from_hbase.time.monotonic")
+    def test_dks_cache_ttl(self, monotonic_mock, post_mock):
+        dks_client = DksClient(url=None, ttl_seconds=60)
+        monotonic_mock.return_value = 1000
+        dks_client.get_plaintext_key(None, "key1_ciphertext")
+        monotonic_mock.return_value = 1030
+        dks_client.get_plaintext_key(None, "key1_ciphertext")
+        self.assertEqual(post_mock.call_count, 1)
+        monotonic_mock.return_value = 1061
+        dks_client.get_plaintext_key(None, "key1_ciphertext")
+        self.assertEqual(post_mock.call_count, 2)
+        self.assertEqual(dks_client.stats(), {"hits": 1, "misses": 2, "evictions": 1})
 
 
 if __name__ == "__main__":
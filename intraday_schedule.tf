@@ -70,6 +70,7 @@ resource "aws_lambda_function" "intraday_cron_launcher" {
       launch_topic_arn        = aws_sns_topic.hbase_incremental_refresh_sns.arn
       alert_topic_arn         = data.terraform_remote_state.security-tools.outputs.sns_topic_london_monitoring["arn"]
       collections_secret_name = local.collections_secret_name
+      lease_duration_minutes  = 60
     }
   }
   tags = { Name = "intraday-cron-launcher" }